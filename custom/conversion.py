@@ -1,48 +1,98 @@
 import pvlib
 from pvlib import solarposition
 import pandas as pd
+import numpy as np
 from datetime import datetime
+from functools import lru_cache
 import math
+import logging
 # -*- coding: utf-8 -*- #
 """
 Created on Wed Jul 19 11:08:22 2023
 
 @author: doylef
 """
+logger = logging.getLogger(__name__)
+
+SOLAR_CONSTANT = 1361  # W/m²
+
+
+class ConversionContext:
+    """
+    Per configuration state shared by the conversion functions: the building's pvlib Location
+    is built once, and solar zenith angles are memoized per simulation timestamp so that the
+    DHI and DNI conversions of the same timestep only compute the solar position once.
+    """
+    def __init__(self, config, cache_size=4096):
+        self.tz = config.get('DEFAULT', 'bldg_tz')
+        self.location = pvlib.location.Location(float(config.get('DEFAULT', 'bldg_latitude')), float(config.get('DEFAULT', 'bldg_longitude')), tz=self.tz, altitude=float(config.get('DEFAULT', 'bldg_altitude')))
+        self.zenith = lru_cache(maxsize=cache_size)(self._zenith)
+
+    def _zenith(self, time):
+        pdtime = pd.Timestamp(time, tz=self.tz)
+        solar_position = self.location.get_solarposition(pdtime)
+        return solar_position['zenith'].values[0]
+
+    def zenith_angles(self, times):
+        """zenith angles for an array of (naive, building local) timestamps in one pvlib call"""
+        times = pd.DatetimeIndex(times)
+        if times.tz is None:
+            #resolve DST ambiguity the same way pd.Timestamp(time, tz=...) does for single values
+            times = times.tz_localize(self.tz, ambiguous=np.zeros(len(times), dtype=bool), nonexistent=pd.Timedelta(hours=1))
+        else:
+            times = times.tz_convert(self.tz)
+        return self.location.get_solarposition(times)['zenith'].to_numpy()
+
+
+#a context is attached to the config object it was built from and goes away with it
+#(ConfigParser is not hashable, so it cannot key a WeakKeyDictionary)
+def get_conversion_context(config):
+    context = getattr(config, '_conversion_context', None)
+    if context is None:
+        context = ConversionContext(config)
+        config._conversion_context = context
+    return context
+
+def erbs_decomposition(ghi, zenith):
+    """
+    Vectorized DHI and DNI (W/m²) from GHI (W/m²) and solar zenith angle (degrees) using the
+    Erbs model; returns a (dhi, dni) tuple of arrays, both 0 when the sun is below the horizon
+    """
+    ghi = np.asarray(ghi, dtype=np.float64)
+    cos_theta = np.cos(np.radians(np.asarray(zenith, dtype=np.float64)))
+    ghi_0 = SOLAR_CONSTANT * cos_theta
+    sun_up = ghi_0 > 0
+    kt = np.divide(ghi, ghi_0, out=np.zeros_like(ghi_0), where=sun_up)
+    diffuse_fraction = np.select([kt <= 0.22, kt <= 0.8],
+                                 [1.0 - 0.09 * kt, 1.0 - 0.09 * kt - 0.6 * (kt - 0.22)**2],
+                                 0.165)
+    dhi = np.where(sun_up, ghi * diffuse_fraction, 0.0)
+    dni = np.divide(ghi - dhi, cos_theta, out=np.zeros_like(ghi_0), where=sun_up)
+    return dhi, dni
 
 def convert_F_to_C(config, time, temp):
     new_temp = (temp-32) * (5/9)
     return new_temp
 
 def solar_zenith_angle(config, time):
-
-    # Create location object
-    location = pvlib.location.Location(float(config.get('DEFAULT', 'bldg_latitude')), float(config.get('DEFAULT', 'bldg_longitude')), tz=config.get('DEFAULT', 'bldg_tz'), altitude=float(config.get('DEFAULT', 'bldg_altitude')))
-    pdtime = pd.Timestamp(time, tz=config.get('DEFAULT', 'bldg_tz'))
-    solar_position = location.get_solarposition(pdtime)
-    zenith_angle = solar_position['zenith'].values[0]
-    return zenith_angle
+    return get_conversion_context(config).zenith(time)
 
 def convert_mph_to_metps(config, time, speed):
     """Calculate speed in meters/s from mph"""
     mps_speed = speed * 0.44704
     return mps_speed
 
-def convert_ghi_to_dhi(config, time, ghi):
-    """Calculate DHI and DNI from GHI (W/m²) using Erbs model."""
-    # Step 1: Get solar zenith angle
-    theta = solar_zenith_angle(config, time)
-    print("theta:" + str(theta))
+def _erbs_scalar(ghi, theta):
+    """Calculate DHI and DNI from GHI (W/m²) using Erbs model; returns (dhi, dni)."""
     cos_theta = math.cos(math.radians(theta))
-    print("cos_theta:" + str(cos_theta))
+    logger.debug("theta:%s cos_theta:%s", theta, cos_theta)
 
     # Step 2: extraterrestrial radiation (GHI₀) on horizontal surface
-    solar_constant = 1361  # W/m²
-    ghi_0 = solar_constant * cos_theta  # Adjust for zenith
+    ghi_0 = SOLAR_CONSTANT * cos_theta  # Adjust for zenith
 
     # Step 3: Clearness index (kT)
     if ghi_0 <= 0:  # Avoid division by zero (sun below horizon)
-        return 0  # DHI = 0
+        return 0, 0  # DHI = DNI = 0
     kt = ghi / ghi_0
 
     # Step 4: Diffuse fraction using Erbs model
@@ -55,8 +105,13 @@ def convert_ghi_to_dhi(config, time, ghi):
 
     # Step 5: Calculate DHI and DNI
     dhi = ghi * diffuse_fraction
+    dni = (ghi - dhi) / cos_theta
+    return dhi, dni
 
-    return dhi
+def convert_ghi_to_dhi(config, time, ghi):
+    """Calculate DHI from GHI (W/m²) using Erbs model."""
+    # Step 1: Get solar zenith angle (memoized per timestep)
+    return _erbs_scalar(ghi, solar_zenith_angle(config, time))[0]
 
 def convert_inHg_to_Pa(config, time, inhg):
     """Calculate pressure in Pascals from inHg"""
@@ -65,35 +120,14 @@ def convert_inHg_to_Pa(config, time, inhg):
     return pressure_in_pa
 
 def convert_ghi_to_dni(config, time, ghi):
-    """Calculate DHI and DNI from GHI (W/m²) using Erbs model."""
-    # Step 1: Get solar zenith angle
-    theta = solar_zenith_angle(config, time)
-    print("theta:" + str(theta))
-    cos_theta = math.cos(math.radians(theta))
-    print("cos_theta:" + str(cos_theta))
-
-    # Step 2: extraterrestrial radiation (GHI₀) on horizontal surface
-    solar_constant = 1361  # W/m²
-    ghi_0 = solar_constant * cos_theta  # Adjust for zenith
-
-    # Step 3: Clearness index (kT)
-    if ghi_0 <= 0:  # Avoid division by zero (sun below horizon)
-        return 0  # DNI = 0
-    kt = ghi / ghi_0
+    """Calculate DNI from GHI (W/m²) using Erbs model."""
+    # Step 1: Get solar zenith angle (memoized per timestep)
+    return _erbs_scalar(ghi, solar_zenith_angle(config, time))[1]
 
-    # Step 4: Diffuse fraction using Erbs model
-    if kt <= 0.22:
-        diffuse_fraction = 1.0 - 0.09 * kt
-    elif 0.22 < kt <= 0.8:
-        diffuse_fraction = 1.0 - 0.09 * kt - 0.6 * (kt - 0.22)**2
-    else:  # kt > 0.8
-        diffuse_fraction = 0.165
-
-    # Step 5: Calculate DHI and DNI
-    dhi = ghi * diffuse_fraction
-    if cos_theta <= 0:  # Sun below horizon
-        dni = 0
-    else:
-        dni = (ghi - dhi) / cos_theta
+def convert_ghi_to_dhi_batch(config, times, ghi):
+    """Batch variant of convert_ghi_to_dhi for arrays of timestamps and GHI values (replay/backfill)."""
+    return erbs_decomposition(ghi, get_conversion_context(config).zenith_angles(times))[0]
 
-    return dni
\ No newline at end of file
+def convert_ghi_to_dni_batch(config, times, ghi):
+    """Batch variant of convert_ghi_to_dni for arrays of timestamps and GHI values (replay/backfill)."""
+    return erbs_decomposition(ghi, get_conversion_context(config).zenith_angles(times))[1]
\ No newline at end of file
@@ -7,14 +7,17 @@ Created on Thu Jun 22 11:27:38 2023
 import sys 
 import os
 from dotenv import load_dotenv
-load_dotenv() Load .env overrides before config
+load_dotenv() # Load .env overrides before config
 import pandas as pd
 import configparser
 import datetime
 from retrieval.core_retrieval import CoreRetrieval
 from opcmodule.opcmodule import OPCUAModule
 #import conversion
-from persistence.postgres_persistence import PostgresPersistence
+from persistence.registry import create_persistence_agent
+from simulator.signal_store import SignalStore
+from simulator.pacing import SimulationPacer
+from simulator.idf import IdfOverride, read_overrides
 from dateutil.parser import parse
 import logging
 logger = logging.getLogger(__name__)
@@ -27,10 +30,10 @@ class DigitalTwin:
         function defines four global objects that contain required data for execution
         throughout rest of program code
         1) config - a configuration object read from a .ini style file
-        2) signals_df - a pandas dataframe with information regarding signals to be 
-        retrieved via some external source (e.g. Seeq)
-        3) sensors_df - a dataframe of sensor data that is to be retrieved and persisted as 
-        the embodiment of the digital twin representation
+        2) signal_store - an array backed store with information regarding signals to be 
+        retrieved via some external source (e.g. Seeq) (signals_df is a dataframe view of it)
+        3) sensor_store - an array backed store of sensor data that is to be retrieved and persisted as 
+        the embodiment of the digital twin representation (sensors_df is a dataframe view of it)
         4) actuators_df - a dataframe defining the actuators to be overriden in EP
         
         Returns
@@ -55,39 +58,45 @@ class DigitalTwin:
         sys.path.insert(0, self.config.get('ENERGYPLUS', 'EnergyPlusDirectory'))
         #"signals" are the physical, real world data we will feed into virtual twin
         signals_path = os.path.join(working_directory, self.config.get('CONFIGURATIONFILES', 'SignalsFile'))
-        self.signals_df = pd.read_csv(signals_path)
-        self.signals_df = self.signals_df.assign(current_val=-1)
+        self.signal_store = SignalStore(pd.read_csv(signals_path), 'SignalTagName', track_quality=True)
         #"sensors" are the energyplus variables we want to collect and persist as the representation of the digital twin
         #we include both variables termed as "sensors" in EP as well as "meters"
         sensors_path = os.path.join(working_directory, self.config.get('CONFIGURATIONFILES', 'SensorsFile'))
-        self.sensors_df = pd.read_csv(sensors_path)
-        self.sensors_df = self.sensors_df.assign(ep_handle=-1)
-        self.sensors_df = self.sensors_df.assign(current_val=-1)
+        self.sensor_store = SignalStore(pd.read_csv(sensors_path), 'PersistenceName')
         #actuators are the settings in energyplus simulation we will be overriding
         actuators_path = os.path.join(working_directory, self.config.get('CONFIGURATIONFILES', 'ActuatorsFile'))
         self.actuators_df = pd.read_csv(actuators_path)
         self.actuators_df = self.actuators_df.assign(ep_handle=-1)
         self.actuators_df = self.actuators_df.assign(current_val=-1)
+        #optional fixed actuator values (ActuatorCategory, ActuatorName, ActuatorInstance, Value) that
+        #replace the values derived from the actuators' signals, e.g. for the variants of a sweep
+        self.actuator_overrides_df = None
+        actuator_overrides_file = self.config.get('CONFIGURATIONFILES', 'ActuatorOverridesFile', fallback='').strip()
+        if actuator_overrides_file:
+            self.actuator_overrides_df = pd.read_csv(os.path.join(working_directory, actuator_overrides_file))
         #custom are the optional reflection based fundtions that the user can define to be called via reflection
         #at specified timepoints
         custom_path = os.path.join(working_directory, self.config.get('CONFIGURATIONFILES', 'CustomFile'))
         self.custom_callbacks_df = pd.read_csv(custom_path)
         #print(self.custom_callbacks_df)
        
-        #create our persistence agent
-        if self.config.get('DEFAULT', 'PersistenceType') == 'SQL':
-            from persistence.postgres_persistence_etv import PostgresPersistenceETV
-            self.persistence_agent = PostgresPersistenceETV(self.config, self.sensors_df)
-        else:
-            raise ValueError("Unsupported PersistenceType")    
+        #create our persistence agent, the backend is selected by PersistenceType
+        self.persistence_agent = create_persistence_agent(self.config, self.sensor_store)
+        #optionally decouple the simulation thread from the database via a write-behind queue
+        if self.config.get('PERSISTENCE', 'WriteBehindEnabled', fallback='false').strip().lower() == 'true':
+            from persistence.write_behind import WriteBehindPersistence
+            self.persistence_agent = WriteBehindPersistence(self.config, self.persistence_agent, self.sensor_store)
         
+        #pacing of simulation time against the wall clock, shared by the simulator and
+        #the retrieval read-ahead workers
+        self.pacer = SimulationPacer(self.config)
         #retrieval agent is the object we use to obtain real world signals
-        self.retrieval_agent = CoreRetrieval(self.config, self.signals_df)
+        self.retrieval_agent = CoreRetrieval(self.config, self.signal_store, self.pacer)
         #handle OPC UA if active
         self.opc_module = None
         if self.config.get('OPCSERVER', 'OpcServerEnabled').lower() == 'true':
             
-            self.opc_module = OPCUAModule(working_directory, self.config)
+            self.opc_module = OPCUAModule(working_directory, self.config, self.signal_store.metadata)
             self.opc_module.start()  
             self.retrieval_agent.add_retrieval_agent(self.opc_module) 
 
@@ -125,14 +134,46 @@ class DigitalTwin:
         print('begin_day_name:{}'.format(begin_day_name))
 
             
-        self.override_map = {'!- Begin Year': "  {},                                   !- Begin Year\n".format(begin_year),
-                            '!- Begin Month': "  {},                                      !- Begin Month\n".format(begin_month),
-                             '!- Begin Day of Month': "  {},                                      !- Begin Day of Month\n".format(begin_day),
-                             '!- End Year': "  {},                                   !- End Year\n".format(end_year),
-                             '!- End Month': "  {},                                     !- End Month\n".format(end_month),
-                             '!- End Day of Month': "  {},                                     !- End Day of Month\n".format(end_day),
-                             '!- Day of Week for Start Day': "  {},                              !- Day of Week for Start Day\n".format(begin_day_name)
-                             }
+        #field overrides applied to the building model when it is prepared for simulation; RunPeriod
+        #fields after the name: begin month, day, year, end month, day, year, day of week for start day
+        self.idf_overrides = [IdfOverride('RunPeriod', '*', 1, begin_month),
+                              IdfOverride('RunPeriod', '*', 2, begin_day),
+                              IdfOverride('RunPeriod', '*', 3, begin_year),
+                              IdfOverride('RunPeriod', '*', 4, end_month),
+                              IdfOverride('RunPeriod', '*', 5, end_day),
+                              IdfOverride('RunPeriod', '*', 6, end_year),
+                              IdfOverride('RunPeriod', '*', 7, begin_day_name)]
+        #further per twin overrides (timestep, output variables, schedules, simulation control, ...)
+        #from the optional declarative override file; they are applied after, so win over, the RunPeriod
+        overrides_file = self.config.get('CONFIGURATIONFILES', 'IdfOverridesFile', fallback='').strip()
+        if overrides_file:
+            self.idf_overrides.extend(read_overrides(os.path.join(working_directory, overrides_file)))
+
+    @property
+    def signals_df(self):
+        """dataframe copy of the signals, built lazily from the signal store (see sensors_df)"""
+        return self.signal_store.frame()
+
+    @signals_df.setter
+    def signals_df(self, frame):
+        self.signal_store.update_from_frame(frame)
+
+    @property
+    def sensors_df(self):
+        """
+        dataframe copy of the sensors, built lazily from the sensor store. Intended for custom
+        callbacks and other code off the per timestep path; changed current_val values are kept
+        by assigning the frame back, e.g.
+            sensors_df = digital_twin.sensors_df
+            sensors_df.loc[sensors_df['PersistenceName'] == 'zone_temp', 'current_val'] = 21.0
+            digital_twin.sensors_df = sensors_df
+        """
+        return self.sensor_store.frame()
+
+    @sensors_df.setter
+    def sensors_df(self, frame):
+        self.sensor_store.update_from_frame(frame)
+
     '''
     def store_simulated_signals(self, timestamp):
         output_line = timestamp.strftime("%m/%d/%Y, %H:%M:%S")
@@ -158,10 +199,22 @@ class DigitalTwin:
             self.persistence_agent.persist(timestamp)
             #this is also the appropriate time to publish OPC signals if enabled
             if self.opc_module is not None:
-                self.opc_module.update_variables(self.sensors_df)
+                self.opc_module.update_variables(self.sensor_store, timestamp)
             
     def get_signals_for_timepoint(self, timepoint):
-       self.retrieval_agent.retrieve_signals_for_actuators_at_timepoint(self.signals_df, timepoint)
+       self.retrieval_agent.retrieve_signals_for_actuators_at_timepoint(self.signal_store, timepoint)
+
+    def close(self):
+        """releases background resources once the simulation has finished"""
+        #the pacer is shared by the simulator and the retrieval read-ahead workers; stopping it
+        #releases workers still waiting for a timepoint to become due
+        self.pacer.stop()
+        self.retrieval_agent.close()
+        #flushes any queued measurements when write-behind is enabled
+        if hasattr(self.persistence_agent, 'close'):
+            self.persistence_agent.close()
+        if self.opc_module is not None:
+            self.opc_module.stop()
                                                                         
               
 """
@@ -183,6 +236,7 @@ if __name__ == "__main__":
     import simulator.ep_manager as epm 
     epmgr = epm.EpManager(dt)
     epmgr.invoke_simulation()
+    dt.close()
         
 
     
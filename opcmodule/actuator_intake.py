@@ -0,0 +1,81 @@
+import numpy as np
+from simulator.signal_store import SignalReading, QUALITY_GOOD, QUALITY_BAD
+import logging
+
+
+class ActuatorIntake:
+    """
+    latest value table of the writable actuator nodes, kept current by a server side data change
+    subscription: values written by OPC clients are pushed into the table by the server's event
+    loop, so a retrieval only reads the rows of the signals it serves. The table is plain numpy
+    arrays without a lock; a reader racing a notification sees either the previous or the new
+    value of a row.
+    """
+    def __init__(self, tag_names):
+        self._logger = logging.getLogger(__name__)
+        self.tag_names = list(dict.fromkeys(tag_names))
+        self.rows = {tag_name: row for row, tag_name in enumerate(self.tag_names)}
+        self.values = np.full(len(self.tag_names), np.nan)
+        self.quality = np.full(len(self.tag_names), QUALITY_BAD, dtype=np.int8)
+        self.timestamps = np.full(len(self.tag_names), None, dtype=object)
+        #the first notification of a monitored item is the node's initial value, not a client write
+        self.initialized = np.zeros(len(self.tag_names), dtype=bool)
+        self.node_rows = {}
+        self.subscription = None
+        #signals served by fetch, all actuators until bind_signals narrows them down
+        self.signal_tags = list(self.tag_names)
+        self.signal_rows = np.arange(len(self.tag_names))
+
+    def bind_signals(self, signal_metadata):
+        """restricts the readings to the signals whose SignalSource is opc, resolved to table rows once"""
+        opc_signals = signal_metadata[signal_metadata['SignalSource'].str.lower() == 'opc']
+        self.signal_tags = []
+        rows = []
+        for tag_name in opc_signals['SignalTagName']:
+            if tag_name not in self.rows:
+                self._logger.error("Signal {} is not a writable OPC-UA actuator tag".format(tag_name))
+                continue
+            self.signal_tags.append(tag_name)
+            rows.append(self.rows[tag_name])
+        self.signal_rows = np.asarray(rows, dtype=np.int64)
+
+    async def subscribe(self, server, tagmap, interval_ms):
+        """subscribes to data changes of all actuator nodes, with this object as the handler"""
+        nodes = []
+        for tag_name in self.tag_names:
+            node = tagmap.get(tag_name)
+            if node is None:
+                continue
+            self.node_rows[node.nodeid] = self.rows[tag_name]
+            nodes.append(node)
+        if not nodes:
+            return
+        self.subscription = await server.create_subscription(interval_ms, self)
+        await self.subscription.subscribe_data_change(nodes)
+        self._logger.info("Subscribed to {} OPC-UA actuator tags every {}ms".format(len(nodes), interval_ms))
+
+    def datachange_notification(self, node, val, data):
+        row = self.node_rows.get(node.nodeid)
+        if row is None:
+            return
+        if not self.initialized[row]:
+            self.initialized[row] = True
+            return
+        data_value = data.monitored_item.Value
+        try:
+            value = float(val)
+        except (TypeError, ValueError):
+            value = np.nan
+        good = data_value.StatusCode is None or data_value.StatusCode.is_good()
+        self.timestamps[row] = data_value.SourceTimestamp or data_value.ServerTimestamp
+        self.quality[row] = QUALITY_GOOD if good and not np.isnan(value) else QUALITY_BAD
+        self.values[row] = value
+
+    def readings(self):
+        """SignalTagName -> SignalReading of the served signals; unwritten tags have a NaN value and bad quality"""
+        rows = self.signal_rows
+        values = self.values[rows].tolist()
+        quality = self.quality[rows].tolist()
+        timestamps = self.timestamps[rows].tolist()
+        return {tag_name: SignalReading(value, code, timestamp)
+                for tag_name, value, code, timestamp in zip(self.signal_tags, values, quality, timestamps)}
@@ -0,0 +1,171 @@
+import time
+from asyncua import ua
+from asyncua.common.structures104 import new_enum_field
+import logging
+
+#browse name prefix of the metadata enumerations, one per distinct metadata tuple
+META_ENUM_PREFIX = "MetaEnum"
+
+
+class AddressSpaceBuilder:
+    """
+    builds the address space of all OPC devices with a handful of batched service calls instead
+    of several round trips per variable: device objects, metadata enumerations (one per distinct
+    metadata tuple) and their definitions, variables and their meta_enum children are each added
+    in one call, and the data type definitions are loaded once at the end
+    """
+    def __init__(self, server, namespace, uri):
+        self.server = server
+        self.namespace = namespace
+        self.uri = uri
+        self.session = server.iserver.isession
+        self._logger = logging.getLogger(__name__)
+        self.meta_enums = {}
+
+    async def add_nodes(self, items, what):
+        results = await self.session.add_nodes(items)
+        for item, result in zip(items, results):
+            if not result.StatusCode.is_good():
+                raise ua.UaStatusCodeError(result.StatusCode.value, "adding {} {}".format(what, item.BrowseName.Name))
+        return [result.AddedNodeId for result in results]
+
+    async def add_device_objects(self, devices):
+        items = []
+        for device in devices:
+            item = ua.AddNodesItem()
+            item.RequestedNewNodeId = ua.NodeId(0, self.namespace)
+            item.BrowseName = ua.QualifiedName(device.device_name, self.namespace)
+            item.NodeClass = ua.NodeClass.Object
+            item.ParentNodeId = ua.NodeId(ua.ObjectIds.ObjectsFolder)
+            item.ReferenceTypeId = ua.NodeId(ua.ObjectIds.Organizes)
+            item.TypeDefinition = ua.NodeId(ua.ObjectIds.BaseObjectType)
+            attrs = ua.ObjectAttributes()
+            attrs.EventNotifier = 0
+            attrs.Description = ua.LocalizedText(device.device_name)
+            attrs.DisplayName = ua.LocalizedText(device.device_name)
+            item.NodeAttributes = attrs
+            items.append(item)
+        node_ids = await self.add_nodes(items, "device")
+        for device, node_id in zip(devices, node_ids):
+            device.node = self.server.get_node(node_id)
+
+    async def add_meta_enums(self, meta_lists):
+        """creates an enumeration data type for every metadata tuple not seen before"""
+        new_lists = list(dict.fromkeys(meta_list for meta_list in meta_lists if meta_list not in self.meta_enums))
+        if not new_lists:
+            return
+        parent = ua.NodeId(ua.ObjectIds.Enumeration)
+        items = []
+        for number, meta_list in enumerate(new_lists, start=len(self.meta_enums)):
+            name = "{}_{}".format(META_ENUM_PREFIX, number)
+            item = ua.AddNodesItem()
+            item.RequestedNewNodeId = ua.NodeId(0, self.namespace)
+            item.BrowseName = ua.QualifiedName(name, self.namespace)
+            item.NodeClass = ua.NodeClass.DataType
+            item.ParentNodeId = parent
+            item.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasSubtype)
+            attrs = ua.DataTypeAttributes()
+            attrs.Description = ua.LocalizedText(name)
+            attrs.DisplayName = ua.LocalizedText(name)
+            attrs.IsAbstract = False
+            item.NodeAttributes = attrs
+            items.append(item)
+        node_ids = await self.add_nodes(items, "metadata enumeration")
+        writes = []
+        for meta_list, node_id in zip(new_lists, node_ids):
+            self.meta_enums[meta_list] = node_id
+            definition = ua.EnumDefinition()
+            for value, field_name in enumerate(meta_list):
+                field = new_enum_field(field_name)
+                field.Value = value
+                definition.Fields.append(field)
+            writes.append(ua.WriteValue(NodeId=node_id, AttributeId=ua.AttributeIds.DataTypeDefinition,
+                                        Value=ua.DataValue(ua.Variant(definition, ua.VariantType.ExtensionObject))))
+        results = await self.session.write(ua.WriteParameters(NodesToWrite=writes))
+        for write, status in zip(writes, results):
+            status.check()
+
+    def variable_item(self, parent, node_id, browse_name, display_name, description, value, variant_type, datatype, writable,
+                      historizing=False):
+        item = ua.AddNodesItem()
+        item.RequestedNewNodeId = node_id
+        item.BrowseName = browse_name
+        item.NodeClass = ua.NodeClass.Variable
+        item.ParentNodeId = parent
+        item.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasComponent)
+        item.TypeDefinition = ua.NodeId(ua.ObjectIds.BaseDataVariableType)
+        attrs = ua.VariableAttributes()
+        attrs.DisplayName = ua.LocalizedText(display_name)
+        attrs.Description = ua.LocalizedText(description)
+        attrs.DataType = datatype
+        attrs.Value = ua.Variant(value, variant_type)
+        attrs.ValueRank = ua.ValueRank.Scalar
+        attrs.ArrayDimensions = None
+        attrs.Historizing = historizing
+        access = ua.AccessLevel.CurrentRead.mask
+        if writable:
+            access |= ua.AccessLevel.CurrentWrite.mask
+        if historizing:
+            access |= ua.AccessLevel.HistoryRead.mask
+        attrs.AccessLevel = access
+        attrs.UserAccessLevel = access
+        item.NodeAttributes = attrs
+        return item
+
+    async def build(self, devices, module_tagmap, historize=False):
+        """
+        creates the nodes of all devices and fills each device's node, variable and actuator maps,
+        as well as module_tagmap (tag name to variable node across all devices); with historize the
+        sensor (non actuator) variables are flagged as historizing and readable with HistoryRead
+        """
+        start = time.perf_counter()
+        for device in devices:
+            device.server = self.server
+            device.namespace = self.namespace
+            device.uri = self.uri
+        await self.add_device_objects(devices)
+
+        variables = []
+        for device in devices:
+            df = device.variables_df
+            for idx in df.index:
+                variables.append((device, idx, tuple(device.create_metadata_list(idx))))
+        await self.add_meta_enums([meta_list for _, _, meta_list in variables])
+
+        items = []
+        variant_types = []
+        for device, idx, _ in variables:
+            df = device.variables_df
+            tag_name = df['tag_name'][idx]
+            is_actuator = df['ep_type'][idx] == 'actuator'
+            variant_type, initial_value = device.resolve_pandas_dtype_to_opc(df['data_type'][idx])
+            variant_types.append(variant_type)
+            items.append(self.variable_item(device.node.nodeid,
+                                            ua.NodeId.from_string('ns={};s={}'.format(self.namespace, tag_name)),
+                                            ua.QualifiedName.from_string(str(df['description'][idx])),
+                                            str(df['var_name'][idx]), str(df['unit'][idx]),
+                                            initial_value, variant_type, ua.NodeId(variant_type.value),
+                                            is_actuator, historize and not is_actuator))
+        node_ids = await self.add_nodes(items, "variable")
+
+        meta_items = []
+        for (device, idx, meta_list), node_id, variant_type in zip(variables, node_ids, variant_types):
+            df = device.variables_df
+            tag_name = df['tag_name'][idx]
+            variable = self.server.get_node(node_id)
+            #if this is an actuator, it is writeable and must not be overwritten with DT data
+            if df['ep_type'][idx] == 'actuator':
+                device.actuators.add(tag_name)
+            device.variables_map[tag_name] = variable
+            device.variables[tag_name] = variable
+            device.variable_types[tag_name] = variant_type
+            module_tagmap[tag_name] = variable
+            #metadata of the variable, as a child variable of its metadata enumeration type
+            meta_items.append(self.variable_item(node_id, ua.NodeId(0, self.namespace),
+                                                 ua.QualifiedName("meta_enum", self.namespace), "meta_enum", "meta_enum",
+                                                 0, ua.VariantType.Int32, self.meta_enums[meta_list], False))
+        await self.add_nodes(meta_items, "meta_enum")
+
+        await self.server.load_data_type_definitions()
+        self._logger.info("OPC address space built in {:.2f}s: {} devices, {} variables, {} metadata enumerations".format(
+            time.perf_counter() - start, len(devices), len(variables), len(self.meta_enums)))
@@ -1,29 +1,55 @@
 import threading
 import os
+import numpy as np
 import pandas as pd
 import time
 import asyncio
 import datetime as dt
 from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
 from asyncua import ua, Server
-from asyncua.common.structures104 import new_enum
 from opcmodule.opc_device import OPCDevice
+from opcmodule.address_space_builder import AddressSpaceBuilder
+from opcmodule.actuator_intake import ActuatorIntake
+from opcmodule.ring_history import RingHistoryStorage
 import logging
 
 class OPCUAModule:
-    def __init__(self, working_directory, config):
+    def __init__(self, working_directory, config, signal_metadata=None):
         self.working_directory = working_directory
         self.config = config
         self._logger = logging.getLogger(__name__)
 
         self.server = None
+        self.thread = None
         self.uri = None
         self.namespace = None
         self.should_run = True
         self.devices = []
         self.tagmap = {}
-        self.sensors_df_reference = None
-        self.sensors_updated = True
+        self.sensor_store_reference = None
+        #the simulation thread hands immutable snapshots to the server's event loop through a
+        #one slot queue; a snapshot not yet published is replaced by the newer one
+        self.loop = None
+        self.publish_queue = None
+        self.pending_update = None
+        #guards the handover of pending_update while the event loop is being set up
+        self.handover_lock = threading.Lock()
+        #changed values are published right after each update, at most every PublishIntervalSeconds;
+        #a tag is republished once it moved by more than its deadband (per tag 'deadband' column or PublishDeadband)
+        self.publish_interval = float(self.config.get('OPCSERVER', 'PublishIntervalSeconds', fallback='0'))
+        self.publish_deadband = float(self.config.get('OPCSERVER', 'PublishDeadband', fallback='0'))
+        #optional in memory history of the sensor variables, HistoryDepth timesteps per tag, for HistoryRead
+        self.history_enabled = self.config.get('OPCSERVER', 'HistoryEnabled', fallback='false').strip().lower() == 'true'
+        self.history_depth = int(self.config.get('OPCSERVER', 'HistoryDepth', fallback='10080'))
+        self.history = None
+        self.history_tags = []
+        self.history_store_keys = None
+        self.history_slots = None
+        self.history_columns = None
+        #simulation timestamps are naive building local times (bldg_tz, or the host's time zone)
+        bldg_tz = self.config.get('DEFAULT', 'bldg_tz', fallback='').strip()
+        self.tz = ZoneInfo(bldg_tz) if bldg_tz else None
 
         devices_path = os.path.join(self.working_directory, self.config.get('CONFIGURATIONFILES', 'OpcDevicesFile'))
         self.opc_devices_df = pd.read_csv(devices_path)
@@ -38,53 +64,144 @@ class OPCUAModule:
             curr_opc_device_description = self.opc_devices_df['description'][idx]
             current_opc_device_class = self.opc_devices_df['class'][idx]
             #get subframe from variables for this device
-            device_variables_df = self.opc_variables_df[self.opc_variables_df['device_name'] == curr_opc_device_name]
+            device_variables_df = self.opc_variables_df[self.opc_variables_df['device_name'] == curr_opc_device_name].copy()
             
-            current_device = OPCDevice(curr_opc_device_name, curr_opc_device_description, current_opc_device_class, device_variables_df)
+            current_device = OPCDevice(curr_opc_device_name, curr_opc_device_description, current_opc_device_class, device_variables_df,
+                                       self.publish_deadband)
             
             
             self.devices.append(current_device)
             
             
         self._logger.info('all opc devices instantiated')
+        #values written by OPC clients to actuator tags are pushed into a latest value table by a
+        #server side subscription, every ActuatorSubscriptionIntervalMs at most
+        actuator_tags = self.opc_variables_df.loc[self.opc_variables_df['ep_type'] == 'actuator', 'tag_name']
+        self.actuator_intake = ActuatorIntake(actuator_tags)
+        if signal_metadata is not None:
+            self.actuator_intake.bind_signals(signal_metadata)
+        self.actuator_subscription_interval = float(self.config.get('OPCSERVER', 'ActuatorSubscriptionIntervalMs', fallback='100'))
     
     async def add_variables_to_devices(self):
-        for curr_device in self.devices:
-            await curr_device.add_variables(self.server, self.namespace, self.uri, self.tagmap)
+        #all devices are built together, so metadata types are shared and nodes added in a few batches
+        builder = AddressSpaceBuilder(self.server, self.namespace, self.uri)
+        await builder.build(self.devices, self.tagmap, historize=self.history_enabled)
         self._logger.info('all opc device nodes registered')
 
 
+    def create_history(self):
+        """serves HistoryRead of all sensor variables from a ring buffer filled by update_variables"""
+        node_ids = []
+        variant_types = []
+        self.history_tags = []
+        for dev in self.devices:
+            for tag_name, variable in dev.variables.items():
+                if tag_name in dev.actuators:
+                    continue
+                self.history_tags.append(tag_name)
+                node_ids.append(variable.nodeid)
+                variant_types.append(dev.variable_types[tag_name])
+        self.history = RingHistoryStorage(node_ids, variant_types, self.history_depth)
+        self.server.iserver.history_manager.set_storage(self.history)
+
+    def record_history(self, sensor_store, sensor_values, timestamp):
+        if sensor_store.keys is not self.history_store_keys:
+            tag_slots = sensor_store.index_by('opc_tag_name')
+            columns = [column for column, tag_name in enumerate(self.history_tags) if tag_name in tag_slots]
+            self.history_columns = np.asarray(columns, dtype=np.int64)
+            self.history_slots = np.asarray([tag_slots[self.history_tags[column]] for column in columns], dtype=np.int64)
+            self.history_store_keys = sensor_store.keys
+        self.history.record(timestamp, sensor_values[self.history_slots], self.history_columns)
+
     #async def add_simulator_variables(self):
     #    for curr_device in self.devices:
     #        await self.tagmap | curr_device.add_variables(self.server, self.namespace, self.uri)
     #    self._logger.info('all opc device variables added')
-    def update_variables(self, sensors_df):
+    def source_timestamp(self, simulation_datetime):
+        """UTC datetime of a (naive, building local) simulation datetime"""
+        if simulation_datetime is None:
+            return datetime.now(timezone.utc)
+        if simulation_datetime.tzinfo is None:
+            if self.tz is None:
+                return simulation_datetime.astimezone(timezone.utc)
+            simulation_datetime = simulation_datetime.replace(tzinfo=self.tz)
+        return simulation_datetime.astimezone(timezone.utc)
+
+    def update_variables(self, sensor_store, simulation_datetime=None):
+        """
+        called from the simulation thread after each timestep's sensors are stored: snapshots the
+        sensor values and hands them to the publishing loop without waiting for it. Values are
+        published and historized with the simulation datetime as their source timestamp, so that
+        fast and scaled replays are historized along simulation time
+        """
         #for now we are passing in the object rather than registering it on initialization
         #in case it changes over time
-        self.sensors_df_reference = sensors_df
-        self.sensors_updated = True
+        self.sensor_store_reference = sensor_store
+        update = (sensor_store, sensor_store.snapshot(), self.source_timestamp(simulation_datetime))
+        if self.history is not None:
+            #recorded here rather than when publishing, so timesteps coalesced by the publish loop are
+            #still historized; the ring is written without a lock (see RingHistoryStorage)
+            self.record_history(*update)
+        with self.handover_lock:
+            loop = self.loop
+            if loop is None:
+                #server still starting, the latest update is published once it is up
+                self.pending_update = update
+                return
+        try:
+            loop.call_soon_threadsafe(self._enqueue, update)
+        except RuntimeError:
+            #event loop already closed
+            pass
+
+    def _enqueue(self, update):
+        #runs on the event loop; coalesces to the latest snapshot if the previous one is still queued
+        if self.publish_queue.full():
+            self.publish_queue.get_nowait()
+        self.publish_queue.put_nowait(update)
+
+    def _wake(self):
+        #runs on the event loop; wakes the publish loop without displacing a queued snapshot
+        if self.publish_queue.empty():
+            self.publish_queue.put_nowait(None)
 
    
     
+    def fetch_signals_at_timepoint(self, timepoint):
+        """
+        returns the latest values OPC clients wrote to the actuator tags of the signals with SignalSource
+        opc, as a dict of SignalTagName -> SignalReading with the source timestamp of each write.
+        Timepoint is irrelevant for OPC-UA retrieval, as values are pushed live by the OPC-UA server.
+        """
+        return self.actuator_intake.readings()
+
     def retrieve_signals_for_actuators_at_timepoint(self, signals_df, timepoint):
         """
         function retrieves the physical building's signals of interest that will be used
         to override EP simulation actuators, and places values in the appropriate dataframes.
-        Timepoint is irrelevant for OPC-UA retrieval, as values are read live from the OPC-UA server.
         """
+        readings = self.fetch_signals_at_timepoint(timepoint)
+        value_col = signals_df.columns.get_loc('current_val')
         for idx in signals_df.index:
-            if signals_df['SignalSource'][idx].lower() != 'opc':
-            
-                curr_signal_tagname = signals_df['SignalTagName'][idx]
-                try:
-                    curr_signal_value = self.tagmap[curr_signal_tagname].get_value()
-                    #if the returned value is valid, set it in the dataframe
-                    if curr_signal_value is not None:
-                        signals_df.iloc[idx, signals_df.columns.get_loc('current_val')] = curr_signal_value
-                    else:
-                        self._logger.warning("Signal {} returned None value at time {}, retaining setting as last valid".format(curr_signal_tagname, timepoint))
-                except KeyError:
-                    self._logger.error("Signal {} not found in OPC-UA tag map".format(curr_signal_tagname))
+            reading = readings.get(signals_df['SignalTagName'][idx])
+            if reading is not None and not np.isnan(reading.value):
+                signals_df.iloc[idx, value_col] = reading.value
+            elif reading is not None:
+                self._logger.warning("Signal {} has no valid value at time {}, retaining setting as last valid".format(signals_df['SignalTagName'][idx], timepoint))
+
+    async def publish_changes(self, sensor_store, sensor_values, timestamp):
+        """
+        writes the tags of all devices that changed beyond their deadband in a single batched write
+        """
+        writes = []
+        for dev in self.devices:
+            writes.extend(dev.changed_writes(sensor_store, sensor_values, timestamp))
+        if writes:
+            results = await self.server.iserver.isession.write(ua.WriteParameters(NodesToWrite=writes))
+            failed = [write.NodeId for write, status in zip(writes, results) if not status.is_good()]
+            if failed:
+                self._logger.warning("OPC publish rejected for {} tags, e.g. {}".format(len(failed), failed[0]))
+        self._logger.debug("Published {} changed OPC tags".format(len(writes)))
 
     async def core(self):
         """Core asynchronous method to set up and run the OPC UA server."""
@@ -101,33 +218,61 @@ class OPCUAModule:
         self.uri = uri
         self.namespace = await self.server.register_namespace(uri)
         await self.add_variables_to_devices()
+        await self.actuator_intake.subscribe(self.server, self.tagmap, self.actuator_subscription_interval)
+        if self.history_enabled:
+            self.create_history()
 
         self._logger.info('Starting OPC server!')
         async with self.server:
-            # run forever and iterate over devices and publish their variables' values
-            # at intervals defined by sleep time
+            self.publish_queue = asyncio.Queue(maxsize=1)
+            #from here on updates are handed to the loop, so an update stored before is drained
+            #after the loop is set, and none can be left behind in pending_update
+            with self.handover_lock:
+                self.loop = asyncio.get_running_loop()
+                pending, self.pending_update = self.pending_update, None
+            if pending is not None:
+                self._enqueue(pending)
+            # run until stopped, publishing each snapshot handed over by update_variables
             while self.should_run:
                 try:
-                    if self.sensors_updated:
-                        #reset flag
-                        self.sensors_updated = False
-                        #update all devices with latest sensor dataframe value
-                        for dev in self.devices:
-                                await dev.publish_variables(self.sensors_df_reference)                            
-                    
-                    await asyncio.sleep(10)
+                    update = await self.publish_queue.get()
+                    if update is None:
+                        #stop() wake up
+                        continue
+                    await self.publish_changes(*update)
+                    if self.publish_interval > 0:
+                        await asyncio.sleep(self.publish_interval)
                 
                 except Exception as e:
                     self._logger.error("Exception in publish loop..."+str(e))
+            #the final timestep's snapshot may still be queued when stop() comes in
+            while not self.publish_queue.empty():
+                update = self.publish_queue.get_nowait()
+                if update is not None:
+                    try:
+                        await self.publish_changes(*update)
+                    except Exception as e:
+                        self._logger.error("Exception publishing the last snapshot..."+str(e))
+            with self.handover_lock:
+                self.loop = None
 
     def main(self):
         """Main method to start the asyncio event loop and run the core server logic."""
         asyncio.run(self.core())
 
+    def stop(self):
+        """stops the publish loop, which shuts the server down"""
+        self.should_run = False
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._wake)
+            except RuntimeError:
+                pass
+
     def start(self):
         """Start the OPC UA server in a separate thread. Even though we are 
         using asyncio, we need to run it in its own thread to avoid blocking
         the main program execution."""
         #my_thread = threading.Thread(target=self.main, args=(self,))
-        my_thread = threading.Thread(target=self.main)
-        my_thread.start()
+        self.thread = threading.Thread(target=self.main)
+        self.thread.start()
@@ -0,0 +1,149 @@
+import numpy as np
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from asyncua import ua
+from asyncua.server.history import HistoryStorageInterface
+from opcmodule.opc_device import UA_VALUE_CASTS
+import logging
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _to_ns(timestamp):
+    """nanoseconds since the unix epoch of a (naive UTC or aware) datetime"""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    delta = timestamp - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000_000 + delta.microseconds * 1000
+
+
+class RingHistoryStorage(HistoryStorageInterface):
+    """
+    in memory history of the published sensor variables, answering OPC UA HistoryRead requests
+    without a database. Every recorded timestep takes one slot of a fixed size ring holding the
+    values of all historized tags (one column per tag) and their common source timestamp, so
+    the last depth timesteps are kept and recording is a single vectorized row assignment.
+    NaN marks a tag without a value in a slot; such slots are left out of read results.
+    The ring is written without a lock, so a read racing a write may include the slot being
+    overwritten.
+    """
+    def __init__(self, node_ids, variant_types, depth, max_history_data_response_size=10000):
+        super().__init__(max_history_data_response_size)
+        self._logger = logging.getLogger(__name__)
+        self.columns = {node_id: column for column, node_id in enumerate(node_ids)}
+        self.variant_types = list(variant_types)
+        self.depth = max(int(depth), 1)
+        self.times = np.zeros(self.depth, dtype=np.int64)
+        self.values = np.full((self.depth, len(self.columns)), np.nan)
+        #next slot to write, and number of slots written so far (capped at depth)
+        self.head = 0
+        self.count = 0
+        #continuation points handed out by reads without a start time, which run backwards from the
+        #end time: the next page starts at the continuation point and must keep running backwards
+        self._reverse_continuations = OrderedDict()
+        self._logger.info("OPC history ring for {} tags, {} timesteps deep ({:.1f} MB)".format(
+            len(self.columns), self.depth, (self.values.nbytes + self.times.nbytes) / 1e6))
+
+    def record(self, timestamp, values, columns=None):
+        """
+        stores values (aligned with the historized tags, or with columns if given) as one timestep
+        """
+        row = self.head
+        self.times[row] = _to_ns(timestamp)
+        if columns is None:
+            self.values[row] = values
+        else:
+            self.values[row] = np.nan
+            self.values[row, columns] = values
+        self.head = (row + 1) % self.depth
+        self.count = min(self.count + 1, self.depth)
+
+    def ordered_rows(self):
+        """ring slots in chronological order"""
+        return np.arange(self.head - self.count, self.head) % self.depth
+
+    async def init(self):
+        pass
+
+    async def new_historized_node(self, node_id, period, count=0):
+        #the historized tags are fixed when the ring is created
+        if node_id not in self.columns:
+            self._logger.warning("Node {} is not part of the OPC history ring and will not be historized".format(node_id))
+
+    async def save_node_value(self, node_id, datavalue):
+        #the ring is only written a whole timestep at a time, by record
+        pass
+
+    async def read_node_history(self, node_id, start, end, nb_values):
+        cont = None
+        column = self.columns.get(node_id)
+        if column is None:
+            self._logger.warning("Error attempt to read history for a node which is not historized")
+            return [], cont
+        epoch = _to_ns(ua.get_win_epoch())
+        start = epoch if start is None else _to_ns(start)
+        end = epoch if end is None else _to_ns(end)
+        rows = self.ordered_rows()
+        times = self.times[rows]
+        #the requested range as [lower, upper] bounds (None for open), found by bisection as
+        #timestamps are recorded in order
+        reverse = False
+        lower = upper = None
+        if start == epoch:
+            reverse = True
+            upper = None if end == epoch else end
+        elif self._reverse_continuations.pop((node_id, start), False):
+            #next page of a read without a start time: from the continuation point backwards
+            reverse = True
+            upper = start
+        elif end == epoch:
+            lower = start
+        elif start > end:
+            reverse = True
+            lower, upper = end, start
+        else:
+            lower, upper = start, end
+        first = 0 if lower is None else np.searchsorted(times, lower, side='left')
+        last = len(rows) if upper is None else np.searchsorted(times, upper, side='right')
+        rows = rows[first:last]
+        if reverse:
+            rows = rows[::-1]
+        rows = rows[~np.isnan(self.values[rows, column])]
+
+        if nb_values and len(rows) > nb_values:
+            rows = rows[:nb_values]
+        if len(rows) > self.max_history_data_response_size:
+            cont = self.datetime_at(rows[self.max_history_data_response_size])
+            if reverse and lower is None:
+                self.remember_reverse_continuation(node_id, cont)
+            rows = rows[:self.max_history_data_response_size]
+
+        variant_type = self.variant_types[column]
+        cast = UA_VALUE_CASTS.get(variant_type, str)
+        results = []
+        timestamps = self.times[rows].view('datetime64[ns]').astype('datetime64[us]').tolist()
+        for value, timestamp in zip(self.values[rows, column].tolist(), timestamps):
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+            results.append(ua.DataValue(ua.Variant(cast(value), variant_type), SourceTimestamp=timestamp, ServerTimestamp=timestamp))
+        return results, cont
+
+    def datetime_at(self, row):
+        return _EPOCH + timedelta(microseconds=int(self.times[row]) // 1000)
+
+    def remember_reverse_continuation(self, node_id, cont, capacity=1000):
+        self._reverse_continuations[(node_id, _to_ns(cont))] = True
+        #continuation points of abandoned reads are dropped, oldest first
+        while len(self._reverse_continuations) > capacity:
+            self._reverse_continuations.popitem(last=False)
+
+    async def new_historized_event(self, source_id, evtypes, period, count=0):
+        raise ua.UaStatusCodeError(ua.StatusCodes.BadNotImplemented)
+
+    async def save_event(self, event):
+        pass
+
+    async def read_event_history(self, source_id, start, end, nb_values, evfilter):
+        return [], None
+
+    async def stop(self):
+        pass
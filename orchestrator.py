@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Runs a fleet of digital twins on one host, one worker process per twin
+
+EnergyPlus state is not thread safe and every twin owns one (EpManager), so each twin runs
+DigitalTwin + EpManager in its own spawned process, started in the twin's working directory
+(the EnergyPlus 'out' directory, dt_in.idf and the twin's log stay there, and the worker's
+stdout/stderr, including EnergyPlus console output, go to twin.out). Read-only inputs such as
+weather files and building models shared by several twins are read through the OS page cache;
+nothing is copied per twin beyond what EnergyPlus itself loads.
+
+Core limits: the usable cores (the process' affinity mask) are split into slots of
+--cores-per-twin cores; every twin is pinned to one slot and at most --max-workers twins
+(default one per slot) run at once, the remaining twins start as running ones finish. Realtime
+twins mostly sleep, so --max-workers above the slot count is allowed; slots are then shared
+round robin.
+
+Health: every worker sends a heartbeat with its timestep count, simulation time and how long
+its pacer still holds the current timestep back every --heartbeat-seconds from a background
+thread. The orchestrator reports per twin state (pending, starting, running, stalled, finished,
+failed), throughput in timesteps per second and simulation speed (simulated seconds per wall
+clock second) every --report-seconds. A twin is reported stalled when it sent no heartbeat for
+--stall-seconds, or made no timestep progress for --stall-seconds past the time its current
+timestep became due. Progress is judged against the twin's pacing this way: a realtime twin
+with 15 or 60 minute timesteps waits that long for every timestep without being stalled, and
+--stall-seconds only bounds how long a due timestep may take. Stalled twins are reported, not
+killed.
+
+usage: python orchestrator.py [options] working_directory [working_directory ...]
+"""
+import argparse
+import configparser
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from collections import deque, namedtuple
+import logging
+logger = logging.getLogger(__name__)
+
+#event is one of started, heartbeat, finished, failed; detail holds the error of a failed twin;
+#pacing_wait_seconds is how long the twin's pacer still holds the current timestep back
+Heartbeat = namedtuple('Heartbeat', ['twin', 'event', 'pid', 'timesteps', 'simulation_datetime', 'pacing_wait_seconds', 'detail'])
+
+TWIN_STATES = ('pending', 'starting', 'running', 'stalled', 'finished', 'failed')
+
+
+def available_cores():
+    """cores this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def core_slots(cores, cores_per_twin):
+    """splits cores into slots of cores_per_twin cores (a single slot of all cores if there are fewer)"""
+    cores_per_twin = max(int(cores_per_twin), 1)
+    slots = [cores[start:start + cores_per_twin] for start in range(0, len(cores) - cores_per_twin + 1, cores_per_twin)]
+    return slots or [list(cores)]
+
+
+def twin_identifier(working_directory):
+    """DigitalTwinIdentifier of the twin's config.ini, or the name of its working directory"""
+    config = configparser.ConfigParser()
+    config.read(os.path.join(working_directory, 'config.ini'))
+    return config.get('DEFAULT', 'DigitalTwinIdentifier', fallback='').strip() or os.path.basename(os.path.normpath(working_directory))
+
+
+def run_twin(twin, working_directory, start_datetime_string, cores, heartbeats, heartbeat_seconds):
+    """worker process body: runs one digital twin, reporting to the heartbeats queue"""
+    pid = os.getpid()
+    os.chdir(working_directory)
+    #all output of the twin, EnergyPlus' own console output included, goes to its working directory
+    output = os.open('twin.out', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.dup2(output, 1)
+    os.dup2(output, 2)
+    os.close(output)
+    #native thread pools (BLAS, OpenMP) would otherwise size themselves to the whole host
+    threads = str(len(cores))
+    for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[variable] = threads
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    logging.basicConfig(filename='ep_digital_twin.log', level=logging.INFO)
+    logger.info('Starting digital twin {} on cores {}...'.format(twin, cores))
+
+    epmgr = None
+    stop_beating = threading.Event()
+
+    def beat(event, detail=None):
+        timesteps = epmgr.timesteps_completed if epmgr is not None else 0
+        simulation_datetime = epmgr.simulation_datetime if epmgr is not None else None
+        paced_until = epmgr.paced_until if epmgr is not None else None
+        pacing_wait_seconds = max(paced_until - time.time(), 0.0) if paced_until is not None else 0.0
+        heartbeats.put(Heartbeat(twin, event, pid, timesteps, simulation_datetime, pacing_wait_seconds, detail))
+
+    def beat_periodically():
+        while not stop_beating.wait(heartbeat_seconds):
+            beat('heartbeat')
+
+    beat('started')
+    heart = threading.Thread(target=beat_periodically, name='heartbeat', daemon=True)
+    heart.start()
+    dt = None
+    try:
+        from digital_twin import DigitalTwin
+        dt = DigitalTwin(working_directory, start_datetime_string)
+        #import delayed until DigitalTwin has put the configured EnergyPlus directory on the path
+        import simulator.ep_manager as epm
+        epmgr = epm.EpManager(dt)
+        epmgr.invoke_simulation()
+    except BaseException as error:
+        logger.exception('Digital twin {} failed'.format(twin))
+        stop_beating.set()
+        detail = str(error) if not isinstance(error, SystemExit) else 'exited with {}'.format(error.code)
+        beat('failed', detail or traceback.format_exc(limit=1))
+        raise
+    finally:
+        stop_beating.set()
+        if dt is not None:
+            dt.close()
+    beat('finished')
+
+
+class TwinHealth:
+    """what the orchestrator knows about one twin, updated from its heartbeats"""
+    def __init__(self, twin, working_directory):
+        self.twin = twin
+        self.working_directory = working_directory
+        self.state = 'pending'
+        self.process = None
+        self.cores = ()
+        self.pid = None
+        self.detail = None
+        self.started = None
+        self.ended = None
+        self.last_heartbeat = None
+        self.last_progress = None
+        #when the timestep the twin's pacer holds back becomes due
+        self.paced_until = None
+        self.timesteps = 0
+        self.first_simulation_datetime = None
+        self.simulation_datetime = None
+        #timesteps and wall clock time at the previous report, for the current rate
+        self.reported_timesteps = 0
+        self.reported_at = None
+
+    def update(self, heartbeat, now):
+        self.pid = heartbeat.pid
+        self.last_heartbeat = now
+        if heartbeat.timesteps != self.timesteps:
+            self.last_progress = now
+        if heartbeat.pacing_wait_seconds > 0:
+            self.paced_until = now + heartbeat.pacing_wait_seconds
+        self.timesteps = heartbeat.timesteps
+        if heartbeat.simulation_datetime is not None:
+            if self.first_simulation_datetime is None:
+                self.first_simulation_datetime = heartbeat.simulation_datetime
+            self.simulation_datetime = heartbeat.simulation_datetime
+        if heartbeat.event == 'failed':
+            self.state = 'failed'
+            self.detail = heartbeat.detail
+        elif heartbeat.event == 'finished':
+            self.state = 'finished'
+        elif self.state in ('starting', 'stalled'):
+            self.state = 'running'
+
+    def check_stall(self, now, stall_seconds):
+        if self.state not in ('running', 'stalled') or stall_seconds <= 0:
+            return
+        #a twin waiting for its pacer is on schedule; progress is due from when its timestep is
+        progress_due = max(self.last_progress or self.started, self.paced_until or self.started)
+        last_sign_of_life = min(self.last_heartbeat or self.started, progress_due)
+        self.state = 'stalled' if now - last_sign_of_life > stall_seconds else 'running'
+
+    def elapsed(self, now):
+        if self.started is None:
+            return 0.0
+        return (self.ended or now) - self.started
+
+    def throughput(self, now):
+        """average timesteps per wall clock second since the twin was started"""
+        elapsed = self.elapsed(now)
+        return self.timesteps / elapsed if elapsed > 0 else 0.0
+
+    def current_rate(self, now):
+        """timesteps per wall clock second since the previous report"""
+        if self.reported_at is None or now <= self.reported_at:
+            return self.throughput(now)
+        return (self.timesteps - self.reported_timesteps) / (now - self.reported_at)
+
+    def speed(self, now):
+        """simulated seconds per wall clock second since the first timestep"""
+        elapsed = self.elapsed(now)
+        if self.first_simulation_datetime is None or elapsed <= 0:
+            return 0.0
+        return (self.simulation_datetime - self.first_simulation_datetime).total_seconds() / elapsed
+
+    def summary(self, now):
+        line = '{:<20} {:<9} pid {:<7} cores {:<10} timesteps {:>8}  {:8.2f}/s (avg {:8.2f}/s)  speed {:8.1f}x  at {}'.format(
+            self.twin, self.state, self.pid or '-', ','.join(map(str, self.cores)) or '-', self.timesteps,
+            self.current_rate(now), self.throughput(now), self.speed(now), self.simulation_datetime or '-')
+        if self.detail:
+            line += '  ({})'.format(self.detail)
+        return line
+
+
+class Orchestrator:
+    def __init__(self, working_directories, start_datetime_string=None, max_workers=None, cores_per_twin=1,
+                 heartbeat_seconds=5.0, report_seconds=60.0, stall_seconds=900.0):
+        self.start_datetime_string = start_datetime_string
+        self.slots = core_slots(available_cores(), cores_per_twin)
+        self.max_workers = max(int(max_workers or len(self.slots)), 1)
+        self.heartbeat_seconds = heartbeat_seconds
+        self.report_seconds = report_seconds
+        self.stall_seconds = stall_seconds
+        self.twins = []
+        names = set()
+        for working_directory in working_directories:
+            working_directory = os.path.abspath(working_directory)
+            twin = twin_identifier(working_directory)
+            if twin in names:
+                twin = '{}@{}'.format(twin, working_directory)
+            names.add(twin)
+            self.twins.append(TwinHealth(twin, working_directory))
+        #spawned rather than forked workers: EnergyPlus (and the OPC server threads of a twin)
+        #must not inherit state from the orchestrator
+        self.context = multiprocessing.get_context('spawn')
+        self.heartbeats = self.context.Queue()
+        self.free_slots = deque(range(len(self.slots)))
+        logger.info("Orchestrating {} twins, at most {} at once, {} core slots of {}".format(
+            len(self.twins), self.max_workers, len(self.slots), self.slots))
+
+    def start_twin(self, health, slot_index):
+        health.cores = tuple(self.slots[slot_index % len(self.slots)])
+        health.process = self.context.Process(
+            target=run_twin, name='twin-{}'.format(health.twin),
+            args=(health.twin, health.working_directory, self.start_datetime_string, health.cores,
+                  self.heartbeats, self.heartbeat_seconds))
+        health.process.slot_index = slot_index
+        health.state = 'starting'
+        health.started = health.reported_at = time.monotonic()
+        health.process.start()
+        health.pid = health.process.pid
+        logger.info("Started twin {} ({}) as pid {} on cores {}".format(health.twin, health.working_directory, health.pid, health.cores))
+
+    def drain_heartbeats(self, timeout):
+        by_name = {health.twin: health for health in self.twins}
+        try:
+            heartbeat = self.heartbeats.get(timeout=timeout)
+            while True:
+                by_name[heartbeat.twin].update(heartbeat, time.monotonic())
+                heartbeat = self.heartbeats.get_nowait()
+        except queue.Empty:
+            pass
+
+    def reap(self, health):
+        """records the end of a twin whose process exited, returning its core slot"""
+        process = health.process
+        health.ended = time.monotonic()
+        if process.exitcode != 0 and health.state != 'failed':
+            health.state = 'failed'
+            health.detail = 'exit code {}'.format(process.exitcode)
+        elif process.exitcode == 0 and health.state != 'failed':
+            health.state = 'finished'
+        self.free_slots.append(process.slot_index)
+        logger.info("Twin {} {} after {:.0f}s, {} timesteps".format(health.twin, health.state, health.elapsed(health.ended), health.timesteps))
+        health.process = None
+
+    def report(self):
+        now = time.monotonic()
+        lines = ['Digital twin fleet: ' + ', '.join('{} {}'.format(sum(health.state == state for health in self.twins), state)
+                                                    for state in TWIN_STATES)]
+        lines += [health.summary(now) for health in self.twins]
+        logger.info('\n'.join(lines))
+        print('\n'.join(lines), flush=True)
+        for health in self.twins:
+            health.reported_timesteps = health.timesteps
+            health.reported_at = now
+
+    def run(self):
+        """runs every twin to completion; returns True if all of them finished"""
+        pending = deque(self.twins)
+        running = []
+        next_report = time.monotonic() + self.report_seconds
+        try:
+            while pending or running:
+                while pending and len(running) < self.max_workers:
+                    #with more workers than slots, slots are shared round robin
+                    slot_index = self.free_slots.popleft() if self.free_slots else len(running)
+                    health = pending.popleft()
+                    self.start_twin(health, slot_index)
+                    running.append(health)
+                self.drain_heartbeats(min(self.heartbeat_seconds, self.report_seconds))
+                now = time.monotonic()
+                for health in list(running):
+                    if not health.process.is_alive():
+                        health.process.join()
+                        #heartbeats sent right before the exit may still be queued
+                        self.drain_heartbeats(0)
+                        self.reap(health)
+                        running.remove(health)
+                    else:
+                        health.check_stall(now, self.stall_seconds)
+                if now >= next_report:
+                    self.report()
+                    next_report = now + self.report_seconds
+        except KeyboardInterrupt:
+            logger.warning("Interrupted, terminating {} running twins".format(len(running)))
+            for health in running:
+                health.process.terminate()
+            for health in running:
+                health.process.join()
+                self.reap(health)
+        self.report()
+        return all(health.state == 'finished' for health in self.twins)
+
+
+"""
+Entry point for code execution
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Runs one digital twin per working directory, each in its own process')
+    parser.add_argument('working_directories', nargs='+', help='twin working directories, each with its config.ini')
+    parser.add_argument('--start', default=None, help='simulation start datetime passed to every twin (default now)')
+    parser.add_argument('--max-workers', type=int, default=None, help='twins running at once (default one per core slot)')
+    parser.add_argument('--cores-per-twin', type=int, default=1, help='cores each twin is pinned to')
+    parser.add_argument('--heartbeat-seconds', type=float, default=5.0)
+    parser.add_argument('--report-seconds', type=float, default=60.0)
+    parser.add_argument('--stall-seconds', type=float, default=900.0,
+                        help='no heartbeat, or no progress once a timestep is due, for this long marks a twin stalled; 0 disables stall detection')
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='ep_orchestrator.log', level=logging.INFO)
+    orchestrator = Orchestrator(args.working_directories, args.start, args.max_workers, args.cores_per_twin,
+                                args.heartbeat_seconds, args.report_seconds, args.stall_seconds)
+    sys.exit(0 if orchestrator.run() else 1)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar file persistence for the digital twin (PersistenceType PARQUET or ARROW)
+
+Snapshots are buffered and written as one row group per [COLUMNAR] RowGroupTimesteps
+timesteps into a file per simulation day ({dt}_{YYYY-MM-DD}.parquet or .arrow), so
+offline replays are written at disk speed and can be read directly with pandas/pyarrow.
+    long - columns time, signal_id, value; signal_id is the sensor's position in the
+           sensors file, the names being listed in the file's 'signal_names' metadata
+    wide - a time column plus one float64 column per PersistenceName
+"""
+import atexit
+import json
+import os
+import numpy as np
+import pandas as pd
+import logging
+logger = logging.getLogger(__name__)
+
+LAYOUTS = ('long', 'wide')
+FILE_SUFFIXES = {'PARQUET': 'parquet', 'ARROW': 'arrow'}
+
+
+class ColumnarFilePersistence:
+    def __init__(self, config, sensor_store):
+        #pyarrow is only required when this backend is selected
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+        self.pa = pyarrow
+
+        self.sensor_store = sensor_store
+        self.dt_name = config.get('DEFAULT', 'DigitalTwinIdentifier')
+        self.file_format = config.get('DEFAULT', 'PersistenceType', fallback='PARQUET').strip().upper()
+        if self.file_format not in FILE_SUFFIXES:
+            self.file_format = 'PARQUET'
+        self.directory = config.get('COLUMNAR', 'OutputDirectory', fallback='output')
+        self.layout = config.get('COLUMNAR', 'Layout', fallback='long').strip().lower()
+        if self.layout not in LAYOUTS:
+            raise ValueError("Unsupported Layout {}, expected one of {}".format(self.layout, LAYOUTS))
+        self.compression = config.get('COLUMNAR', 'Compression', fallback='zstd').strip().lower() or None
+        if self.compression == 'none':
+            self.compression = None
+        self.row_group_timesteps = int(config.get('COLUMNAR', 'RowGroupTimesteps', fallback='1440'))
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.times = []
+        self.values = np.empty((self.row_group_timesteps, len(sensor_store)), dtype=np.float64)
+        self.current_day = None
+        self.writer = None
+        self.path = None
+        self.rows_written = 0
+        self.schema = self.make_schema()
+        atexit.register(self.close)
+
+    def make_schema(self, time_type=None):
+        pa = self.pa
+        time_type = time_type or pa.timestamp('us')
+        names = [str(name) for name in self.sensor_store.keys]
+        if self.layout == 'long':
+            fields = [pa.field('time', time_type), pa.field('signal_id', pa.int32()), pa.field('value', pa.float64())]
+        else:
+            fields = [pa.field('time', time_type)] + [pa.field(name, pa.float64()) for name in names]
+        metadata = {'digital_twin_id': self.dt_name, 'signal_names': json.dumps(names)}
+        return pa.schema(fields, metadata=metadata)
+
+    def open_writer(self, day):
+        pa = self.pa
+        suffix = FILE_SUFFIXES[self.file_format]
+        self.path = os.path.join(self.directory, "{}_{}.{}".format(self.dt_name, day.isoformat(), suffix))
+        if os.path.exists(self.path):
+            #a rerun of the same day must not silently append to (or clobber) earlier output
+            base, extension = os.path.splitext(self.path)
+            part = 1
+            while os.path.exists("{}_part{}{}".format(base, part, extension)):
+                part += 1
+            self.path = "{}_part{}{}".format(base, part, extension)
+        if self.file_format == 'PARQUET':
+            self.writer = pa.parquet.ParquetWriter(self.path, self.schema, compression=self.compression or 'none')
+        else:
+            options = pa.ipc.IpcWriteOptions(compression=self.compression)
+            self.writer = pa.ipc.new_file(self.path, self.schema, options=options)
+        self.current_day = day
+        logger.info("Writing {} persistence to {}".format(self.file_format.lower(), self.path))
+
+    def close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def build_table(self):
+        pa = self.pa
+        count = len(self.times)
+        times = pd.DatetimeIndex(self.times)
+        values = self.values[:count]
+        if self.layout == 'long':
+            width = values.shape[1]
+            valid = ~np.isnan(values).ravel()
+            time_column = pa.array(times.repeat(width)[valid])
+            columns = [time_column,
+                       pa.array(np.tile(np.arange(width, dtype=np.int32), count)[valid]),
+                       pa.array(values.ravel()[valid])]
+        else:
+            time_column = pa.array(times)
+            columns = [time_column] + [pa.array(values[:, idx]) for idx in range(values.shape[1])]
+        if time_column.type != self.schema.field('time').type:
+            #the time type (e.g. timezone aware timestamps) follows the data of the first file
+            self.schema = self.make_schema(time_column.type)
+        return pa.Table.from_arrays(columns, schema=self.schema)
+
+    def flush(self):
+        """writes the buffered timesteps as one row group into the current day's file"""
+        if not self.times:
+            return
+        table = self.build_table()
+        if self.writer is None:
+            self.open_writer(self.current_day)
+        if self.file_format == 'PARQUET':
+            self.writer.write_table(table, row_group_size=max(table.num_rows, 1))
+        else:
+            for batch in table.to_batches(max_chunksize=max(table.num_rows, 1)):
+                self.writer.write_batch(batch)
+        self.rows_written += table.num_rows
+        self.times = []
+
+    def persist(self, timestamp, sensor_values=None):
+        if sensor_values is None:
+            sensor_values = self.sensor_store.values
+        day = pd.Timestamp(timestamp).date()
+        if day != self.current_day:
+            #roll over to a new file per simulation day
+            self.flush()
+            self.close_writer()
+            self.current_day = day
+        self.values[len(self.times)] = sensor_values
+        self.times.append(timestamp)
+        if len(self.times) >= self.row_group_timesteps:
+            self.flush()
+
+    def persist_batch(self, rows):
+        for timestamp, sensor_values in rows:
+            self.persist(timestamp, sensor_values)
+
+    def close(self):
+        """writes out buffered timesteps and finalizes the current file"""
+        self.flush()
+        self.close_writer()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Shared PostgreSQL connections for the persistence backends
+
+One ConnectionManager exists per database (host, port, database, user) and process, so
+several twins in one process, or a write-behind thread next to the simulation thread,
+draw from the same small pool. Connections idle for longer than HealthCheckSeconds, or
+idle since a connection failure, are checked with SELECT 1 before being handed out.
+After a failure no new connection is attempted for an exponentially growing backoff
+(ReconnectBackoffSeconds doubling up to [PERSISTENCE] ReconnectIntervalSeconds); in
+that window connection() fails fast with OperationalError so callers can journal.
+"""
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+import logging
+logger = logging.getLogger(__name__)
+
+#errors meaning the database is unreachable (as opposed to a rejected statement)
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class ConnectionManager:
+    _managers = {}
+    _managers_lock = threading.Lock()
+
+    @classmethod
+    def for_config(cls, config):
+        """the process wide manager for the database configured in [DATABASE]"""
+        params = dict(host=config.get('DATABASE', 'DatabaseHost'),
+                      port=config.get('DATABASE', 'DatabasePort'),
+                      database=config.get('DATABASE', 'DatabaseName'),
+                      user=config.get('DATABASE', 'DatabaseUser'),
+                      password=config.get('DATABASE', 'DatabasePass'))
+        key = (params['host'], params['port'], params['database'], params['user'])
+        with cls._managers_lock:
+            manager = cls._managers.get(key)
+            if manager is None:
+                manager = cls(params,
+                              pool_size=int(config.get('DATABASE', 'PoolSize', fallback='1')),
+                              max_connections=int(config.get('DATABASE', 'PoolMaxConnections', fallback='4')),
+                              health_check_interval=float(config.get('DATABASE', 'HealthCheckSeconds', fallback='60')),
+                              backoff_initial=float(config.get('DATABASE', 'ReconnectBackoffSeconds', fallback='1')),
+                              backoff_max=float(config.get('PERSISTENCE', 'ReconnectIntervalSeconds', fallback='30')))
+                cls._managers[key] = manager
+            return manager
+
+    def __init__(self, params, pool_size=1, max_connections=4, health_check_interval=60.0,
+                 backoff_initial=1.0, backoff_max=30.0):
+        self.params = dict(params, connect_timeout=10)
+        self.pool_size = pool_size
+        self.max_connections = max(max_connections, pool_size, 1)
+        self.health_check_interval = health_check_interval
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.pool = None
+        self.lock = threading.Lock()
+        #getconn raises once the pool is exhausted, so callers queue here instead
+        self.slots = threading.BoundedSemaphore(self.max_connections)
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.last_failure = 0.0
+        #per connection bookkeeping that disappears with the connection
+        self.last_used = weakref.WeakKeyDictionary()
+        self.prepared = weakref.WeakKeyDictionary()
+
+    def available(self):
+        """False while backing off after a connection failure"""
+        return time.monotonic() >= self.next_attempt
+
+    def _record_failure(self, error):
+        self.failures += 1
+        delay = min(self.backoff_initial * 2 ** (self.failures - 1), self.backoff_max)
+        now = time.monotonic()
+        self.last_failure = now
+        self.next_attempt = now + delay
+        detail = str(error).strip().splitlines()[0] if str(error).strip() else type(error).__name__
+        logger.error("PostgreSQL connection failure #{} ({}), next attempt in {:.0f}s".format(self.failures, detail, delay))
+
+    def _record_success(self):
+        if self.failures:
+            logger.info("PostgreSQL connection restored after {} failures".format(self.failures))
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    def _healthy(self, conn):
+        last_used = self.last_used.get(conn, 0.0)
+        if conn.closed:
+            return False
+        if last_used > self.last_failure and time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+            conn.rollback()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def _acquire(self):
+        with self.lock:
+            if not self.available():
+                raise psycopg2.OperationalError("database unavailable, reconnect in {:.0f}s".format(self.next_attempt - time.monotonic()))
+            try:
+                if self.pool is None:
+                    self.pool = ThreadedConnectionPool(self.pool_size, self.max_connections, **self.params)
+                #discard pooled connections that did not survive an outage or a long idle period
+                for _ in range(self.max_connections + 1):
+                    conn = self.pool.getconn()
+                    if self._healthy(conn):
+                        return conn
+                    self.pool.putconn(conn, close=True)
+                raise psycopg2.OperationalError("no healthy connection available")
+            except CONNECTION_ERRORS as e:
+                self._record_failure(e)
+                raise
+
+    def _release(self, conn, broken=False):
+        with self.lock:
+            self.last_used[conn] = time.monotonic()
+            if self.pool is not None and not self.pool.closed:
+                self.pool.putconn(conn, close=broken or bool(conn.closed))
+
+    @contextmanager
+    def connection(self):
+        """
+        a pooled connection for the duration of the block; a connection error inside the block
+        discards the connection and starts the reconnect backoff before being re-raised
+        """
+        self.slots.acquire()
+        try:
+            conn = self._acquire()
+            try:
+                yield conn
+            except CONNECTION_ERRORS as e:
+                self._release(conn, broken=True)
+                with self.lock:
+                    self._record_failure(e)
+                raise
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                self._release(conn)
+                raise
+            else:
+                self._release(conn)
+                with self.lock:
+                    self._record_success()
+        finally:
+            self.slots.release()
+
+    def prepare(self, cur, name, statement):
+        """
+        PREPAREs statement (with $1.. placeholders) as name on the cursor's connection, once per
+        connection; callers then run "EXECUTE name (%s, ...)"
+        """
+        prepared = self.prepared.setdefault(cur.connection, {})
+        if prepared.get(name) != statement:
+            if name in prepared:
+                cur.execute("DEALLOCATE {};".format(name))
+            cur.execute("PREPARE {} AS {}".format(name, statement))
+            prepared[name] = statement
+        return name
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None and not self.pool.closed:
+                self.pool.closeall()
+            self.pool = None
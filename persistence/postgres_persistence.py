@@ -8,13 +8,28 @@ import psycopg2
 # import the error handling libraries for psycopg2
 from psycopg2 import OperationalError, errorcodes, errors
 import datetime
+import io
+import struct
+import time
+from zoneinfo import ZoneInfo
+import numpy as np
 import pandas as pd
+from persistence.spill_journal import SpillJournal
+from persistence.connection_manager import ConnectionManager, CONNECTION_ERRORS
 import logging
 logger = logging.getLogger(__name__)
 
+#binary COPY framing: signature, flags and header extension length, and the file trailer
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\0' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+PG_EPOCH = datetime.datetime(2000, 1, 1)
+PG_EPOCH_UTC = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+#column types that are written with binary COPY, anything else falls back to text COPY
+BINARY_FLOAT_TYPES = {'float4': '>f4', 'float8': '>f8'}
+
 class PostgresPersistence:
-    def __init__(self, config, sensors_df):
-        self.sensors_df = sensors_df
+    def __init__(self, config, sensor_store):
+        self.sensor_store = sensor_store
         self.dbname = config.get('DATABASE', 'DatabaseName')       
         self.dbhost = config.get('DATABASE', 'DatabaseHost')
         self.dbport = config.get('DATABASE', 'DatabasePort')
@@ -22,50 +37,71 @@ class PostgresPersistence:
         self.dbpass = config.get('DATABASE', 'DatabasePass')
         self.dt_name = config.get('DEFAULT', 'DigitalTwinIdentifier')
         self.successfully_initialized = False
-        
+        #rows that cannot be written while the database is unreachable are journaled locally
+        #and replayed in bulk once the connection manager can reconnect
+        self.journal = SpillJournal.for_store(config, self.dt_name + '_wide', sensor_store)
+        #rows are buffered and written with one COPY per CopyBatchSize rows, or once the oldest
+        #buffered row has waited CopyFlushIntervalSeconds; close() and flush() write out whatever
+        #is buffered. A realtime twin writes every timestep, its rows are minutes apart anyway
+        self.copy_batch_size = int(config.get('DATABASE', 'CopyBatchSize', fallback='60'))
+        self.copy_flush_interval = float(config.get('DATABASE', 'CopyFlushIntervalSeconds', fallback='5'))
+        if config.get('DEFAULT', 'PacingMode', fallback='realtime').strip().lower() == 'realtime':
+            self.copy_batch_size = 1
+        self.buffer = []
+        self.buffer_started = None
+        self._prepared_keys = None
+        #pooled connections shared with other backends on the same database
+        self.db = ConnectionManager.for_config(config)
         
         try:
-            self.conn = psycopg2.connect(
-                host=self.dbhost,
-                port=self.dbport,
-                database=self.dbname,
-                user=self.dbuser,
-                password=self.dbpass)
+            with self.db.connection() as conn:
+                self.setup(conn)
         except psycopg2.Error as e:
             print ("Unable to connect!")
             print (e.pgerror)
             print (e.diag.message_detail)
             return
         
-        self.config_output_table()
+    def setup(self, conn):
+        self.config_output_table(conn)
+        self.prepare_statements(conn)
         
-    def config_columns(self):
+    def config_columns(self, conn):
         
-        for idx in self.sensors_df.index:
-            col_name = self.sensors_df['PersistenceName'][idx]
-            col_type = self.sensors_df['DataType'][idx]
-            sql_stmt = "ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {} NULL;".format(self.dt_name, col_name, col_type)
-            cur = self.conn.cursor()
-            try:
-                cur.execute(sql_stmt)
-                cur.close()
-                self.conn.commit()
-            except psycopg2.Error as e:
-                print ("Unable to create table!")
-                print (e.pgerror)
-                print (e.diag.message_detail)
-                return
+        sensor_metadata = self.sensor_store.metadata
+        #every missing column is added by a single ALTER TABLE, committed once
+        add_columns = []
+        for idx in sensor_metadata.index:
+            col_name = sensor_metadata['PersistenceName'][idx]
+            col_type = sensor_metadata['DataType'][idx]
+            add_columns.append("ADD COLUMN IF NOT EXISTS {} {} NULL".format(col_name, col_type))
+        if not add_columns:
+            #no sensors, 'ALTER TABLE x ;' would not parse
+            self.successfully_initialized = True
+            return
+        sql_stmt = "ALTER TABLE {} {};".format(self.dt_name, ", ".join(add_columns))
+        cur = conn.cursor()
+        try:
+            cur.execute(sql_stmt)
+            cur.close()
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            print ("Unable to create table!")
+            print (e.pgerror)
+            print (e.diag.message_detail)
+            return
             
         self.successfully_initialized = True
                 
-    def make_table(self):
-        cur = self.conn.cursor()
+    def make_table(self, conn):
+        cur = conn.cursor()
         try:
             #sql_stmt = "CREATE TABLE {} (key_id serial PRIMARY KEY, id varchar(20) NOT NULL, time timestamp null);".format(self.dt_name)
             sql_stmt = "CREATE TABLE {} (time TIMESTAMPTZ PRIMARY KEY);".format(self.dt_name)
             cur.execute(sql_stmt)
             cur.close()
-            self.conn.commit()
+            conn.commit()
         except psycopg2.Error as e:
             print ("Unable to create table!")
             print (e.pgerror)
@@ -74,7 +110,7 @@ class PostgresPersistence:
         print("Table'{}' created.".format(self.dt_name))
                    
             
-    def config_output_table(self):
+    def config_output_table(self, conn):
         '''
         Confirms that table representing the digital twin instance exists and that
         all sensors to be read have associated columns and meta data
@@ -88,16 +124,16 @@ class PostgresPersistence:
         None.
 
         '''
-        cur = self.conn.cursor()
+        cur = conn.cursor()
         try:
             cur.execute("select exists(select * from information_schema.tables where table_name='{}');".format(self.dt_name))
             table_exists = cur.fetchone()[0]
             cur.close()
             if table_exists:
-                self.config_columns()
+                self.config_columns(conn)
             else:
-                self.make_table()
-                self.config_columns()
+                self.make_table(conn)
+                self.config_columns(conn)
         except psycopg2.Error as e:
             print ("Unable to create table!")
             print (e.pgerror)
@@ -111,27 +147,228 @@ class PostgresPersistence:
         new_id = current_time.strftime("WO%Y%m%d%H%M%S")+millis
         return new_id
         
-    def persist(self, timestamp):
+    def prepare_statements(self, conn):
+        '''
+        builds the COPY statement and the per column encoding once for the current sensor set,
+        from the column types actually in the table. Binary COPY is used when every sensor
+        column is float4/float8, text COPY otherwise
+        '''
+        columns = ["time"] + list(self.sensor_store.keys)
+        cur = conn.cursor()
+        cur.execute("select column_name, udt_name from information_schema.columns where table_name=%s;", (self.dt_name,))
+        column_types = {name: udt for name, udt in cur.fetchall()}
+        cur.execute("SHOW TimeZone;")
+        session_timezone = cur.fetchone()[0]
+        cur.close()
+        conn.commit()
+
+        self.time_type = column_types.get("time", "timestamptz")
+        self.sensor_types = [column_types.get(str(name).lower(), "float8") for name in self.sensor_store.keys]
+        try:
+            #naive simulation timestamps are interpreted in the session time zone, as with a text insert
+            self.session_tz = ZoneInfo(session_timezone)
+        except (KeyError, ValueError):
+            self.session_tz = None
+        self.binary_copy = self.session_tz is not None and all(udt in BINARY_FLOAT_TYPES for udt in self.sensor_types)
+        if self.binary_copy:
+            fields = [('nfields', '>i2'), ('time_len', '>i4'), ('time', '>i8')]
+            for idx, udt in enumerate(self.sensor_types):
+                fields.extend([('len{}'.format(idx), '>i4'), ('val{}'.format(idx), BINARY_FLOAT_TYPES[udt])])
+            self.tuple_dtype = np.dtype(fields)
+            self.copy_sql = "COPY {} ({}) FROM STDIN WITH (FORMAT binary);".format(self.dt_name, ",".join(columns))
+        else:
+            logger.info("Table {} has non float sensor columns or an unknown session time zone, using text COPY".format(self.dt_name))
+            self.copy_sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv);".format(self.dt_name, ",".join(columns))
+        #prepared per connection, for a batch that COPY rejects (e.g. a timestamp that is already present)
+        self.insert_sql = "INSERT INTO {} ({}) VALUES({}) ON CONFLICT (time) DO NOTHING".format(
+            self.dt_name, ",".join(columns), ",".join("${}".format(idx + 1) for idx in range(len(columns))))
+        self.insert_params = "({})".format(",".join(["%s"] * len(columns)))
+        self._prepared_keys = self.sensor_store.keys
+
+    def pg_time(self, timestamp):
+        '''
+        microseconds since 2000-01-01 as binary COPY expects for the time column
+        '''
+        timestamp = pd.Timestamp(timestamp).to_pydatetime()
+        if self.time_type == "timestamptz":
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=self.session_tz)
+            return (timestamp - PG_EPOCH_UTC) // datetime.timedelta(microseconds=1)
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(self.session_tz).replace(tzinfo=None)
+        return (timestamp - PG_EPOCH) // datetime.timedelta(microseconds=1)
+
+    def encode_binary(self, rows):
+        tuples = np.empty(len(rows), dtype=self.tuple_dtype)
+        values = np.vstack([sensor_values for _, sensor_values in rows])
+        tuples['nfields'] = 1 + values.shape[1]
+        tuples['time_len'] = 8
+        tuples['time'] = [self.pg_time(timestamp) for timestamp, _ in rows]
+        for idx, udt in enumerate(self.sensor_types):
+            tuples['len{}'.format(idx)] = 4 if udt == 'float4' else 8
+            tuples['val{}'.format(idx)] = values[:, idx]
+        return PGCOPY_HEADER + tuples.tobytes() + PGCOPY_TRAILER
+
+    def encode_text(self, rows):
+        lines = []
+        for timestamp, sensor_values in rows:
+            fields = [pd.Timestamp(timestamp).isoformat()]
+            for value, udt in zip(sensor_values.tolist(), self.sensor_types):
+                if value != value:
+                    #NaN is kept for float columns and stored as NULL elsewhere
+                    fields.append('NaN' if udt in BINARY_FLOAT_TYPES or udt == 'numeric' else '')
+                elif udt == 'bool':
+                    fields.append('t' if value else 'f')
+                elif udt in ('int2', 'int4', 'int8'):
+                    fields.append(str(int(round(value))))
+                else:
+                    fields.append(repr(value))
+            lines.append(",".join(fields))
+        return ("\n".join(lines) + "\n").encode('utf-8')
+
+    def copy_rows(self, conn, rows):
+        '''
+        writes (timestamp, sensor_values) rows with one COPY in one transaction
+        '''
+        if self.sensor_store.keys is not self._prepared_keys:
+            self.config_columns(conn)
+            self.prepare_statements(conn)
+        payload = self.encode_binary(rows) if self.binary_copy else self.encode_text(rows)
+        try:
+            with conn.cursor() as cur:
+                cur.copy_expert(self.copy_sql, io.BytesIO(payload))
+            conn.commit()
+        except CONNECTION_ERRORS:
+            raise
+        except psycopg2.IntegrityError:
+            #COPY cannot skip conflicting rows, so the batch is inserted row by row instead
+            conn.rollback()
+            self.insert_rows(conn, rows)
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+
+    def insert_rows(self, conn, rows):
+        '''
+        inserts (timestamp, sensor_values) rows in one transaction, skipping existing timestamps
+        '''
         #varchar_id = self.generate_varchar_id()
-        columns_for_insert = "time"
-        val_holders = "%s"
-        
         #values_for_insert = [varchar_id,timestamp]
-        values_for_insert = [timestamp]
-        for idx in self.sensors_df.index:
-            col_name = self.sensors_df['PersistenceName'][idx]
-            columns_for_insert = columns_for_insert+","+col_name
-            values_for_insert.append(self.sensors_df['current_val'][idx])
-            val_holders = val_holders+",%s"
-        cur = self.conn.cursor()
+        values_for_insert = [[timestamp] + sensor_values.tolist() for timestamp, sensor_values in rows]
         try:
-            sql_stmt = "INSERT INTO {} ({}) VALUES({});".format(self.dt_name, columns_for_insert, val_holders)
-            cur.execute(sql_stmt, values_for_insert)
-            cur.close()
-            self.conn.commit()
+            with conn.cursor() as cur:
+                statement = self.db.prepare(cur, "{}_insert_row".format(self.dt_name), self.insert_sql)
+                cur.executemany("EXECUTE {} {};".format(statement, self.insert_params), values_for_insert)
+            conn.commit()
+        except CONNECTION_ERRORS:
+            raise
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+
+    def replay_journal(self, conn):
+        '''
+        writes all journaled rows back in one transaction; the journal is only cleared
+        once that transaction has committed
+        '''
+        rows = self.journal.rows()
+        self.copy_rows(conn, rows)
+        self.journal.clear()
+        logger.info("Replayed {} journaled rows into {}".format(len(rows), self.dt_name))
+
+    def flush(self):
+        '''
+        writes all buffered rows; while the database is unreachable they go to the journal
+        '''
+        rows = self.buffer
+        self.buffer = []
+        self.buffer_started = None
+        if not rows:
+            return
+        if not self.db.available():
+            self.journal.append_many(rows)
+            return
+        try:
+            with self.db.connection() as conn:
+                if self._prepared_keys is None:
+                    #the database was unreachable when this backend was created
+                    self.setup(conn)
+                if len(self.journal):
+                    self.replay_journal(conn)
+                self.copy_rows(conn, rows)
+        except CONNECTION_ERRORS as e:
+            logger.error("Lost PostgreSQL connection, journaling rows to {}: {}".format(self.journal.path, e))
+            self.journal.append_many(rows)
         except psycopg2.Error as e:
-            print ("Unable to persist for time{}!".format(timestamp))
+            print ("Unable to persist {} rows from time {}!".format(len(rows), rows[0][0]))
             print (e.pgerror)
             print (e.diag.message_detail)
-            return        
-            
\ No newline at end of file
+            return
+
+    def persist(self, timestamp, sensor_values=None):
+        if sensor_values is None:
+            sensor_values = self.sensor_store.snapshot()
+        if not self.buffer:
+            self.buffer_started = time.monotonic()
+        self.buffer.append((timestamp, sensor_values))
+        if (len(self.buffer) >= self.copy_batch_size
+                or time.monotonic() - self.buffer_started >= self.copy_flush_interval):
+            self.flush()
+
+    def persist_batch(self, rows):
+        self.buffer.extend(rows)
+        self.flush()
+
+    def close(self):
+        self.flush()
+        if len(self.journal) and self.db.available():
+            try:
+                with self.db.connection() as conn:
+                    self.replay_journal(conn)
+            except CONNECTION_ERRORS as e:
+                logger.error("{} rows left in journal {}: {}".format(len(self.journal), self.journal.path, e))
+        self.journal.close()
+
+
+if __name__ == "__main__":
+    # Benchmark: rows/sec for 500 sensors at 1-minute timesteps against the database in
+    # the given config.ini, comparing a single-row INSERT per timestep with buffered binary COPY
+    # usage: python -m persistence.postgres_persistence <config.ini> [timesteps]
+    import sys
+    import configparser
+    from simulator.signal_store import SignalStore
+
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1])
+    timesteps = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+    config.set('DEFAULT', 'DigitalTwinIdentifier', 'wide_benchmark')
+    #a backfill, realtime pacing would write every row on its own
+    config.set('DEFAULT', 'PacingMode', 'fast')
+    n_sensors = 500
+    store = SignalStore(pd.DataFrame({'PersistenceName': ['bench_sensor_{}'.format(i) for i in range(n_sensors)],
+                                      'DataType': 'REAL'}), 'PersistenceName')
+    agent = PostgresPersistence(config, store)
+    rng = np.random.default_rng(0)
+    start_time = datetime.datetime(2000, 1, 1)
+
+    def run(write):
+        with agent.db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM {};".format(agent.dt_name))
+            conn.commit()
+            cur.close()
+        began = time.perf_counter()
+        for step in range(timesteps):
+            store.write(slice(None), rng.random(n_sensors))
+            write(start_time + datetime.timedelta(minutes=step), store.snapshot())
+        agent.flush()
+        return timesteps / (time.perf_counter() - began)
+
+    def insert_row(timestamp, values):
+        with agent.db.connection() as conn:
+            agent.insert_rows(conn, [(timestamp, values)])
+
+    print("{} sensors x {} one-minute timesteps, COPY batches of {}".format(n_sensors, timesteps, agent.copy_batch_size))
+    print("row INSERT:  {:10.0f} rows/s".format(run(lambda timestamp, values: insert_row(timestamp, values))))
+    print("binary COPY: {:10.0f} rows/s".format(run(agent.persist)))
+    agent.close()
@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+"""
+postgres_persistence_etv.py
+Entity-Timestamp-Value (ETV) persistence for ZEN Digital Twin
+Optimized for Seeq, TimescaleDB, and long-term scalability
+Author: Francis Doyle (updated 2025)
+"""
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+import numpy as np
+import pandas as pd
+import re
+import time
+import logging
+from typing import Dict
+from persistence.spill_journal import SpillJournal
+from persistence.connection_manager import ConnectionManager, CONNECTION_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# journaled snapshots written back per statement when the database returns
+REPLAY_CHUNK = 500
+# prepared once per pooled connection; one execution writes any number of measurements
+INSERT_MEASUREMENTS = """
+    INSERT INTO measurements (time, signal_id, value)
+    SELECT * FROM unnest($1::timestamptz[], $2::integer[], $3::double precision[])
+    ON CONFLICT (time, signal_id) DO UPDATE SET value = EXCLUDED.value
+"""
+
+
+class PostgresPersistenceETV:
+    def __init__(self, config, sensor_store):
+        self.sensor_store = sensor_store
+        self.config = config
+
+        # Database connection params
+        self.dbname = config.get('DATABASE', 'DatabaseName')
+        self.dbhost = config.get('DATABASE', 'DatabaseHost')
+        self.dbport = config.get('DATABASE', 'DatabasePort')
+        self.dbuser = config.get('DATABASE', 'DatabaseUser')
+        self.dbpass = config.get('DATABASE', 'DatabasePass')
+        self.dt_name = config.get('DEFAULT', 'DigitalTwinIdentifier')
+
+        # TimescaleDB options, only applied when the extension is installed in the database;
+        # an empty CompressAfter / RetentionPeriod / ContinuousAggregates disables that feature
+        self.timescale_enabled = config.get('DATABASE', 'TimescaleEnabled', fallback='false').strip().lower() == 'true'
+        self.chunk_interval = config.get('DATABASE', 'HypertableChunkInterval', fallback='7 days').strip()
+        self.compress_after = config.get('DATABASE', 'CompressAfter', fallback='7 days').strip()
+        self.retention_period = config.get('DATABASE', 'RetentionPeriod', fallback='').strip()
+        self.aggregate_intervals = [interval.strip() for interval in
+                                    config.get('DATABASE', 'ContinuousAggregates', fallback='15 minutes, 1 hour').split(',')
+                                    if interval.strip()]
+        self.hypertable = False
+        # (first, last) timestamp written by this run, for refreshing the continuous aggregates on close
+        self.persisted_range = None
+
+        # snapshots that could not be written during an outage are journaled locally and
+        # replayed in bulk, oldest first, once the database is reachable again
+        self.journal = SpillJournal.for_store(config, self.dt_name + '_etv', sensor_store)
+
+        # pooled connections shared with other backends on the same database
+        self.db = ConnectionManager.for_config(config)
+
+        # signal metadata is upserted and the signal_id per store slot cached once; it is
+        # only refreshed when the sensor store's signal set changes
+        self._cached_keys = None
+        self.slot_signal_ids = None
+        try:
+            with self.db.connection() as conn:
+                self._ensure_schema(conn)
+                self.refresh_signal_metadata(conn)
+            logger.info("Connected to PostgreSQL for ETV persistence")
+        except Exception as e:
+            logger.error(f"Failed to connect to PostgreSQL: {e}")
+            raise
+
+    def _ensure_schema(self, conn):
+        """Create signals metadata table and measurements table if not exist"""
+        cur = conn.cursor()
+
+        # 1. signals metadata table
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS signals (
+                id SERIAL PRIMARY KEY,
+                signal_key TEXT NOT NULL,
+                name TEXT,
+                description TEXT,
+                units TEXT,
+                data_type TEXT,
+                persistence_name TEXT,
+                sensor_name TEXT,
+                sensor_instance TEXT,
+                source_type TEXT DEFAULT 'digital_twin',
+                digital_twin_id TEXT NOT NULL,
+                created_at TIMESTAMPTZ DEFAULT NOW(),
+                updated_at TIMESTAMPTZ DEFAULT NOW(),
+                CONSTRAINT signals_twin_signal_key UNIQUE (digital_twin_id, signal_key)
+            );
+        """)
+        self._migrate_signal_key_constraint(cur)
+
+        # 2. measurements table (hypertable ready for TimescaleDB)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS measurements (
+                time TIMESTAMPTZ NOT NULL,
+                signal_id INTEGER NOT NULL REFERENCES signals(id) ON DELETE CASCADE,
+                value DOUBLE PRECISION,
+                PRIMARY KEY (time, signal_id)
+            );
+        """)
+
+        # 3. TimescaleDB hypertable with compression and retention, if enabled and available
+        if self.timescale_enabled:
+            self.hypertable = self._ensure_hypertable(cur)
+
+        # Index for fast queries by signal_key (a hypertable already gets its own time index)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_measurements_signal_id ON measurements(signal_id);")
+        if not self.hypertable:
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_measurements_time ON measurements(time DESC);")
+
+        conn.commit()
+        cur.close()
+
+        # continuous aggregates cannot be created inside a transaction
+        if self.hypertable and self.aggregate_intervals:
+            self._ensure_continuous_aggregates(conn)
+        logger.info("ETV schema ensured (signals + measurements{})".format(", hypertable" if self.hypertable else ""))
+
+    def _migrate_signal_key_constraint(self, cur):
+        """
+        Signal keys used to be unique across all twins, so a second twin in the same database
+        sharing a PersistenceName could not register it; tables created that way are moved to
+        a key unique per twin
+        """
+        # twins starting together would otherwise race on the constraint changes
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('signals_twin_signal_key'));")
+        cur.execute("""
+            SELECT c.conname,
+                   (SELECT array_agg(a.attname::text ORDER BY a.attname) FROM pg_attribute a
+                    WHERE a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey))
+            FROM pg_constraint c
+            WHERE c.conrelid = 'signals'::regclass AND c.contype = 'u';
+        """)
+        constraints = {name: columns for name, columns in cur.fetchall()}
+        for name, columns in constraints.items():
+            if columns == ['signal_key']:
+                cur.execute('ALTER TABLE signals DROP CONSTRAINT "{}";'.format(name))
+                logger.warning("Replaced the unique signal_key constraint {} of the signals table by one per digital twin".format(name))
+        if 'signals_twin_signal_key' not in constraints:
+            cur.execute("ALTER TABLE signals ADD CONSTRAINT signals_twin_signal_key UNIQUE (digital_twin_id, signal_key);")
+
+    def _timescale_version(self, cur):
+        """Installed TimescaleDB extension version, None on vanilla PostgreSQL"""
+        cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'timescaledb';")
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def _ensure_hypertable(self, cur):
+        """
+        Convert measurements into a hypertable with native compression segmented by signal_id,
+        plus the configured compression and retention policies. Returns False, leaving a plain
+        table, when the timescaledb extension is not installed
+        """
+        version = self._timescale_version(cur)
+        if version is None:
+            logger.warning("TimescaleEnabled is set but the timescaledb extension is not installed, "
+                           "using a plain measurements table")
+            return False
+
+        cur.execute("SELECT create_hypertable('measurements', 'time', chunk_time_interval => %s::interval, "
+                    "if_not_exists => TRUE, migrate_data => TRUE);", (self.chunk_interval,))
+        if self.compress_after:
+            # compression settings cannot be changed once chunks are compressed, so they are only
+            # applied the first time
+            cur.execute("""
+                SELECT compression_enabled FROM timescaledb_information.hypertables
+                WHERE hypertable_schema = current_schema() AND hypertable_name = 'measurements';
+            """)
+            row = cur.fetchone()
+            if not (row and row[0]):
+                cur.execute("""
+                    ALTER TABLE measurements SET (
+                        timescaledb.compress,
+                        timescaledb.compress_segmentby = 'signal_id',
+                        timescaledb.compress_orderby = 'time DESC'
+                    );
+                """)
+            cur.execute("SELECT add_compression_policy('measurements', %s::interval, if_not_exists => TRUE);",
+                        (self.compress_after,))
+        if self.retention_period:
+            cur.execute("SELECT add_retention_policy('measurements', %s::interval, if_not_exists => TRUE);",
+                        (self.retention_period,))
+        logger.info(f"measurements is a TimescaleDB {version} hypertable (chunks of {self.chunk_interval}, "
+                    f"compress after {self.compress_after or 'never'}, retention {self.retention_period or 'unlimited'})")
+        return True
+
+    def _ensure_continuous_aggregates(self, conn):
+        """
+        One continuous aggregate per configured interval (e.g. measurements_15_minutes) holding
+        avg/min/max/count per signal and bucket, refreshed by a policy every bucket. The policy only
+        covers the last few buckets before now; replayed history is refreshed on close
+        """
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            for interval in self.aggregate_intervals:
+                view_name = self._aggregate_view_name(interval)
+                cur.execute(sql.SQL("""
+                    CREATE MATERIALIZED VIEW IF NOT EXISTS {} WITH (timescaledb.continuous) AS
+                    SELECT time_bucket(%s::interval, time) AS bucket, signal_id,
+                           avg(value) AS avg_value, min(value) AS min_value,
+                           max(value) AS max_value, count(*) AS samples
+                    FROM measurements
+                    GROUP BY bucket, signal_id
+                    WITH NO DATA;
+                """).format(sql.Identifier(view_name)), (interval,))
+                # refresh the last few buckets, leaving the still open bucket alone
+                cur.execute("""
+                    SELECT add_continuous_aggregate_policy(%s,
+                        start_offset => 4 * %s::interval, end_offset => %s::interval,
+                        schedule_interval => %s::interval, if_not_exists => TRUE);
+                """, (view_name, interval, interval, interval))
+                logger.info(f"Continuous aggregate {view_name} ensured")
+        finally:
+            cur.close()
+            conn.autocommit = False
+
+    @staticmethod
+    def _aggregate_view_name(interval):
+        return "measurements_" + re.sub(r'\W+', '_', interval).strip('_').lower()
+
+    def _refresh_continuous_aggregates(self, conn):
+        """
+        Materialize the continuous aggregates over the time range persisted by this run, which for
+        a historical replay lies outside the refresh policy's window
+        """
+        start, end = self.persisted_range
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            for interval in self.aggregate_intervals:
+                view_name = self._aggregate_view_name(interval)
+                # widened by a bucket either side, so the buckets holding the range ends are refreshed
+                cur.execute("CALL refresh_continuous_aggregate(%s, %s::timestamptz - %s::interval, %s::timestamptz + %s::interval);",
+                            (view_name, start, interval, end, interval))
+                logger.info(f"Refreshed continuous aggregate {view_name} from {start} to {end}")
+        finally:
+            cur.close()
+            conn.autocommit = False
+
+    def _upsert_signals(self, conn):
+        """
+        Insert or update signal metadata from the sensor store metadata
+        Uses signal_key = PersistenceName as natural key
+        """
+        cur = conn.cursor()
+
+        upsert_sql = """
+            INSERT INTO signals (
+                signal_key, name, description, units, data_type,
+                persistence_name, sensor_name, sensor_instance,
+                digital_twin_id
+            ) VALUES %s
+            ON CONFLICT (digital_twin_id, signal_key)
+            DO UPDATE SET
+                name = EXCLUDED.name,
+                description = EXCLUDED.description,
+                units = EXCLUDED.units,
+                data_type = EXCLUDED.data_type,
+                sensor_name = EXCLUDED.sensor_name,
+                sensor_instance = EXCLUDED.sensor_instance,
+                updated_at = NOW();
+        """
+
+        def text(value, default=''):
+            return default if pd.isna(value) else str(value)
+
+        sensor_metadata = self.sensor_store.metadata
+        rows = []
+        for idx in sensor_metadata.index:
+            row = sensor_metadata.iloc[idx]
+            persistence_name = row['PersistenceName']
+
+            rows.append((
+                persistence_name,                    # signal_key
+                text(row.get('SensorName'), persistence_name),  # name
+                text(row.get('Description')),        # description
+                text(row.get('Units')),              # units
+                text(row.get('DataType'), 'REAL'),   # data_type (for EP)
+                persistence_name,                    # persistence_name (legacy)
+                text(row.get('SensorName')),         # sensor_name
+                text(row.get('SensorInstance')),     # sensor_instance
+                self.dt_name                         # digital_twin_id
+            ))
+        # one statement for all signals
+        execute_values(cur, upsert_sql, rows, page_size=max(len(rows), 1))
+
+        conn.commit()
+        cur.close()
+        logger.info(f"Upserted {len(self.sensor_store)} signals into metadata table")
+
+    def _get_signal_ids(self, conn) -> Dict[str, int]:
+        """Cache signal_id lookup by PersistenceName"""
+        cur = conn.cursor()
+        cur.execute("SELECT signal_key, id FROM signals WHERE digital_twin_id = %s", (self.dt_name,))
+        result = {row[0]: row[1] for row in cur.fetchall()}
+        cur.close()
+        return result
+
+    def persist(self, timestamp: pd.Timestamp, sensor_values: np.ndarray = None):
+        """
+        Persist all current sensor values (or the given snapshot of them) in ETV format
+        """
+        if sensor_values is None:
+            sensor_values = self.sensor_store.snapshot()
+        if np.isnan(sensor_values).all():
+            logger.warning("No valid sensor values to persist at %s", timestamp)
+            return
+
+        if not self.db.available():
+            self.journal.append(timestamp, sensor_values)
+            return
+
+        try:
+            with self.db.connection() as conn:
+                if len(self.journal):
+                    self._replay_journal(conn)
+                if self.sensor_store.keys is not self._cached_keys:
+                    self.refresh_signal_metadata(conn)
+                columns = self._build_columns([(timestamp, sensor_values)])
+                if not columns[0]:
+                    logger.debug("No records to insert at %s", timestamp)
+                    return
+                self._write_columns(conn, columns)
+            logger.info(f"Persisted {len(columns[0])} measurements at {timestamp}")
+        except CONNECTION_ERRORS as e:
+            logger.error(f"Lost PostgreSQL connection, journaling measurements to {self.journal.path}: {e}")
+            self.journal.append(timestamp, sensor_values)
+
+    def persist_batch(self, rows):
+        """
+        Persist several (timestamp, sensor_values) snapshots in one statement and transaction
+        """
+        if not self.db.available():
+            self.journal.append_many(rows)
+            return
+
+        try:
+            with self.db.connection() as conn:
+                if len(self.journal):
+                    self._replay_journal(conn)
+                if self.sensor_store.keys is not self._cached_keys:
+                    self.refresh_signal_metadata(conn)
+                columns = self._build_columns(rows)
+                if not columns[0]:
+                    return
+                self._write_columns(conn, columns)
+            logger.info(f"Persisted {len(columns[0])} measurements for {len(rows)} timestamps")
+        except CONNECTION_ERRORS as e:
+            logger.error(f"Lost PostgreSQL connection, journaling measurements to {self.journal.path}: {e}")
+            self.journal.append_many(rows)
+
+    def _write_columns(self, conn, columns):
+        """Insert and commit measurement columns in one transaction, rolling back anything but a lost connection"""
+        cur = conn.cursor()
+        try:
+            self._insert_columns(cur, columns)
+            conn.commit()
+            times = columns[0]
+            first, last = min(times[0], times[-1]), max(times[0], times[-1])
+            if self.persisted_range is not None:
+                first, last = min(first, self.persisted_range[0]), max(last, self.persisted_range[1])
+            self.persisted_range = (first, last)
+        except CONNECTION_ERRORS:
+            raise
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Failed to persist measurements: {e}")
+            raise
+        finally:
+            if not cur.closed:
+                cur.close()
+
+    def _replay_journal(self, conn):
+        """
+        Write all journaled snapshots back in bulk; the journal is only cleared once every chunk
+        is committed, a partial replay is simply repeated (the insert is an upsert)
+        """
+        if self.sensor_store.keys is not self._cached_keys:
+            self.refresh_signal_metadata(conn)
+        rows = self.journal.rows()
+        for start in range(0, len(rows), REPLAY_CHUNK):
+            columns = self._build_columns(rows[start:start + REPLAY_CHUNK])
+            if columns[0]:
+                self._write_columns(conn, columns)
+        self.journal.clear()
+        logger.info(f"Replayed {len(rows)} journaled snapshots")
+
+    def refresh_signal_metadata(self, conn):
+        """Upsert signal metadata and rebuild the store slot -> signal_id cache"""
+        self._upsert_signals(conn)
+        signal_id_map = self._get_signal_ids(conn)
+        slot_signal_ids = np.full(len(self.sensor_store), -1, dtype=np.int64)
+        for slot, persistence_name in enumerate(self.sensor_store.keys):
+            signal_id = signal_id_map.get(persistence_name)
+            if signal_id is None:
+                logger.warning(f"Signal {persistence_name} not found in DB, it will not be persisted")
+            else:
+                slot_signal_ids[slot] = signal_id
+        self.slot_signal_ids = slot_signal_ids
+        self._cached_keys = self.sensor_store.keys
+
+    def _build_columns(self, rows):
+        """(times, signal_ids, values) lists for every known signal with a non NaN value in rows"""
+        times, signal_ids, values = [], [], []
+        for timestamp, sensor_values in rows:
+            valid = ~np.isnan(sensor_values) & (self.slot_signal_ids >= 0)
+            valid_ids = self.slot_signal_ids[valid].tolist()
+            times.extend([timestamp] * len(valid_ids))
+            signal_ids.extend(valid_ids)
+            values.extend(sensor_values[valid].tolist())
+        return times, signal_ids, values
+
+    def _insert_columns(self, cur, columns):
+        """Bulk insert in a single round trip through the connection's prepared statement"""
+        statement = self.db.prepare(cur, "etv_insert_measurements", INSERT_MEASUREMENTS)
+        cur.execute(f"EXECUTE {statement} (%s, %s, %s);", columns)
+
+    def close(self):
+        if len(self.journal) and self.db.available():
+            try:
+                with self.db.connection() as conn:
+                    self._replay_journal(conn)
+            except CONNECTION_ERRORS as e:
+                logger.error(f"{len(self.journal)} snapshots left in journal {self.journal.path}: {e}")
+        if self.hypertable and self.aggregate_intervals and self.persisted_range is not None and self.db.available():
+            try:
+                with self.db.connection() as conn:
+                    self._refresh_continuous_aggregates(conn)
+                self.persisted_range = None
+            except Exception as e:
+                logger.error(f"Failed to refresh continuous aggregates: {e}")
+        self.journal.close()
+
+
+if __name__ == "__main__":
+    # Benchmark: rows/sec for 1k sensors at 1-minute timesteps against the database in
+    # the given config.ini, comparing executemany, execute_values and the prepared unnest insert
+    # usage: python -m persistence.postgres_persistence_etv <config.ini> [timesteps]
+    import sys
+    import configparser
+    from simulator.signal_store import SignalStore
+
+    config = configparser.ConfigParser()
+    config.read(sys.argv[1])
+    timesteps = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    config.set('DEFAULT', 'DigitalTwinIdentifier', 'etv_benchmark')
+    n_sensors = 1000
+    store = SignalStore(pd.DataFrame({'PersistenceName': ['bench_sensor_{}'.format(i) for i in range(n_sensors)],
+                                      'SensorName': 'bench', 'SensorInstance': 'bench'}), 'PersistenceName')
+    agent = PostgresPersistenceETV(config, store)
+    rng = np.random.default_rng(0)
+    start_time = pd.Timestamp('2000-01-01', tz='UTC')
+
+    def run(insert):
+        with agent.db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM measurements WHERE signal_id = ANY(%s)", (agent.slot_signal_ids.tolist(),))
+            conn.commit()
+            began = time.perf_counter()
+            for step in range(timesteps):
+                store.write(slice(None), rng.random(n_sensors))
+                insert(cur, agent._build_columns([(start_time + pd.Timedelta(minutes=step), store.snapshot())]))
+                conn.commit()
+            elapsed = time.perf_counter() - began
+            cur.close()
+        return timesteps * n_sensors / elapsed
+
+    values_sql = """
+        INSERT INTO measurements (time, signal_id, value) VALUES %s
+        ON CONFLICT (time, signal_id) DO UPDATE SET value = EXCLUDED.value;
+    """
+    executemany_sql = values_sql.replace("%s", "(%s, %s, %s)")
+    print("{} sensors x {} one-minute timesteps".format(n_sensors, timesteps))
+    print("executemany:     {:10.0f} rows/s".format(run(lambda cur, columns: cur.executemany(executemany_sql, list(zip(*columns))))))
+    print("execute_values:  {:10.0f} rows/s".format(run(lambda cur, columns: execute_values(cur, values_sql, list(zip(*columns)), page_size=n_sensors))))
+    print("prepared unnest: {:10.0f} rows/s".format(run(agent._insert_columns)))
+    agent.close()
@@ -7,56 +7,87 @@ Created on Fri Jul 21 10:39:30 2023
 import psycopg2
 # import the error handling libraries for psycopg2
 from psycopg2 import OperationalError, errorcodes, errors
+from psycopg2.extras import execute_values
 import datetime
+from zoneinfo import ZoneInfo
+import numpy as np
 import pandas as pd
+from persistence.spill_journal import SpillJournal
+from persistence.connection_manager import ConnectionManager, CONNECTION_ERRORS
+import logging
+logger = logging.getLogger(__name__)
 
 class PostgresPersistence:
-    def __init__(self, config, sensors_df):
-        self.sensors_df = sensors_df
+    '''
+    long format persistence: one (time, signal_id, value) row per sensor and timestep in
+    {dt}_values, with signal names normalized into the {dt}_signal_names dictionary table.
+    With [DATABASE] LongFormatPartitioned the values table is range partitioned by month,
+    partitions being created as the simulation reaches them. The {dt}_signal_values view
+    presents the data with signal names, as the original single table did, and is also
+    available as {dt}, into which an existing original table is migrated.
+    '''
+    def __init__(self, config, sensor_store):
+        self.sensor_store = sensor_store
         self.dbname = config.get('DATABASE', 'DatabaseName')       
         self.dbhost = config.get('DATABASE', 'DatabaseHost')
         self.dbport = config.get('DATABASE', 'DatabasePort')
         self.dbuser = config.get('DATABASE', 'DatabaseUser')
         self.dbpass = config.get('DATABASE', 'DatabasePass')
         self.dt_name = config.get('DEFAULT', 'DigitalTwinIdentifier')
+        self.names_table = "{}_signal_names".format(self.dt_name)
+        self.values_table = "{}_values".format(self.dt_name)
+        self.partitioned = config.get('DATABASE', 'LongFormatPartitioned', fallback='false').strip().lower() == 'true'
         self.successfully_initialized = False
-        
+        #rows that cannot be written while the database is unreachable are journaled locally
+        #and replayed in bulk once the connection manager can reconnect
+        self.journal = SpillJournal.for_store(config, self.dt_name + '_long', sensor_store)
+        self._cached_keys = None
+        self.slot_signal_ids = None
+        self.partitions = set()
+        #pooled connections shared with other backends on the same database
+        self.db = ConnectionManager.for_config(config)
         
         try:
-            self.conn = psycopg2.connect(
-                host=self.dbhost,
-                port=self.dbport,
-                database=self.dbname,
-                user=self.dbuser,
-                password=self.dbpass)
+            with self.db.connection() as conn:
+                self.setup(conn)
         except psycopg2.Error as e:
             print ("Unable to connect!")
             print (e.pgerror)
             print (e.diag.message_detail)
             return
         
-        self.config_output_table()
-        
+    def setup(self, conn):
+        self.config_output_table(conn)
+        if self.successfully_initialized:
+            self.refresh_signal_ids(conn)
                 
-    def make_table(self):
-        cur = self.conn.cursor()
+    def make_tables(self, conn):
+        cur = conn.cursor()
         try:
-            sql_stmt = "CREATE TABLE {} (key_id serial PRIMARY KEY, time TIMESTAMPTZ, signal_name VARCHAR(255) not null, value real);".format(self.dt_name)
-            cur.execute(sql_stmt)
+            cur.execute("CREATE TABLE IF NOT EXISTS {} (id SERIAL PRIMARY KEY, signal_name VARCHAR(255) UNIQUE NOT NULL);".format(self.names_table))
+            sql_stmt = ("CREATE TABLE IF NOT EXISTS {} (time TIMESTAMPTZ NOT NULL, "
+                        "signal_id INTEGER NOT NULL REFERENCES {}(id), value REAL, "
+                        "PRIMARY KEY (time, signal_id))").format(self.values_table, self.names_table)
+            if self.partitioned:
+                sql_stmt = sql_stmt + " PARTITION BY RANGE (time)"
+            cur.execute(sql_stmt + ";")
+            cur.execute("CREATE OR REPLACE VIEW {}_signal_values AS SELECT v.time, n.signal_name, v.value "
+                        "FROM {} v JOIN {} n ON n.id = v.signal_id;".format(self.dt_name, self.values_table, self.names_table))
             cur.close()
-            self.conn.commit()
+            conn.commit()
         except psycopg2.Error as e:
+            conn.rollback()
             print ("Unable to create table!")
             print (e.pgerror)
             print (e.diag.message_detail)
-            return
-        print("Table'{}' created.".format(self.dt_name))
+            return False
+        return True
                    
             
-    def config_output_table(self):
+    def config_output_table(self, conn):
         '''
-        Confirms that table representing the digital twin instance exists and that
-        all sensors to be read have associated columns and meta data
+        Confirms that the tables representing the digital twin instance exist, and
+        whether an existing values table is partitioned
 
         Parameters
         ----------
@@ -67,44 +98,181 @@ class PostgresPersistence:
         None.
 
         '''
-        cur = self.conn.cursor()
+        cur = conn.cursor()
         try:
-            cur.execute("select exists(select * from information_schema.tables where table_name='{}');".format(self.dt_name))
-            table_exists = cur.fetchone()[0]
+            cur.execute("SHOW TimeZone;")
+            self.session_tz = ZoneInfo(cur.fetchone()[0])
+        except (KeyError, ValueError):
+            self.session_tz = None
+        try:
+            if not self.make_tables(conn):
+                return
+            #an existing table keeps the layout it was created with
+            cur.execute("select relkind from pg_class where relname=%s;", (self.values_table,))
+            partitioned = cur.fetchone()[0] == 'p'
+            if partitioned != self.partitioned:
+                logger.warning("{} already exists {}partitioned, LongFormatPartitioned is ignored".format(self.values_table, "" if partitioned else "un"))
+            self.partitioned = partitioned
+            if self.partitioned:
+                cur.execute("select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid "
+                            "join pg_class p on p.oid = i.inhparent where p.relname=%s;", (self.values_table,))
+                self.partitions = {name for (name,) in cur.fetchall()}
+            self.migrate_legacy_table(cur)
             cur.close()
-            if table_exists:
-                pass
-            else:
-                self.make_table()
+            conn.commit()
         except psycopg2.Error as e:
+            conn.rollback()
             print ("Unable to create table!")
             print (e.pgerror)
             print (e.diag.message_detail)
             return
-            
-        
-    def persist(self, timestamp):
-        #varchar_id = self.generate_varchar_id()
-        val_holders = "%s"
-        
-        #values_for_insert = [varchar_id,timestamp]
+        self.successfully_initialized = True
+
+    def migrate_legacy_table(self, cur):
+        '''
+        the single {dt} table (time, signal_name, value) written by earlier versions is migrated into
+        the values and signal names tables and kept as {dt}_legacy; {dt} is then a view of the new
+        tables, so that queries and dashboards reading {dt} keep getting new data
+        '''
+        cur.execute("select relkind from pg_class where relname=%s and pg_table_is_visible(oid);", (self.dt_name,))
+        row = cur.fetchone()
+        relkind = row[0] if row else None
+        if relkind == 'r':
+            legacy_table = "{}_legacy".format(self.dt_name)
+            logger.warning("Found table {} of the previous long format, migrating its rows into {} and renaming it {}".format(
+                self.dt_name, self.values_table, legacy_table))
+            cur.execute("INSERT INTO {} (signal_name) SELECT DISTINCT signal_name FROM {} ON CONFLICT (signal_name) DO NOTHING;".format(
+                self.names_table, self.dt_name))
+            if self.partitioned:
+                cur.execute("SELECT DISTINCT date_trunc('month', time) FROM {} WHERE time IS NOT NULL;".format(self.dt_name))
+                self.ensure_partitions(cur, [month for (month,) in cur.fetchall()])
+            #the old table had no key on (time, signal_name); the latest row of a duplicate wins
+            cur.execute("INSERT INTO {} (time, signal_id, value) "
+                        "SELECT DISTINCT ON (l.time, n.id) l.time, n.id, l.value FROM {} l "
+                        "JOIN {} n ON n.signal_name = l.signal_name WHERE l.time IS NOT NULL "
+                        "ORDER BY l.time, n.id, l.key_id DESC ON CONFLICT (time, signal_id) DO NOTHING;".format(
+                            self.values_table, self.dt_name, self.names_table))
+            migrated = cur.rowcount
+            cur.execute("ALTER TABLE {} RENAME TO {};".format(self.dt_name, legacy_table))
+            logger.warning("Migrated {} rows from {}, which is now a view of {}".format(migrated, legacy_table, self.values_table))
+            relkind = None
+        if relkind in (None, 'v'):
+            cur.execute("CREATE OR REPLACE VIEW {} AS SELECT time, signal_name, value FROM {}_signal_values;".format(
+                self.dt_name, self.dt_name))
+        else:
+            logger.warning("{} exists but is neither the previous long format table nor a view, it does not receive new data".format(self.dt_name))
+
+    def refresh_signal_ids(self, conn):
+        '''
+        adds any new signal names to the dictionary table and caches the signal id per store slot
+        '''
+        names = [str(name) for name in self.sensor_store.keys]
+        cur = conn.cursor()
+        execute_values(cur, "INSERT INTO {} (signal_name) VALUES %s ON CONFLICT (signal_name) DO NOTHING;".format(self.names_table),
+                       [(name,) for name in names], page_size=max(len(names), 1))
+        cur.execute("SELECT signal_name, id FROM {} WHERE signal_name = ANY(%s);".format(self.names_table), (names,))
+        signal_ids = dict(cur.fetchall())
+        cur.close()
+        conn.commit()
+        self.slot_signal_ids = np.array([signal_ids[name] for name in names], dtype=np.int64)
+        self._cached_keys = self.sensor_store.keys
+
+    def partition_month(self, timestamp):
+        timestamp = pd.Timestamp(timestamp).to_pydatetime()
+        if timestamp.tzinfo is not None and self.session_tz is not None:
+            #partition bounds are given in the session time zone, as naive timestamps are
+            timestamp = timestamp.astimezone(self.session_tz)
+        return timestamp.year, timestamp.month
+
+    def ensure_partitions(self, cur, timestamps):
+        '''
+        creates the monthly partitions the given timestamps fall into, once per month
+        '''
+        for year, month in sorted({self.partition_month(timestamp) for timestamp in timestamps}):
+            partition = "{}_y{:04d}m{:02d}".format(self.values_table, year, month)
+            if partition in self.partitions:
+                continue
+            next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+            cur.execute("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ('{:04d}-{:02d}-01') TO ('{:04d}-{:02d}-01');".format(
+                partition, self.values_table, year, month, next_year, next_month))
+            self.partitions.add(partition)
+
+    def insert_rows(self, conn, rows):
+        '''
+        writes (timestamp, sensor_values) rows with one execution of a prepared multi-row insert
+        (arrays of times, signal ids and values) in one transaction; NaN values are not stored
+        '''
+        if self.sensor_store.keys is not self._cached_keys:
+            self.refresh_signal_ids(conn)
+        times, signal_ids, values = [], [], []
+        for timestamp, sensor_values in rows:
+            valid = ~np.isnan(sensor_values)
+            valid_ids = self.slot_signal_ids[valid].tolist()
+            times.extend([timestamp] * len(valid_ids))
+            signal_ids.extend(valid_ids)
+            values.extend(sensor_values[valid].tolist())
+        if not times:
+            return
+        cur = conn.cursor()
+        try:
+            if self.partitioned:
+                self.ensure_partitions(cur, {timestamp for timestamp, _ in rows})
+            sql_stmt = ("INSERT INTO {} (time,signal_id,value) SELECT * FROM unnest($1::timestamptz[], $2::integer[], $3::real[]) "
+                        "ON CONFLICT (time, signal_id) DO UPDATE SET value = EXCLUDED.value").format(self.values_table)
+            statement = self.db.prepare(cur, "{}_insert".format(self.values_table), sql_stmt)
+            cur.execute("EXECUTE {} (%s, %s, %s);".format(statement), (times, signal_ids, values))
+            cur.close()
+            conn.commit()
+        except CONNECTION_ERRORS:
+            raise
+        except psycopg2.Error:
+            conn.rollback()
+            #partitions created in the failed transaction are gone again
+            if self.partitioned:
+                self.partitions.clear()
+                self.config_output_table(conn)
+            raise
+
+    def replay_journal(self, conn):
+        '''
+        writes all journaled rows back in one transaction; the journal is only cleared
+        once that transaction has committed
+        '''
+        rows = self.journal.rows()
+        self.insert_rows(conn, rows)
+        self.journal.clear()
+        logger.info("Replayed {} journaled rows into {}".format(len(rows), self.values_table))
         
-        for idx in self.sensors_df.index:
-            curr_signal_name = self.sensors_df['PersistenceName'][idx]
-            curr_value = self.sensors_df['current_val'][idx]
-            values_for_insert = [timestamp]
-            values_for_insert.append(curr_signal_name)
-            values_for_insert.append(curr_value)
-            try:
-                cur = self.conn.cursor()
-                sql_stmt = "INSERT INTO {} (time,signal_name,value) VALUES({});".format(self.dt_name, "%s,%s,%s" )
-                cur.execute(sql_stmt, values_for_insert)
-                cur.close()
-                self.conn.commit()
-            except psycopg2.Error as e:
-                print ("Unable to persist signal('{}')for time{}!".format(curr_signal_name,timestamp))
+    def persist_batch(self, rows):
+        if not self.db.available():
+            self.journal.append_many(rows)
+            return
+        try:
+            with self.db.connection() as conn:
+                if not self.successfully_initialized:
+                    #the database was unreachable when this backend was created
+                    self.setup(conn)
+                if len(self.journal):
+                    self.replay_journal(conn)
+                self.insert_rows(conn, rows)
+        except CONNECTION_ERRORS as e:
+            logger.error("Lost PostgreSQL connection, journaling rows to {}: {}".format(self.journal.path, e))
+            self.journal.append_many(rows)
+        except psycopg2.Error as e:
+            print ("Unable to persist {} rows from time {}!".format(len(rows), rows[0][0]))
+            print (e.pgerror)
+            print (e.diag.message_detail)
 
-                print (e.pgerror)
-                print (e.diag.message_detail)
-                       
-            
\ No newline at end of file
+    def persist(self, timestamp, sensor_values=None):
+        if sensor_values is None:
+            sensor_values = self.sensor_store.snapshot()
+        self.persist_batch([(timestamp, sensor_values)])
+
+    def close(self):
+        if len(self.journal) and self.db.available():
+            try:
+                with self.db.connection() as conn:
+                    self.replay_journal(conn)
+            except CONNECTION_ERRORS as e:
+                logger.error("{} rows left in journal {}: {}".format(len(self.journal), self.journal.path, e))
+        self.journal.close()
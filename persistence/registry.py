@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Persistence backends keyed by the [DEFAULT] PersistenceType setting
+
+Built in backends are referenced by module path and only imported when selected, so a
+replay writing Parquet files does not need psycopg2 (and vice versa). Additional
+backends can be added with register_backend.
+"""
+import importlib
+import logging
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_BACKENDS = {
+    'SQL': 'persistence.postgres_persistence_etv:PostgresPersistenceETV',
+    'SQL_WIDE': 'persistence.postgres_persistence:PostgresPersistence',
+    'SQL_LONG': 'persistence.postgres_persistence_new_format:PostgresPersistence',
+    'PARQUET': 'persistence.columnar_file_persistence:ColumnarFilePersistence',
+    'ARROW': 'persistence.columnar_file_persistence:ColumnarFilePersistence',
+}
+
+
+def register_backend(persistence_type, backend):
+    """
+    registers backend for persistence_type; backend is either a callable taking
+    (config, sensor_store) or a 'module.path:ClassName' string
+    """
+    PERSISTENCE_BACKENDS[persistence_type.strip().upper()] = backend
+
+
+def create_persistence_agent(config, sensor_store):
+    persistence_type = config.get('DEFAULT', 'PersistenceType', fallback='SQL').strip().upper()
+    backend = PERSISTENCE_BACKENDS.get(persistence_type)
+    if backend is None:
+        raise ValueError("Unsupported PersistenceType {}, expected one of {}".format(persistence_type, sorted(PERSISTENCE_BACKENDS)))
+    if isinstance(backend, str):
+        module_name, class_name = backend.split(':')
+        backend = getattr(importlib.import_module(module_name), class_name)
+    logger.info("Persistence backend for {}: {}".format(persistence_type, getattr(backend, '__name__', backend)))
+    return backend(config, sensor_store)
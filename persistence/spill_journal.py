@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Durable local journal for sensor snapshots that could not be written to the database
+
+The journal is an append-only, memory-mapped binary file of fixed width records
+(int64 nanosecond timestamp, timezone flag, float64 value vector). Its header carries a hash of the
+signal schema (the ordered sensor keys), so a journal written for one sensor layout is
+never replayed into another; such a journal is set aside instead of being lost.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import numpy as np
+import pandas as pd
+import logging
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ZDTJRNL1'
+#magic, schema hash (sha256 digest), value width, record count
+HEADER = struct.Struct('<8s32sQQ')
+HEADER_SIZE = 64
+INITIAL_CAPACITY = 1024
+
+
+def schema_hash(keys):
+    return hashlib.sha256('\n'.join(str(key) for key in keys).encode('utf-8')).digest()
+
+
+class SpillJournal:
+    def __init__(self, path, keys):
+        self.path = path
+        self.width = len(keys)
+        self.schema = schema_hash(keys)
+        #utc marks timestamps that were timezone aware (stored as UTC), others are kept naive
+        self.record_dtype = np.dtype([('time', '<i8'), ('utc', '<i8'), ('values', '<f8', (self.width,))])
+        self.count = 0
+        self._file = None
+        self._mmap = None
+        self._open()
+
+    @classmethod
+    def for_store(cls, config, name, sensor_store):
+        """journal in [PERSISTENCE] JournalDirectory named after the persistence backend"""
+        directory = config.get('PERSISTENCE', 'JournalDirectory', fallback='persistence_journal')
+        os.makedirs(directory, exist_ok=True)
+        return cls(os.path.join(directory, '{}.journal'.format(name)), sensor_store.keys)
+
+    def _open(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= HEADER_SIZE:
+            with open(self.path, 'rb') as existing:
+                magic, schema, width, count = HEADER.unpack(existing.read(HEADER.size))
+            if magic != MAGIC or schema != self.schema or width != self.width:
+                orphan_path = '{}.{}.orphaned'.format(self.path, schema.hex()[:8])
+                os.replace(self.path, orphan_path)
+                logger.warning("Journal {} was written for a different signal schema, moved to {}".format(self.path, orphan_path))
+            else:
+                self.count = count
+        if not os.path.exists(self.path):
+            with open(self.path, 'wb') as new_file:
+                new_file.write(HEADER.pack(MAGIC, self.schema, self.width, 0).ljust(HEADER_SIZE, b'\0'))
+                new_file.truncate(HEADER_SIZE + INITIAL_CAPACITY * self.record_dtype.itemsize)
+        self._file = open(self.path, 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        if self.count:
+            logger.warning("Journal {} holds {} unpersisted snapshots".format(self.path, self.count))
+
+    def __len__(self):
+        return self.count
+
+    def _capacity(self):
+        return (len(self._mmap) - HEADER_SIZE) // self.record_dtype.itemsize
+
+    def _grow(self, needed):
+        capacity = max(self._capacity(), INITIAL_CAPACITY)
+        while capacity < needed:
+            capacity *= 2
+        self._mmap.close()
+        self._file.truncate(HEADER_SIZE + capacity * self.record_dtype.itemsize)
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+
+    def _records(self):
+        return np.frombuffer(self._mmap, dtype=self.record_dtype, count=self._capacity(), offset=HEADER_SIZE)
+
+    def append_many(self, rows):
+        """appends (timestamp, values) rows; naive timestamps are returned naive, aware ones in UTC"""
+        if not rows:
+            return
+        if self.count + len(rows) > self._capacity():
+            self._grow(self.count + len(rows))
+        records = self._records()
+        for offset, (timestamp, values) in enumerate(rows):
+            timestamp = pd.Timestamp(timestamp)
+            records[self.count + offset] = (timestamp.value, timestamp.tzinfo is not None, values)
+        del records
+        self.count += len(rows)
+        #the count is only advanced once the records themselves are in place
+        self._mmap[:HEADER.size] = HEADER.pack(MAGIC, self.schema, self.width, self.count)
+        self._mmap.flush()
+
+    def append(self, timestamp, values):
+        self.append_many([(timestamp, values)])
+
+    def read(self):
+        """returns (timestamps, values) copies of every journaled record"""
+        records = self._records()[:self.count]
+        times = [pd.Timestamp(int(ns), tz='UTC' if utc else None).to_pydatetime()
+                 for ns, utc in zip(records['time'], records['utc'])]
+        values = records['values'].copy()
+        del records
+        return times, values
+
+    def rows(self):
+        """journaled records as a list of (timestamp, values) rows, e.g. for persist_batch"""
+        times, values = self.read()
+        return list(zip(times, values))
+
+    def clear(self):
+        """drops all records once they have been persisted, shrinking the file back"""
+        self.count = 0
+        self._mmap[:HEADER.size] = HEADER.pack(MAGIC, self.schema, self.width, 0)
+        self._mmap.flush()
+        if self._capacity() > INITIAL_CAPACITY:
+            self._mmap.close()
+            self._file.truncate(HEADER_SIZE + INITIAL_CAPACITY * self.record_dtype.itemsize)
+            self._mmap = mmap.mmap(self._file.fileno(), 0)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind persistence for the digital twin
+
+persist(timestamp) only snapshots the sensor store into a bounded in-memory queue, so the
+EnergyPlus thread never waits on the database; a background writer flushes batches to the
+configured persistence agent when either the batch size or the flush interval is reached.
+When the queue is full the overflow policy decides what happens:
+    block       - the simulation thread waits for room (no data loss, may stall the simulation)
+    drop_oldest - the oldest queued snapshot is discarded
+    spill       - the snapshot is appended to a local spill journal, replayed once the queue drains
+"""
+import atexit
+import threading
+import time
+from collections import deque
+from persistence.spill_journal import SpillJournal
+import logging
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'spill')
+
+
+class WriteBehindPersistence:
+    def __init__(self, config, persistence_agent, sensor_store):
+        self.agent = persistence_agent
+        self.sensor_store = sensor_store
+        self.batch_size = int(config.get('PERSISTENCE', 'BatchSize', fallback='60'))
+        self.flush_interval = float(config.get('PERSISTENCE', 'FlushIntervalSeconds', fallback='5'))
+        self.capacity = int(config.get('PERSISTENCE', 'QueueCapacity', fallback='10000'))
+        self.overflow_policy = config.get('PERSISTENCE', 'OverflowPolicy', fallback='block').strip().lower()
+        if self.overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unsupported OverflowPolicy {}, expected one of {}".format(self.overflow_policy, OVERFLOW_POLICIES))
+        self.spill = None
+        if self.overflow_policy == 'spill':
+            spill_path = config.get('PERSISTENCE', 'SpillFile', fallback='persistence_spill.journal')
+            self.spill = SpillJournal(spill_path, sensor_store.keys)
+
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.written = 0
+        self.closed = False
+        self.writer = threading.Thread(target=self._run, name="persistence-writer", daemon=True)
+        self.writer.start()
+        #make sure queued data is flushed even if close() is never called explicitly
+        atexit.register(self.close)
+
+    def persist(self, timestamp):
+        """snapshots the current sensor values for timestamp; returns without touching the database"""
+        row = (timestamp, self.sensor_store.snapshot())
+        with self.condition:
+            if len(self.queue) >= self.capacity:
+                if self.overflow_policy == 'block':
+                    while len(self.queue) >= self.capacity and not self.closed:
+                        self.condition.wait()
+                elif self.overflow_policy == 'drop_oldest':
+                    self.queue.popleft()
+                    self.dropped += 1
+                    if self.dropped % 1000 == 1:
+                        logger.warning("Persistence queue full, {} snapshots dropped so far".format(self.dropped))
+                else:
+                    self.spill.append(*row)
+                    return
+            self.queue.append(row)
+            if len(self.queue) >= self.batch_size:
+                self.condition.notify_all()
+
+    def _take_batch(self):
+        with self.condition:
+            batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            self.condition.notify_all()
+        return batch
+
+    def _write(self, batch):
+        """writes one batch, retrying until it succeeds or the pipeline is closed"""
+        while True:
+            try:
+                if hasattr(self.agent, 'persist_batch'):
+                    self.agent.persist_batch(batch)
+                else:
+                    for timestamp, values in batch:
+                        self.agent.persist(timestamp, values)
+                self.written += len(batch)
+                return True
+            except Exception as e:
+                logger.error("Write-behind flush of {} snapshots failed: {}".format(len(batch), e))
+                if self.closed:
+                    return False
+                time.sleep(self.flush_interval)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.closed and len(self.queue) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+                closing = self.closed
+            batch = self._take_batch()
+            if batch and not self._write(batch):
+                self._spill_or_report(batch)
+            #once the queue has drained, replay anything spilled while it was full
+            spilled = self._take_spilled()
+            if spilled:
+                for start in range(0, len(spilled), self.batch_size):
+                    if not self._write(spilled[start:start + self.batch_size]):
+                        self._spill_or_report(spilled[start:])
+                        break
+            if closing and not self.queue:
+                return
+
+    def _take_spilled(self):
+        """
+        empties the spill journal once the queue has drained, returning its rows. The journal is only
+        touched under the condition, as persist appends to it from the simulation thread
+        """
+        with self.condition:
+            if self.spill is None or self.queue or not len(self.spill):
+                return []
+            spilled = self.spill.rows()
+            self.spill.clear()
+        return spilled
+
+    def _spill_or_report(self, rows):
+        if self.spill is not None:
+            with self.condition:
+                self.spill.append_many(rows)
+            logger.error("{} snapshots kept in spill journal {}".format(len(rows), self.spill.path))
+        else:
+            logger.error("{} snapshots could not be persisted at shutdown".format(len(rows)))
+
+    def flush(self):
+        """blocks until everything queued so far has been handed to the persistence agent"""
+        with self.condition:
+            self.condition.notify_all()
+            while self.queue:
+                self.condition.wait(self.flush_interval)
+
+    def close(self):
+        """flushes all queued snapshots, stops the writer and closes the wrapped agent"""
+        if self.closed:
+            return
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.writer.join()
+        logger.info("Write-behind persistence closed: {} snapshots written, {} dropped".format(self.written, self.dropped))
+        if self.spill is not None:
+            with self.condition:
+                self.spill.close()
+        if hasattr(self.agent, 'close'):
+            self.agent.close()
@@ -1,36 +1,202 @@
-import pandas as pd
+import numpy as np
+import time
+import datetime
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from retrieval.seeq_retrieval import SeeqRetrieval
+from simulator.signal_store import SignalReading, QUALITY_GOOD, QUALITY_STALE
 
 logger = logging.getLogger(__name__)
 
 
+class RetrievalMetrics:
+    """fetch latency and deadline miss bookkeeping for the agent fetches"""
+    def __init__(self, window=1000):
+        self.fetches = 0
+        self.read_ahead_hits = 0
+        self.misses = 0
+        self.failures = 0
+        #fetches whose result was never used: late ones superseded by the next timepoint, or
+        #read-aheads for a timepoint that was not requested
+        self.discarded = 0
+        self.latencies = deque(maxlen=window)
+
+    def record_fetch(self, latency):
+        self.fetches += 1
+        self.latencies.append(latency)
+
+    def summary(self):
+        latencies = np.asarray(self.latencies) if self.latencies else np.zeros(1)
+        return {'fetches': self.fetches, 'read_ahead_hits': self.read_ahead_hits,
+                'misses': self.misses, 'failures': self.failures, 'discarded': self.discarded,
+                'latency_mean_s': float(latencies.mean()),
+                'latency_p95_s': float(np.percentile(latencies, 95)),
+                'latency_max_s': float(latencies.max())}
+
+
+class AgentFetcher:
+    """
+    runs one retrieval agent on its own single worker thread and returns its partial result as
+    a dict of SignalTagName -> SignalReading. Agents implementing fetch_signals_at_timepoint
+    return that directly; older agents that only implement
+    retrieve_signals_for_actuators_at_timepoint write into a private staging copy of the signal
+    metadata, from which the rows they set (non NaN) are turned into readings.
+    """
+    def __init__(self, agent, signal_metadata, deadline):
+        self.agent = agent
+        self.deadline = float(getattr(agent, 'fetch_deadline', deadline))
+        self.staging_df = None
+        if not hasattr(agent, 'fetch_signals_at_timepoint'):
+            self.staging_df = signal_metadata.copy()
+            self.staging_df['current_val'] = np.nan
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="retrieval-{}".format(type(agent).__name__))
+        self.pending_timepoint = None
+        self.pending_future = None
+        #whether the pending fetch's result has been taken up by a retrieval
+        self.collected = True
+        #tags this agent has ever delivered, used to flag staleness when it misses a deadline
+        self.tags = set()
+
+    def submit(self, timepoint, pacer=None, data_delay=None):
+        """
+        starts fetching timepoint on the worker, after waiting (in realtime pacing) until the data is
+        available at its source, data_delay after the timepoint. Returns False if the previous fetch is
+        superseded before its result was used
+        """
+        superseded = not self.collected
+        self.pending_timepoint = timepoint
+        self.pending_future = self.executor.submit(self._fetch, timepoint, pacer, data_delay)
+        self.collected = False
+        return not superseded
+
+    def _fetch(self, timepoint, pacer, data_delay):
+        #in real time mode data for a timepoint is not available before the timepoint (plus the
+        #source's ingestion delay); the simulation itself only needs it PacingBufferMinutes later
+        if pacer is not None:
+            pacer.wait(timepoint, data_delay)
+        start = time.perf_counter()
+        if self.staging_df is None:
+            readings = self.agent.fetch_signals_at_timepoint(timepoint)
+        else:
+            self.staging_df['current_val'] = np.nan
+            self.agent.retrieve_signals_for_actuators_at_timepoint(self.staging_df, timepoint)
+            fetched = self.staging_df['current_val'].to_numpy(dtype=np.float64)
+            tagnames = self.staging_df['SignalTagName'].to_numpy()
+            readings = {tagnames[row]: SignalReading(fetched[row], QUALITY_GOOD, timepoint)
+                        for row in np.flatnonzero(~np.isnan(fetched))}
+        return readings, time.perf_counter() - start
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
 class CoreRetrieval:
-    def __init__(self, config, signals_df):
+    def __init__(self, config, signal_store, pacer=None):
         self.config = config
-        self.signals_df = signals_df
+        self.signal_store = signal_store
+        self.pacer = pacer
         self.retrieval_agents = []
         #this DT implementation was based on Seeq, and while it may not be require, it is the default
         #and usage is currently checked at the initialization of this class
-        if self.signals_df['SignalSource'].str.contains('seeq').any():
-            self.retrieval_agents.append(SeeqRetrieval(self.config, self.signals_df))
+        if self.signal_store.metadata['SignalSource'].str.contains('seeq').any():
+            self.retrieval_agents.append(SeeqRetrieval(self.config, self.signal_store.metadata))
+
+        #agents are fetched concurrently, each bounded by its deadline (an agent may override the
+        #configured default with a fetch_deadline attribute). With read-ahead, once a timepoint has
+        #been served each agent's fetch for the next timepoint is started straight away
+        self.read_ahead_enabled = config.get('RETRIEVAL', 'ReadAheadEnabled', fallback='false').strip().lower() == 'true'
+        self.fetch_deadline = float(config.get('RETRIEVAL', 'FetchDeadlineSeconds', fallback='30'))
+        #in realtime pacing a read-ahead fetch starts once its timepoint is ReadAheadDataDelaySeconds
+        #old, when the source has the data, instead of when the simulation needs it
+        self.data_delay = datetime.timedelta(seconds=float(config.get('RETRIEVAL', 'ReadAheadDataDelaySeconds', fallback='0')))
+        self.fetchers = {}
+        self.metrics = RetrievalMetrics()
+        #metrics are logged every MetricsLogIntervalSeconds of wall clock time (and at close), so
+        #that long running realtime twins report them too
+        self.metrics_log_interval = float(config.get('RETRIEVAL', 'MetricsLogIntervalSeconds', fallback='3600'))
+        self.next_metrics_log = time.monotonic() + self.metrics_log_interval
+        self.last_timepoint = None
+        self.timestep = None
 
     def add_retrieval_agent(self, agent):
         """
         function adds a retrieval agent to the list of retrieval agents
-        retrieval agent must implement the method:
-        retrieve_signals_for_actuators_at_timepoint(signals_df, timepoint)  
+        retrieval agent must implement either of the methods:
+        fetch_signals_at_timepoint(timepoint) -> dict of SignalTagName -> SignalReading
+        retrieve_signals_for_actuators_at_timepoint(signals_df, timepoint)
         """
         self.retrieval_agents.append(agent)
 
-    def retrieve_signals_for_actuators_at_timepoint(self, signals_df, timepoint):
+    def retrieve_signals_for_actuators_at_timepoint(self, signal_store, timepoint):
         """
-        function calls all applicable retrieval agents to retrieve the physical building's signals of 
-        interest that will be used to override EP simulation actuators, and places values in the appropriate dataframes.
+        function calls all applicable retrieval agents concurrently to retrieve the physical building's
+        signals of interest that will be used to override EP simulation actuators, and merges their
+        partial results into the signal store in one step. Total latency is that of the slowest agent,
+        capped by the deadlines: an agent that misses its deadline or fails leaves its signals at their
+        last good value, marked stale.
         """
+        if self.last_timepoint is not None and timepoint > self.last_timepoint:
+            self.timestep = timepoint - self.last_timepoint
+        self.last_timepoint = timepoint
+
+        #start (or pick up the read-ahead of) every agent's fetch before waiting on any of them
+        started = time.monotonic()
         for agent in self.retrieval_agents:
-            agent.retrieve_signals_for_actuators_at_timepoint(signals_df, timepoint)
+            fetcher = self.fetchers.get(agent)
+            if fetcher is None:
+                fetcher = AgentFetcher(agent, signal_store.metadata, self.fetch_deadline)
+                self.fetchers[agent] = fetcher
+            if fetcher.pending_timepoint == timepoint and fetcher.pending_future is not None:
+                if fetcher.pending_future.done():
+                    self.metrics.read_ahead_hits += 1
+            elif not fetcher.submit(timepoint):
+                self.metrics.discarded += 1
+
+        merged = {}
+        stale_tags = []
+        for agent, fetcher in self.fetchers.items():
+            remaining = max(0.0, started + fetcher.deadline - time.monotonic())
+            try:
+                readings, latency = fetcher.pending_future.result(timeout=remaining)
+                fetcher.collected = True
+            except FutureTimeoutError:
+                self.metrics.misses += 1
+                logger.warning("{} missed the {}s fetch deadline for {}, serving last good values".format(type(agent).__name__, fetcher.deadline, timepoint))
+                stale_tags.extend(fetcher.tags)
+                continue
+            except Exception as e:
+                fetcher.collected = True
+                self.metrics.failures += 1
+                logger.error("{} failed to fetch signals for {}: {}".format(type(agent).__name__, timepoint, e))
+                stale_tags.extend(fetcher.tags)
+                continue
+            self.metrics.record_fetch(latency)
+            fetcher.tags.update(readings)
+            merged.update(readings)
+
+        signal_store.merge(merged)
+        if stale_tags:
+            signal_store.mark([signal_store.slots[tag] for tag in stale_tags if tag in signal_store.slots], QUALITY_STALE)
+
+        if self.read_ahead_enabled and self.timestep is not None:
+            next_timepoint = timepoint + self.timestep
+            for fetcher in self.fetchers.values():
+                #an agent still busy with a late fetch is not queued up any further
+                if fetcher.pending_future.done() and not fetcher.submit(next_timepoint, self.pacer, self.data_delay):
+                    self.metrics.discarded += 1
+
+        if self.metrics_log_interval > 0 and time.monotonic() >= self.next_metrics_log:
+            logger.info("Retrieval metrics: {}".format(self.metrics.summary()))
+            self.next_metrics_log = time.monotonic() + self.metrics_log_interval
+
+    def close(self):
+        #read-ahead workers waiting on the pacer are released by its owner (DigitalTwin.close)
+        for fetcher in self.fetchers.values():
+            fetcher.shutdown()
+        if self.fetchers:
+            logger.info("Retrieval metrics: {}".format(self.metrics.summary()))
 
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    pass
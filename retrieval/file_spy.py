@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+File based stand-in for the subset of seeq.spy used by SeeqRetrieval
+
+Lets historical replays (and development without Seeq access) run offline from a csv
+export: first column holds timestamps, every other column holds the samples of one
+signal, named by its Data ID (the SignalTagName used in the signals configuration).
+"""
+import pandas as pd
+import logging
+logger = logging.getLogger(__name__)
+
+
+class FileSpy:
+    def __init__(self, data_path):
+        self.data_path = data_path
+        data = pd.read_csv(data_path, index_col=0)
+        data.index = pd.to_datetime(data.index)
+        self.data = data.sort_index()
+        logger.info("FileSpy loaded {} samples of {} signals from {}".format(len(self.data), len(self.data.columns), data_path))
+
+    def login(self, **kwargs):
+        pass
+
+    def search(self, query):
+        """returns an items frame for the requested Data ID, empty if the file has no such column"""
+        data_id = query.get('Data ID')
+        if data_id not in self.data.columns:
+            return pd.DataFrame(columns=['ID', 'Name', 'Datasource ID', 'Data ID'])
+        return pd.DataFrame({'ID': [data_id], 'Name': [data_id],
+                             'Datasource ID': [query.get('Datasource ID')], 'Data ID': [data_id]})
+
+    def pull(self, items, start, end, grid=None):
+        """
+        returns samples of items in [start, end]; with a grid, values are interpolated in
+        time onto the grid, mirroring how Seeq gridded pulls are used by SeeqRetrieval
+        """
+        columns = [name for name in items['Name'] if name in self.data.columns]
+        start = pd.Timestamp(start)
+        end = pd.Timestamp(end)
+        #keep one sample either side of the window so interpolation at its edges is possible
+        first = max(self.data.index.searchsorted(start) - 1, 0)
+        last = self.data.index.searchsorted(end, side='right') + 1
+        data = self.data.iloc[first:last][columns]
+        if grid is None:
+            return data.loc[start:end]
+        grid_index = pd.date_range(start.ceil(grid), end, freq=grid)
+        combined = data.reindex(data.index.union(grid_index))
+        combined = combined.interpolate(method='time', limit_area='inside')
+        return combined.reindex(grid_index)
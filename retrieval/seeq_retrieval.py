@@ -4,22 +4,100 @@ Created on Mon Jun 26 14:43:38 2023
 
 @author: doylef
 """
-from seeq import spy
+import numpy as np
 import pandas as pd
+from simulator.signal_store import SignalReading, QUALITY_GOOD, QUALITY_STALE, QUALITY_BAD
 import logging
 logger = logging.getLogger(__name__)
 
+
+class SeeqHistoryCache:
+    """
+    time indexed, columnar cache of prefetched Seeq samples: a sorted datetime64 array and a
+    (time x item) float64 matrix. Lookups return the latest row at or before a timepoint via
+    binary search; NaN samples are forward filled (across chunks too) when a chunk is loaded,
+    and the time of the sample each value was filled from is kept alongside, so that callers
+    can tell how old a value is.
+    """
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.column_index = {name: col for col, name in enumerate(self.columns)}
+        self.times = np.empty(0, dtype='datetime64[ns]')
+        self.values = np.empty((0, len(self.columns)), dtype=np.float64)
+        self.sample_times = np.empty((0, len(self.columns)), dtype='datetime64[ns]')
+        self.window_start = None
+        self.window_end = None
+        self.last_valid = np.full(len(self.columns), np.nan)
+        self.last_sample_time = np.full(len(self.columns), np.datetime64('NaT'), dtype='datetime64[ns]')
+
+    def covers(self, timepoint):
+        return self.window_start is not None and self.window_start <= timepoint <= self.window_end
+
+    def load(self, data, window_start, window_end):
+        """replaces the cached chunk with data pulled for [window_start, window_end]"""
+        data = data.reindex(columns=self.columns).sort_index()
+        values = data.to_numpy(dtype=np.float64, na_value=np.nan)
+        times = data.index.to_numpy(dtype='datetime64[ns]')
+        sample_times = np.where(np.isnan(values), np.datetime64('NaT'), times[:, None]).astype('datetime64[ns]')
+        if len(values):
+            values = pd.DataFrame(np.vstack((self.last_valid, values))).ffill().to_numpy()[1:]
+            sample_times = pd.DataFrame(np.vstack((self.last_sample_time, sample_times))).ffill().to_numpy(dtype='datetime64[ns]')[1:]
+            self.last_valid = values[-1].copy()
+            self.last_sample_time = sample_times[-1].copy()
+        self.times = times
+        self.values = values
+        self.sample_times = sample_times
+        self.window_start = window_start
+        self.window_end = window_end
+
+    def lookup(self, timepoint):
+        """
+        returns the row of item values at or before timepoint and the times of the samples they
+        were filled from (NaT for NaN values), or None if there is none
+        """
+        pos = np.searchsorted(self.times, np.datetime64(timepoint, 'ns'), side='right') - 1
+        if pos < 0:
+            return None
+        return self.values[pos], self.sample_times[pos]
+
+
 class SeeqRetrieval:
-    def __init__(self, config, signals_df):
-    
+    def __init__(self, config, signals_df, spy_client=None):
+        """
+        spy_client: object providing login/search/pull like seeq.spy; defaults to a FileSpy when
+        [Seeq] OfflineDataFile is configured, otherwise to seeq.spy itself
+        """
+        offline_data_file = config.get('Seeq', 'OfflineDataFile', fallback='').strip()
+        if spy_client is not None:
+            self.spy = spy_client
+        elif offline_data_file:
+            from retrieval.file_spy import FileSpy
+            self.spy = FileSpy(offline_data_file)
+        else:
+            from seeq import spy
+            self.spy = spy
+        spy = self.spy
+
         SeeqServerURL=config.get('Seeq', 'SeeqServerURL')
         SeeqUser=config.get('Seeq', 'SeeqUser')   
         SeeqPassword=config.get('Seeq', 'SeeqPassword')
         SeeqRequestOrigin=config.get('Seeq', 'SeeqRequestOrigin')
         spy.login(url=SeeqServerURL, username=SeeqUser, password=SeeqPassword,request_origin_label=SeeqRequestOrigin)
         
+        #prefetch mode pulls whole chunks of history for all items in one request and serves
+        #timesteps from the cache; intended for replays over historical periods
+        self.prefetch_enabled = config.get('Seeq', 'PrefetchEnabled', fallback='false').strip().lower() == 'true'
+        self.prefetch_chunk = pd.Timedelta(days=float(config.get('Seeq', 'PrefetchChunkDays', fallback='7')))
+        self.prefetch_grid = config.get('Seeq', 'PrefetchGrid', fallback='1min').strip()
+        #values forward filled from a sample older than this are served as stale
+        self.prefetch_max_sample_age = pd.Timedelta(minutes=float(config.get('Seeq', 'PrefetchMaxSampleAgeMinutes', fallback='15')))
+        self.tz = config.get('DEFAULT', 'bldg_tz', fallback=None)
+        self.history_cache = None
+
         self.signals_df = signals_df
         self.items = pd.DataFrame()
+        #(SignalTagName, row in self.items) for every seeq signal that Seeq could resolve
+        self.seeq_signals = []
         logger.info("SeeqRetrieval initilization, requesting Seeq items...")
         for idx in signals_df.index:
             if signals_df['SignalSource'][idx]=='seeq':
@@ -27,44 +105,100 @@ class SeeqRetrieval:
                     'Datasource ID' : signals_df['SourceId'][idx],
                     'Data ID' : signals_df['SignalTagName'][idx]
                     })
+                if len(new_items):
+                    self.seeq_signals.append((signals_df['SignalTagName'][idx], len(self.items)))
                 #self.items = self.items.append(new_items)
                 self.items = pd.concat([self.items, new_items], ignore_index=True)
         logger.info(self.items)
-       
-    def retrieve_signals_for_actuators_at_timepoint(self, signals_df, timepoint):
+        if self.prefetch_enabled:
+            self.history_cache = SeeqHistoryCache(self.items['Name'] if 'Name' in self.items else [])
+            #tag -> cache column, resolved once
+            self.signal_columns = [(tagname, self.history_cache.column_index[tagname])
+                                   for tagname, item_row in self.seeq_signals
+                                   if tagname in self.history_cache.column_index]
+
+    def prefetch(self, start, end):
+        """pulls [start, end] for all items in a single request into the history cache"""
+        logger.info("Prefetching Seeq history for {} items from {} to {}".format(len(self.items), start, end))
+        data = self.spy.pull(self.items, start=start, end=end, grid=self.prefetch_grid)
+        if data.index.tz is not None:
+            #simulation timepoints are naive building local times
+            data.index = data.index.tz_convert(self.tz).tz_localize(None)
+        self.history_cache.load(data, start, end)
+
+    def fetch_signals_at_timepoint(self, timepoint):
         """
-        function retrieves the physical building's signals of interest that will be used
-        to override EP simulation actuators, and places values in the appropriate dataframes.
+        function retrieves the physical building's signals of interest at timepoint and returns
+        them as a dict of SignalTagName -> SignalReading, without touching shared state, so that
+        CoreRetrieval can run it concurrently with other agents. Signals without a valid value
+        are reported with a NaN value and bad quality.
         """
+        if self.prefetch_enabled:
+            return self.fetch_from_history_cache(timepoint)
+        spy = self.spy
+        readings = {}
         #todo note - grid="1min" used to ensure return value. Some timepoints return no values without this
         #...seems to be a failure to interpolate by default? Need to talk to Seeq
         data = spy.pull(self.items, start=timepoint, end=timepoint, grid="1min")
-        for idx in signals_df.index:
-            curr_signal_tagname = signals_df['SignalTagName'][idx]
-            
+        for curr_signal_tagname, item_row in self.seeq_signals:
+            curr_signal_value = np.nan
             try:                
-                curr_signal_value = data[curr_signal_tagname][0]
-                #if the returned value is valid, set it in the dataframe
-                if not pd.isna(curr_signal_value):
-                    signals_df.iloc[idx, signals_df.columns.get_loc('current_val')] = curr_signal_value
-                #otherwise, try again for that specific signal
-                else:
+                curr_signal_value = data[curr_signal_tagname].iloc[0]
+                #if the returned value is invalid, try again for that specific signal
+                if pd.isna(curr_signal_value):
                     logger.warning("Signal {} returned NaN value at time {}, attempting retry".format(curr_signal_tagname, timepoint))
-                    retry_attempt = spy.pull(self.items[idx:idx+1], start=timepoint, end=timepoint, grid="1min")
-                    curr_signal_value = retry_attempt[curr_signal_tagname][0]
+                    retry_attempt = spy.pull(self.items[item_row:item_row+1], start=timepoint, end=timepoint, grid="1min")
+                    curr_signal_value = retry_attempt[curr_signal_tagname].iloc[0]
                     #if still invalid, default to last value
                     if pd.isna(curr_signal_value):
                         logger.warning("Warning - signal {} returned NaN value on second attempt at time {}, retaining setting as last valid".format(curr_signal_tagname, timepoint))
-                        curr_signal_value = -1
-                    #otherwise, set the valid value
-                    else:
-                        signals_df.iloc[idx, signals_df.columns.get_loc('current_val')] = curr_signal_value
 
-            except IndexError:
+            except (IndexError, KeyError):
                 #todo - better exception logic for lack of valid signal, and logging
                 #currently leaving last value in place (obviously this is prone to error)
                 logger.error("Unable to set signal for {} due to index error on Seeq pull results at time {}".format(curr_signal_tagname, timepoint))
-                   
-    
-        
-        
\ No newline at end of file
+            quality = QUALITY_BAD if pd.isna(curr_signal_value) else QUALITY_GOOD
+            readings[curr_signal_tagname] = SignalReading(float(curr_signal_value), quality, timepoint)
+        return readings
+
+    def fetch_from_history_cache(self, timepoint):
+        """prefetch mode counterpart of fetch_signals_at_timepoint"""
+        timepoint = pd.Timestamp(timepoint)
+        if not self.history_cache.covers(timepoint):
+            #the chunk starts one grid step before the timepoint's grid sample, so that it holds a
+            #sample at or before the timepoint however the grid is aligned
+            start = timepoint
+            if self.prefetch_grid:
+                step = pd.tseries.frequencies.to_offset(self.prefetch_grid)
+                start = timepoint.floor(step) - step
+            self.prefetch(start, timepoint + self.prefetch_chunk)
+        found = self.history_cache.lookup(timepoint)
+        if found is None:
+            logger.error("No prefetched Seeq samples at or before {}, retaining last values".format(timepoint))
+            return {}
+        row, sample_times = found
+        readings = {}
+        for tagname, col in self.signal_columns:
+            if np.isnan(row[col]):
+                logger.warning("Signal {} has no valid prefetched value at time {}, retaining setting as last valid".format(tagname, timepoint))
+                readings[tagname] = SignalReading(np.nan, QUALITY_BAD, timepoint)
+                continue
+            sample_time = pd.Timestamp(sample_times[col])
+            if timepoint - sample_time > self.prefetch_max_sample_age:
+                logger.warning("Signal {} has not reported since {}, serving its last value as stale at time {}".format(tagname, sample_time, timepoint))
+                readings[tagname] = SignalReading(float(row[col]), QUALITY_STALE, sample_time)
+            else:
+                readings[tagname] = SignalReading(float(row[col]), QUALITY_GOOD, timepoint)
+        return readings
+
+    def retrieve_signals_for_actuators_at_timepoint(self, signals_df, timepoint):
+        """
+        function retrieves the physical building's signals of interest that will be used
+        to override EP simulation actuators, and places values in the appropriate dataframes.
+        """
+        readings = self.fetch_signals_at_timepoint(timepoint)
+        value_col = signals_df.columns.get_loc('current_val')
+        for idx in signals_df.index:
+            reading = readings.get(signals_df['SignalTagName'][idx])
+            if reading is not None and not np.isnan(reading.value):
+                signals_df.iloc[idx, value_col] = reading.value
@@ -9,14 +9,60 @@ import pyenergyplus
 import sys
 import os
 import time
+import numpy as np
+import pandas as pd
 import datetime as dt
 from datetime import datetime
 #import conversion.conversion as reflect_conv
 import custom.conversion as reflect_conv
 import custom.callback as reflect_callbk
+from simulator.idf import ModelVariants
 import logging
 logger = logging.getLogger(__name__)
 
+#EnergyPlus runtime registration function for each callback stage that sensors, actuators and
+#custom functions can be bound to. begin_zone_timestep_before_init_heat_balance and
+#end_zone_timestep_after_zone_reporting drive the simulation time step logic and are always registered
+CALLBACK_STAGES = {
+    'begin_new_environment': 'callback_begin_new_environment',
+    'after_component_get_input': 'callback_after_component_get_input',
+    'after_new_environment_warmup_complete': 'callback_after_new_environment_warmup_complete',
+    'after_predictor_before_hvac_managers': 'callback_after_predictor_before_hvac_managers',
+    'after_predictor_after_hvac_managers': 'callback_after_predictor_after_hvac_managers',
+    'begin_system_timestep_before_predictor': 'callback_begin_system_timestep_before_predictor',
+    'begin_zone_timestep_after_init_heat_balance': 'callback_begin_zone_timestep_after_init_heat_balance',
+    'end_system_sizing': 'callback_end_system_sizing',
+    'end_system_timestep_after_hvac_reporting': 'callback_end_system_timestep_after_hvac_reporting',
+    'end_system_timestep_before_hvac_reporting': 'callback_end_system_timestep_before_hvac_reporting',
+    'end_zone_sizing': 'callback_end_zone_sizing',
+    'end_zone_timestep_before_zone_reporting': 'callback_end_zone_timestep_before_zone_reporting',
+    'inside_system_iteration_loop': 'callback_inside_system_iteration_loop',
+    'message': 'callback_message',
+    'progress': 'callback_progress',
+    'unitary_system_sizing': 'callback_unitary_system_sizing',
+}
+
+
+class StagePlan:
+    """
+    precompiled work for a single callback stage, built once all EP handles are resolved
+    so that the callbacks only iterate over what is actually bound to their stage.
+    Sensor slots index the sensor store (variables first, then meters, matching the order
+    values are read), actuator rows are positions in actuators_df and handles are the EP
+    exchange handles.
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self.sensor_slots = np.empty(0, dtype=np.int32)
+        self.variable_handles = ()
+        self.meter_handles = ()
+        self.actuator_rows = ()
+        self.actuator_handles = ()
+        self.custom_funcs = ()
+
+    def is_empty(self):
+        return not (len(self.sensor_slots) or self.actuator_rows or self.custom_funcs)
+
 
 class EpManager:
     def __init__(self, digital_twin):
@@ -26,152 +72,116 @@ class EpManager:
         self.ep_api = EnergyPlusAPI()
         self.ep_state = self.ep_api.state_manager.new_state()
         self.proceed_with_step_logic = False
+        #controls how simulation time is paced against the wall clock (realtime/scaled/fast)
+        self.pacer = digital_twin.pacer
         #print('calling api')
         #self.ep_api.runtime.callback_begin_zone_timestep_after_init_heat_balance(self.ep_state, self.ep_callback)
         
+        self.stage_plans = {}
+        #actuator row -> signal store slot gather index and bound conversion functions, resolved
+        #up front so that configuration errors surface before the simulation starts
+        self.actuator_signal_rows = None
+        self.actuator_conversions = ()
+        #(actuator row, fixed value) pairs overriding the signal derived values
+        self.actuator_overrides = ()
+        self.actuator_values = None
+        self.compile_actuator_signal_map()
+        #only stages that have sensors, actuators or custom functions bound to them in the
+        #configuration files are registered with EnergyPlus; the remaining callbacks would
+        #otherwise be invoked (many times per timestep in some cases) just to do nothing
+        self.bound_stages = self.find_bound_stages()
+
         # Register callbacks
-        self.ep_api.runtime.callback_begin_new_environment(self.ep_state, self.begin_new_environment)
-        self.ep_api.runtime.callback_after_component_get_input(self.ep_state, self.after_component_get_input)
-        self.ep_api.runtime.callback_after_new_environment_warmup_complete(self.ep_state, self.after_new_environment_warmup_complete)
         self.ep_api.runtime.callback_begin_zone_timestep_before_init_heat_balance(self.ep_state, self.begin_zone_timestep_before_init_heat_balance)
-
-        self.ep_api.runtime.callback_after_predictor_before_hvac_managers(self.ep_state, self.after_predictor_before_hvac_managers)
-        self.ep_api.runtime.callback_after_predictor_after_hvac_managers(self.ep_state, self.after_predictor_after_hvac_managers)
-        self.ep_api.runtime.callback_begin_system_timestep_before_predictor(self.ep_state, self.begin_system_timestep_before_predictor)
-        self.ep_api.runtime.callback_begin_zone_timestep_after_init_heat_balance(self.ep_state, self.begin_zone_timestep_after_init_heat_balance)
-        self.ep_api.runtime.callback_end_system_sizing(self.ep_state, self.end_system_sizing)
-        self.ep_api.runtime.callback_end_system_timestep_after_hvac_reporting(self.ep_state, self.end_system_timestep_after_hvac_reporting)
-        self.ep_api.runtime.callback_end_system_timestep_before_hvac_reporting(self.ep_state, self.end_system_timestep_before_hvac_reporting)
-        self.ep_api.runtime.callback_end_zone_sizing(self.ep_state, self.end_zone_sizing)
-        self.ep_api.runtime.callback_end_zone_timestep_before_zone_reporting(self.ep_state, self.end_zone_timestep_before_zone_reporting)
         self.ep_api.runtime.callback_end_zone_timestep_after_zone_reporting(self.ep_state, self.end_zone_timestep_after_zone_reporting)
-        self.ep_api.runtime.callback_inside_system_iteration_loop(self.ep_state, self.inside_system_iteration_loop)
-        self.ep_api.runtime.callback_message(self.ep_state, self.message)
-        self.ep_api.runtime.callback_progress(self.ep_state, self.progress)
-        self.ep_api.runtime.callback_unitary_system_sizing(self.ep_state, self.unitary_system_sizing)
+        for stage, registration_func in CALLBACK_STAGES.items():
+            if stage in self.bound_stages:
+                logger.info("Registering EnergyPlus callback for bound stage {}".format(stage))
+                getattr(self.ep_api.runtime, registration_func)(self.ep_state, getattr(self, stage))
 
 
         self.custom_input_file_path = os.path.join(self.dtwin.working_directory, 'dt_in.idf') 
+        #the building model is parsed once and held in memory for writing dt_in.idf and other variants
+        self.model_variants = ModelVariants(self.config.get('ENERGYPLUS', 'EPBuildingModel'))
         self.simulation_datetime = None
+        #progress of the run, read by the orchestrator's heartbeat (see orchestrator.py); paced_until
+        #is the wall clock time (time.time()) the current timestep is due while the pacer holds it back
+        self.timesteps_completed = 0
+        self.paced_until = None
 
     def begin_new_environment(self, state):
         #print("#callback_begin_new_environment called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("begin_new_environment")
-            self.run_custom("begin_new_environment")
-            self.collectSensorData("begin_new_environment")
+        self.run_stage("begin_new_environment")
         return
 
     def after_component_get_input(self, state):
         #print("#callback_after_component_get_input called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("after_component_get_input")
-            self.run_custom("after_component_get_input")
-            self.collectSensorData("after_component_get_input")
+        self.run_stage("after_component_get_input")
         return
 
     def after_new_environment_warmup_complete(self, state):
         #print("#callback_after_new_environment_warmup_complete called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("after_new_environment_warmup_complete")
-            self.run_custom("after_new_environment_warmup_complete")
-            self.collectSensorData("after_new_environment_warmup_complete")
+        self.run_stage("after_new_environment_warmup_complete")
         return
 
     def after_predictor_after_hvac_managers(self, state):
         #print("#callback_after_predictor_after_hvac_managers called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("after_predictor_after_hvac_managers")
-            self.run_custom("after_predictor_after_hvac_managers")
-            self.collectSensorData("after_predictor_after_hvac_managers")
+        self.run_stage("after_predictor_after_hvac_managers")
         return
 
     def begin_system_timestep_before_predictor(self, state):
         #print("#callback_begin_system_timestep_before_predictor called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("begin_system_timestep_before_predictor")
-            self.run_custom("begin_system_timestep_before_predictor")
-            self.collectSensorData("begin_system_timestep_before_predictor")
+        self.run_stage("begin_system_timestep_before_predictor")
         return
 
     def begin_zone_timestep_after_init_heat_balance(self, state):
         #print("#callback_begin_zone_timestep_after_init_heat_balance called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("begin_zone_timestep_after_init_heat_balance")
-            self.run_custom("begin_zone_timestep_after_init_heat_balance")
-            self.collectSensorData("begin_zone_timestep_after_init_heat_balance")
+        self.run_stage("begin_zone_timestep_after_init_heat_balance")
         return
 
     def end_system_sizing(self, state):
         #print("#callback_end_system_sizing called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("end_system_sizing")
-            self.run_custom("end_system_sizing")
-            self.collectSensorData("end_system_sizing")
+        self.run_stage("end_system_sizing")
         return
 
     def end_system_timestep_after_hvac_reporting(self, state):
         #print("#callback_end_system_timestep_after_hvac_reporting called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("end_system_timestep_after_hvac_reporting")
-            self.run_custom("end_system_timestep_after_hvac_reporting")
-            self.collectSensorData("end_system_timestep_after_hvac_reporting")
+        self.run_stage("end_system_timestep_after_hvac_reporting")
         return
 
     def end_system_timestep_before_hvac_reporting(self, state):
         #print("#callback_end_system_timestep_before_hvac_reporting called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("end_system_timestep_before_hvac_reporting")
-            self.run_custom("end_system_timestep_before_hvac_reporting")
-            self.collectSensorData("end_system_timestep_before_hvac_reporting")
+        self.run_stage("end_system_timestep_before_hvac_reporting")
         return
 
     def end_zone_sizing(self, state):
         #print("#callback_end_zone_sizing called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("end_zone_sizing")
-            self.run_custom("end_zone_sizing")
-            self.collectSensorData("end_zone_sizing")
+        self.run_stage("end_zone_sizing")
         return
 
     def end_zone_timestep_before_zone_reporting(self, state):
         #print("#callback_end_zone_timestep_before_zone_reporting called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("end_zone_timestep_before_zone_reporting")
-            self.run_custom("end_zone_timestep_before_zone_reporting")
-            self.collectSensorData("end_zone_timestep_before_zone_reporting")
+        self.run_stage("end_zone_timestep_before_zone_reporting")
         return
 
     def inside_system_iteration_loop(self, state):
         #print("#callback_inside_system_iteration_loop called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("inside_system_iteration_loop")
-            self.run_custom("inside_system_iteration_loop")
-            self.collectSensorData("inside_system_iteration_loop")
+        self.run_stage("inside_system_iteration_loop")
         return
 
     def message(self, state):
         #print("#callback_message called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("message")
-            self.run_custom("message")
-            self.collectSensorData("message")
+        self.run_stage("message")
         return
 
     def progress(self, state):
         #print("#callback_progress called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("progress")
-            self.run_custom("progress")
-            self.collectSensorData("progress")
+        self.run_stage("progress")
         return
 
     def unitary_system_sizing(self, state):
         #print("#callback_unitary_system_sizing called#")
-        if self.proceed_with_step_logic:
-            self.setActuators("unitary_system_sizing")
-            self.run_custom("unitary_system_sizing")
-            self.collectSensorData("unitary_system_sizing")
+        self.run_stage("unitary_system_sizing")
         return
 
     def setCurrentSimulationTime(self):
@@ -199,45 +209,88 @@ class EpManager:
         self.simulation_datetime = dtime
      
     def collectSensorData(self, timepoint):
-        for idx in self.dtwin.sensors_df.index:
-            curr_sensor_handle = self.dtwin.sensors_df['ep_handle'][idx]
-            if self.dtwin.sensors_df['Read_stage'][idx] == timepoint:
-                if self.dtwin.sensors_df['Type'][idx] == 'sensor':
-                    value =  self.ep_api.exchange.get_variable_value(self.ep_state, curr_sensor_handle)
-                    self.dtwin.sensors_df.iloc[idx, self.dtwin.sensors_df.columns.get_loc('current_val')] = value
-                elif self.dtwin.sensors_df['Type'][idx] == 'meter':
-                    value =  self.ep_api.exchange.get_meter_value(self.ep_state, curr_sensor_handle)
-                    self.dtwin.sensors_df.iloc[idx, self.dtwin.sensors_df.columns.get_loc('current_val')] = value
-    '''
-    def get_actuator_values_by_signals(self):
-        self.dtwin.get_signals_for_timepoint(self.simulation_datetime)
-        for idx in self.dtwin.signals_df.index:
-            curr_signal_tagname = self.dtwin.signals_df['SignalTagName'][idx]
-            curr_signal_value = self.dtwin.signals_df['current_val'][idx]
-            curr_conversion =  self.dtwin.signals_df['conversion_func'][idx] 
-            if curr_conversion != "none":
-                conversion_func = getattr(reflect_conv, curr_conversion)
-                curr_signal_value = conversion_func(self.config, self.simulation_datetime, curr_signal_value)
-            self.dtwin.actuators_df.loc[self.dtwin.actuators_df['SourceTagName'] == curr_signal_tagname, 'current_val'] = curr_signal_value
-    '''
+        plan = self.stage_plans.get(timepoint)
+        if plan is None:
+            return
+        if not len(plan.sensor_slots):
+            return
+        get_variable_value = self.ep_api.exchange.get_variable_value
+        get_meter_value = self.ep_api.exchange.get_meter_value
+        values = [get_variable_value(self.ep_state, handle) for handle in plan.variable_handles]
+        values += [get_meter_value(self.ep_state, handle) for handle in plan.meter_handles]
+        #single vectorized write into the sensor store for the whole stage
+        self.dtwin.sensor_store.write(plan.sensor_slots, values)
+
+    def compile_actuator_signal_map(self):
+        """
+        resolves, once, the signal feeding each actuator and its conversion function.
+        Raises ValueError listing every actuator whose SourceTagName is not a known signal
+        or whose ConversionFunction does not exist in custom.conversion
+        """
+        signal_rows = self.dtwin.signal_store.slots
+        actuators_df = self.dtwin.actuators_df
+
+        gather_rows = []
+        conversions = []
+        errors = []
+        for row in range(len(actuators_df)):
+            curr_source_tagname = actuators_df['SourceTagName'].iloc[row]
+            curr_conversion = actuators_df['ConversionFunction'].iloc[row]
+            if curr_source_tagname not in signal_rows:
+                errors.append("actuator row {} references unknown signal '{}'".format(row, curr_source_tagname))
+                continue
+            gather_rows.append(signal_rows[curr_source_tagname])
+            if not pd.isna(curr_conversion) and curr_conversion != "none":
+                conversion_func = getattr(reflect_conv, str(curr_conversion), None)
+                if not callable(conversion_func):
+                    errors.append("actuator row {} references unknown conversion function '{}'".format(row, curr_conversion))
+                    continue
+                conversions.append((row, conversion_func))
+        overrides = []
+        overrides_df = self.dtwin.actuator_overrides_df
+        if overrides_df is not None:
+            actuator_keys = {}
+            for row, key in enumerate(zip(actuators_df['ActuatorCategory'], actuators_df['ActuatorName'], actuators_df['ActuatorInstance'])):
+                actuator_keys.setdefault(tuple(str(part).strip().lower() for part in key), []).append(row)
+            for category, name, instance, value in overrides_df[['ActuatorCategory', 'ActuatorName', 'ActuatorInstance', 'Value']].itertuples(index=False):
+                rows = actuator_keys.get(tuple(str(part).strip().lower() for part in (category, name, instance)))
+                if rows is None:
+                    errors.append("actuator override references unknown actuator '{}', '{}', '{}'".format(category, name, instance))
+                    continue
+                overrides.extend((row, float(value)) for row in rows)
+        if errors:
+            raise ValueError("Invalid actuator configuration: " + "; ".join(errors))
+
+        self.actuator_signal_rows = np.asarray(gather_rows, dtype=np.intp)
+        self.actuator_conversions = tuple(conversions)
+        self.actuator_overrides = tuple(overrides)
+        self.actuator_values = actuators_df['current_val'].to_numpy(dtype=np.float64)
+
     def get_actuator_values_by_signals(self):
         self.dtwin.get_signals_for_timepoint(self.simulation_datetime)
-        for idx in self.dtwin.actuators_df.index:
-            curr_source_tagname = self.dtwin.actuators_df['SourceTagName'][idx]
-            curr_conversion =  self.dtwin.actuators_df['ConversionFunction'][idx] 
-            curr_signal_value = self.dtwin.signals_df.loc[self.dtwin.signals_df['SignalTagName'] == curr_source_tagname, 'current_val'].iloc[0]
-            if curr_conversion != "none":
-                conversion_func = getattr(reflect_conv, curr_conversion)
-                curr_signal_value = conversion_func(self.config, self.simulation_datetime, curr_signal_value)
-            self.dtwin.actuators_df.iloc[idx , self.dtwin.actuators_df.columns.get_loc('current_val')] = curr_signal_value    
+        #gather every actuator's source signal in one go, then apply the bound conversions
+        actuator_values = self.dtwin.signal_store.values[self.actuator_signal_rows]
+        for row, conversion_func in self.actuator_conversions:
+            actuator_values[row] = conversion_func(self.config, self.simulation_datetime, actuator_values[row])
+        for row, value in self.actuator_overrides:
+            actuator_values[row] = value
+        self.actuator_values = actuator_values
+        self.dtwin.actuators_df['current_val'] = actuator_values
 
 
     def setActuators(self, timepoint):
-            for idx in self.dtwin.actuators_df.index:
-                if self.dtwin.actuators_df['Override_stage'][idx] == timepoint:
-                    print("calling api to set actuator with(state, {},{} at {})".format(self.dtwin.actuators_df['ep_handle'][idx], self.dtwin.actuators_df['current_val'][idx], timepoint))
-                    self.ep_api.exchange.set_actuator_value(self.ep_state, self.dtwin.actuators_df['ep_handle'][idx], self.dtwin.actuators_df['current_val'][idx])
-                    
+        plan = self.stage_plans.get(timepoint)
+        if plan is None or not plan.actuator_rows:
+            return
+        set_actuator_value = self.ep_api.exchange.set_actuator_value
+        current_vals = self.actuator_values
+        #checked once per call rather than formatting a message per actuator on this hot path
+        if logger.isEnabledFor(logging.DEBUG):
+            for row, handle in zip(plan.actuator_rows, plan.actuator_handles):
+                logger.debug("calling api to set actuator with(state, %s,%s at %s)", handle, current_vals[row], timepoint)
+        for row, handle in zip(plan.actuator_rows, plan.actuator_handles):
+            set_actuator_value(self.ep_state, handle, current_vals[row])
+
     def set_actuator_handles(self):
         for idx in self.dtwin.actuators_df.index:
             curr_actuator_category = self.dtwin.actuators_df['ActuatorCategory'][idx]
@@ -253,17 +306,18 @@ class EpManager:
             return True
         
     def set_sensor_handles(self):
-        for idx in self.dtwin.sensors_df.index:
-            curr_sensor_name = self.dtwin.sensors_df['SensorName'][idx]
-            curr_sensor_instance = self.dtwin.sensors_df['SensorInstance'][idx]
-            curr_sensor_type = self.dtwin.sensors_df['Type'][idx]
+        sensor_store = self.dtwin.sensor_store
+        for slot in range(len(sensor_store)):
+            curr_sensor_name = sensor_store.metadata['SensorName'][slot]
+            curr_sensor_instance = sensor_store.metadata['SensorInstance'][slot]
+            curr_sensor_type = sensor_store.metadata['Type'][slot]
             if  curr_sensor_type == 'sensor':
-                self.dtwin.sensors_df.iloc[idx, self.dtwin.sensors_df.columns.get_loc('ep_handle')] = self.ep_api.exchange.get_variable_handle(self.ep_state, curr_sensor_name, curr_sensor_instance)
+                sensor_store.handles[slot] = self.ep_api.exchange.get_variable_handle(self.ep_state, curr_sensor_name, curr_sensor_instance)
             elif curr_sensor_type == 'meter':
-                self.dtwin.sensors_df.iloc[idx, self.dtwin.sensors_df.columns.get_loc('ep_handle')] = self.ep_api.exchange.get_meter_handle(self.ep_state, curr_sensor_name)
+                sensor_store.handles[slot] = self.ep_api.exchange.get_meter_handle(self.ep_state, curr_sensor_name)
             
-            print(self.dtwin.sensors_df)
-        if -1 in self.dtwin.sensors_df['ep_handle'].values:
+        print(sensor_store.frame())
+        if -1 in sensor_store.handles:
             return False
         else:
             return True
@@ -283,17 +337,17 @@ class EpManager:
                     
                     self.ep_api.runtime.stop_simulation(self.ep_state)
                     sys.exit(1)
+                self.compile_stage_plans()
         elif self.ep_api.exchange.warmup_flag(self.ep_state):
             return
           
         else:
 
             self.setCurrentSimulationTime()
-            #todo make this buffer period configurable and put in 
-            time_buffer = dt.timedelta()
-            time_buffer = dt.timedelta(minutes=5)
-            while datetime.now() < (self.simulation_datetime + time_buffer):
-                time.sleep(5)
+            #wait until this timestep is due according to the configured pacing mode
+            self.paced_until = time.time() + max(self.pacer.seconds_until(self.simulation_datetime), 0.0)
+            self.pacer.wait(self.simulation_datetime)
+            self.paced_until = None
             #as this is the first callback per simulation iteration
             #perform the following two lines that affect the rest of the callbacks
             self.proceed_with_step_logic = True
@@ -309,75 +363,100 @@ class EpManager:
             
             
     def run_custom(self, timeperiod):
-        #custom_callbacks_df
-        for idx in self.dtwin.custom_callbacks_df.index:
-            curr_row_timeperiod = self.dtwin.custom_callbacks_df['TimePeriod'][idx]
-            #print(curr_row_timeperiod)
-            if  curr_row_timeperiod == timeperiod:
-                curr_callback = self.dtwin.custom_callbacks_df['Function'][idx]
-                custom_func = getattr(reflect_callbk, curr_callback)
-                custom_func(self.dtwin)
-        
+        plan = self.stage_plans.get(timeperiod)
+        if plan is None:
+            return
+        for custom_func in plan.custom_funcs:
+            custom_func(self.dtwin)
+
+    def run_stage(self, stage):
+        """
+        common body of the stage callbacks: override actuators, run custom functions
+        and collect sensors bound to the stage, using the precompiled stage plan
+        """
+        if self.proceed_with_step_logic:
+            self.setActuators(stage)
+            self.run_custom(stage)
+            self.collectSensorData(stage)
+
     def after_predictor_before_hvac_managers(self, state):
         #print("#after_predictor_before_hvac_managers called#")
-        if self.proceed_with_step_logic:
-            pass
-        else:
-            return       
-            
+        self.run_stage("after_predictor_before_hvac_managers")
+        return
+
+    def find_bound_stages(self):
+        """
+        returns the set of callback stages referenced by the sensor, actuator or custom
+        function configuration, i.e. the stages for which a callback has any work to do
+        """
+        bound_stages = set(self.dtwin.sensor_store.metadata['Read_stage'])
+        bound_stages.update(self.dtwin.actuators_df['Override_stage'])
+        bound_stages.update(self.dtwin.custom_callbacks_df['TimePeriod'])
+        return bound_stages
+
+    def compile_stage_plans(self):
+        """
+        builds a StagePlan for every bound stage from the dataframes; must be called once
+        handles have been resolved. Custom functions are resolved here as well so that an
+        unknown function name is reported at startup rather than mid-run
+        """
+        sensor_store = self.dtwin.sensor_store
+        actuators_df = self.dtwin.actuators_df
+        custom_df = self.dtwin.custom_callbacks_df
+
+        sensor_types = sensor_store.metadata['Type'].to_numpy()
+        actuator_stages = actuators_df['Override_stage'].to_numpy()
+        actuator_handles = actuators_df['ep_handle'].to_numpy()
+
+        stage_plans = {}
+        for stage in self.bound_stages:
+            plan = StagePlan(stage)
+            variable_slots = sensor_store.stage_slots('Read_stage', stage, sensor_types == 'sensor')
+            meter_slots = sensor_store.stage_slots('Read_stage', stage, sensor_types == 'meter')
+            actuator_rows = [row for row in range(len(actuators_df)) if actuator_stages[row] == stage]
+            plan.sensor_slots = np.concatenate((variable_slots, meter_slots))
+            plan.variable_handles = tuple(int(handle) for handle in sensor_store.handles[variable_slots])
+            plan.meter_handles = tuple(int(handle) for handle in sensor_store.handles[meter_slots])
+            plan.actuator_rows = tuple(actuator_rows)
+            plan.actuator_handles = tuple(int(actuator_handles[row]) for row in actuator_rows)
+            plan.custom_funcs = tuple(getattr(reflect_callbk, func_name) for func_name in
+                                      custom_df.loc[custom_df['TimePeriod'] == stage, 'Function'])
+            if not plan.is_empty():
+                stage_plans[stage] = plan
+        self.stage_plans = stage_plans
+        logger.info("Compiled stage plans for stages: {}".format(sorted(stage_plans)))
+
     def end_zone_timestep_after_zone_reporting(self, state):
         #print("#end_zone_timestep_after_zone_reporting called#")
         if self.proceed_with_step_logic:
             self.setActuators("end_zone_timestep_after_zone_reporting")
             self.collectSensorData("end_zone_timestep_after_zone_reporting")
             self.dtwin.store_simulated_signals(self.simulation_datetime)
+            self.timesteps_completed += 1
         else:
             return
 
                   
     def prep_input_file_for_simulation(self):
         '''
-        overrides the building model idf file RunPeriod to match requested time period 
-        inefficient...look for better way to do this via API
+        writes the building model with the digital twin's field overrides (e.g. the RunPeriod matching
+        the requested time period) to dt_in.idf; skipped when dt_in.idf was already prepared from the
+        same model and overrides
         '''
-        with open(self.config.get('ENERGYPLUS', 'EPBuildingModel'), 'rt') as base_input_model_file:
-            with open(self.custom_input_file_path, 'wt') as custom_input_model_file:
-                for line in base_input_model_file: 
-
-                    found_eof = False        
-                    while not found_eof:
-                        line = base_input_model_file.readline()
-                        if not line:
-                            found_eof = True
-                        else:
-                            if line.startswith('RunPeriod'):
-                                custom_input_model_file.write(line)
-                                #should not find eof before close of section, but just in case...
-                                while not ';' in line and not found_eof:
-                                    line = base_input_model_file.readline()
-                                    if not line:
-                                        found_eof = True
-                                        break
-                                    else:
-                                        found_key = False
-                                        for key in self.dtwin.override_map.keys():
-                                            if key in line:
-                                                custom_input_model_file.write(self.dtwin.override_map[key])
-                                                found_key = True
-                                                break
-                                        if not found_key:
-                                            custom_input_model_file.write(line)
-                                      
-                            else:
-                                custom_input_model_file.write(line)
-                                
+        self.write_model_variant(self.custom_input_file_path, self.dtwin.idf_overrides)
 
+    def write_model_variant(self, output_path, overrides):
+        '''
+        writes the building model with a list of IdfOverride applied to output_path; the base model
+        is only parsed for the first variant. Returns True if output_path was already up to date
+        '''
+        return self.model_variants.write(output_path, overrides)
 
-            
     def invoke_simulation(self):
         self.prep_input_file_for_simulation();
-        for idx in self.dtwin.sensors_df.index:
-            self.ep_api.exchange.request_variable(self.ep_state, self.dtwin.sensors_df['SensorName'][idx], self.dtwin.sensors_df['SensorInstance'][idx])
+        sensor_metadata = self.dtwin.sensor_store.metadata
+        for idx in sensor_metadata.index:
+            self.ep_api.exchange.request_variable(self.ep_state, sensor_metadata['SensorName'][idx], sensor_metadata['SensorInstance'][idx])
            
         self.ep_api.runtime.run_energyplus(self.ep_state,
                                    [
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+Single pass IDF tokenizer and field level patcher for EnergyPlus building models
+
+IdfModel.parse locates the objects of a model (comma separated fields terminated by ';',
+'!' comments to the end of the line) and their types in one pass; the fields of an object
+are only tokenized, recording where every value sits in the original text, once it is
+looked up. serialize then writes the model with overridden field values spliced in,
+leaving every untouched byte (comments, layout, line endings) as it was.
+
+Fields are addressed per object by index, 0 being the first field after the object type
+(the name of named objects), or by the name given in the field's '!- ' comment. Overrides
+can be listed in a csv file (see read_overrides), and ModelVariants keeps a parsed base
+model in memory to write many variants of it, e.g. for a fleet of twins or a sweep.
+"""
+import hashlib
+import json
+import os
+import re
+from collections import namedtuple
+import pandas as pd
+import logging
+logger = logging.getLogger(__name__)
+
+#object_name '*' matches every object of object_type; field is an index or a field name
+IdfOverride = namedtuple('IdfOverride', ['object_type', 'object_name', 'field', 'value'])
+
+#columns of a declarative override file, see read_overrides
+OVERRIDE_COLUMNS = ('ObjectType', 'ObjectName', 'Field', 'Value')
+
+#bumped whenever parsing or serialization changes, so cached prepared models are rebuilt
+IDF_FORMAT_VERSION = 2
+
+#a comment to the end of the line, a field separator or a run of field text
+_TOKENS = re.compile(r'!([^\n]*)|([,;])|[^,;!]+')
+#an object terminator, or the start of a comment (which may contain ';')
+_BOUNDARIES = re.compile(r'[;!]')
+#the object type: the first field, after any whitespace and comments
+_OBJECT_TYPE = re.compile(r'(?:\s|![^\n]*)*([^,;!]*)')
+#units in field names, e.g. 'X Origin {m}', which are not needed to address the field
+_UNITS = re.compile(r'\s*\{[^}]*\}')
+
+
+def _field_key(name):
+    return _UNITS.sub('', name).strip().lower()
+
+
+class IdfObject:
+    """
+    one object of a model, located by its span in the model text. Its fields, as (value, start,
+    end) offsets into the model text, and the field names found in '!- ' comments are only
+    tokenized when first needed, so that objects which are never looked at cost nothing
+    """
+    __slots__ = ('text', 'start', 'end', 'object_type', '_fields', '_field_names')
+
+    def __init__(self, text, start, end, object_type):
+        self.text = text
+        self.start = start
+        #offset of the terminating ';'
+        self.end = end
+        self.object_type = object_type
+        self._fields = None
+        self._field_names = None
+
+    def tokenize(self):
+        text = self.text
+        fields = []
+        field_names = {}
+        value_start = None
+        value_end = None
+        #field ended by the last separator seen, which a '!- ' comment on the same line names
+        named_field = None
+        #include the rest of the terminator's line, which may hold the last field's name
+        line_end = text.find('\n', self.end)
+        stop = len(text) if line_end < 0 else line_end
+        for match in _TOKENS.finditer(text, self.start, stop):
+            comment, separator = match.group(1), match.group(2)
+            if comment is not None:
+                #the object type (fields[0]) is never named, e.g. 'Timestep,4;  !- Number of Timesteps per Hour'
+                if (named_field is not None and named_field[0] > 0 and comment.startswith('-')
+                        and text.find('\n', named_field[1], match.start()) < 0):
+                    field_names.setdefault(_field_key(comment[1:]), named_field[0])
+                named_field = None
+                continue
+            if match.start() > self.end:
+                #past the terminator only the trailing comment is of interest
+                continue
+            if separator is None:
+                chunk = match.group(0)
+                if chunk.strip():
+                    if value_start is None:
+                        value_start = match.start() + len(chunk) - len(chunk.lstrip())
+                    value_end = match.start() + len(chunk.rstrip())
+                continue
+            if value_start is None:
+                #an empty field is located at its separator, where a value can be inserted
+                fields.append(('', match.start(), match.start()))
+            else:
+                fields.append((text[value_start:value_end], value_start, value_end))
+            named_field = (len(fields) - 1, match.end())
+            value_start = value_end = None
+        self._fields = fields
+        self._field_names = field_names
+
+    @property
+    def fields(self):
+        """(value, start, end) of every field, the object type being field 0"""
+        if self._fields is None:
+            self.tokenize()
+        return self._fields
+
+    @property
+    def field_names(self):
+        """field name (lower case, without units) -> position in fields"""
+        if self._field_names is None:
+            self.tokenize()
+        return self._field_names
+
+    @property
+    def name(self):
+        return self.fields[1][0] if len(self.fields) > 1 else ''
+
+    def field_index(self, field):
+        """index (0 = first field after the object type) of a field given by index or name"""
+        if isinstance(field, int):
+            return field
+        field = str(field).strip()
+        if field.lstrip('-').isdigit():
+            return int(field)
+        index = self.field_names.get(_field_key(field))
+        return None if index is None else index - 1
+
+    def value(self, field):
+        index = self.field_index(field)
+        if index is None or index < 0 or index + 1 >= len(self.fields):
+            return None
+        return self.fields[index + 1][0]
+
+
+class IdfModel:
+    def __init__(self, text, objects):
+        self.text = text
+        self.objects = objects
+        self.by_type = {}
+        for obj in objects:
+            self.by_type.setdefault(obj.object_type.lower(), []).append(obj)
+
+    @classmethod
+    def parse(cls, text):
+        """locates every object and its type in one pass over the text"""
+        objects = []
+        search = _BOUNDARIES.search
+        match_type = _OBJECT_TYPE.match
+        find = text.find
+        position = start = 0
+        while True:
+            match = search(text, position)
+            if match is None:
+                break
+            if match.group() == '!':
+                line_end = find('\n', match.end())
+                position = len(text) if line_end < 0 else line_end
+                continue
+            object_type = match_type(text, start, match.start()).group(1).strip()
+            objects.append(IdfObject(text, start, match.start(), object_type))
+            start = position = match.end()
+        return cls(text, objects)
+
+    @classmethod
+    def read(cls, path):
+        #latin-1 maps every byte to one character, so offsets and untouched bytes survive as is
+        with open(path, 'rb') as model_file:
+            return cls.parse(model_file.read().decode('latin-1'))
+
+    def find(self, object_type, object_name='*'):
+        objects = self.by_type.get(str(object_type).strip().lower(), [])
+        if object_name is None or str(object_name).strip() in ('', '*'):
+            return objects
+        object_name = str(object_name).strip().lower()
+        return [obj for obj in objects if obj.name.lower() == object_name]
+
+    def resolve(self, overrides):
+        """
+        maps overrides to {object: {field index: value}}; later overrides of the same field win.
+        Overrides matching no object or field are reported and skipped
+        """
+        edits = {}
+        for override in overrides:
+            objects = self.find(override.object_type, override.object_name)
+            if not objects:
+                logger.warning("No IDF object {} {} for override of field {}".format(override.object_type, override.object_name, override.field))
+                continue
+            for obj in objects:
+                index = obj.field_index(override.field)
+                if index is None or index < 0:
+                    logger.warning("IDF object {} {} has no field {}".format(obj.object_type, obj.name, override.field))
+                    continue
+                edits.setdefault(obj, {})[index] = str(override.value).strip()
+        return edits
+
+    def serialize(self, overrides=()):
+        """returns the model text with the overrides applied"""
+        splices = []
+        for obj, values in self.resolve(overrides).items():
+            tail = []
+            for index, value in values.items():
+                if index + 1 < len(obj.fields):
+                    _, start, end = obj.fields[index + 1]
+                    splices.append((start, end, value))
+                else:
+                    tail.append((index, value))
+            if tail:
+                #fields beyond the object's last one are appended, with empty fields in between
+                tail_values = dict(tail)
+                last = max(tail_values)
+                text = ''.join(',' + tail_values.get(index, '') for index in range(len(obj.fields) - 1, last + 1))
+                splices.append((obj.end, obj.end, text))
+        splices.sort(key=lambda splice: splice[0])
+        pieces = []
+        position = 0
+        for start, end, value in splices:
+            pieces.append(self.text[position:start])
+            pieces.append(value)
+            position = end
+        pieces.append(self.text[position:])
+        return ''.join(pieces)
+
+    def write(self, path, overrides=()):
+        with open(path, 'wb') as model_file:
+            model_file.write(self.serialize(overrides).encode('latin-1'))
+
+
+def read_overrides(path):
+    """
+    reads a declarative override file, one override per row with the columns ObjectType,
+    ObjectName ('*' or empty for every object of the type), Field (index or name) and Value
+    """
+    overrides_df = pd.read_csv(path, dtype=str, keep_default_na=False, skipinitialspace=True)
+    missing = [column for column in OVERRIDE_COLUMNS if column not in overrides_df.columns]
+    if missing:
+        raise ValueError("IDF overrides file {} lacks the columns {}".format(path, missing))
+    overrides = []
+    for object_type, object_name, field, value in overrides_df[list(OVERRIDE_COLUMNS)].itertuples(index=False):
+        if not object_type.strip():
+            continue
+        overrides.append(IdfOverride(object_type.strip(), object_name.strip() or '*', field.strip(), value))
+    return overrides
+
+
+class ModelVariants:
+    """
+    a base model read and parsed once and held in memory, from which any number of variants
+    (the base model with a list of overrides) are written at the cost of a serialization each.
+    A variant file is only rewritten when the base model or its overrides changed since it was
+    written, as recorded by the sha256 in the output_path + '.sha256' sidecar
+    """
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self._stat = None
+        self._text = None
+        self._digest = None
+        self._model = None
+
+    def _load(self):
+        #the base model is re-read if it was modified on disk
+        stat = os.stat(self.base_path)
+        if (stat.st_size, stat.st_mtime_ns) != self._stat:
+            with open(self.base_path, 'rb') as base_file:
+                base = base_file.read()
+            self._digest = hashlib.sha256(base)
+            self._text = base.decode('latin-1')
+            self._model = None
+            self._stat = (stat.st_size, stat.st_mtime_ns)
+
+    @property
+    def model(self):
+        self._load()
+        if self._model is None:
+            self._model = IdfModel.parse(self._text)
+        return self._model
+
+    def key(self, overrides):
+        """sha256 identifying a variant: the base model, the overrides and the format version"""
+        self._load()
+        digest = self._digest.copy()
+        digest.update(json.dumps([IDF_FORMAT_VERSION] + [list(map(str, override)) for override in overrides]).encode('utf-8'))
+        return digest.hexdigest()
+
+    def write(self, output_path, overrides):
+        """writes the variant to output_path unless it is already there; returns True when it was"""
+        key = self.key(overrides)
+        sidecar_path = output_path + '.sha256'
+        if os.path.exists(output_path) and os.path.exists(sidecar_path):
+            with open(sidecar_path, 'rt') as sidecar_file:
+                if sidecar_file.read().strip() == key:
+                    logger.info("Reusing prepared model {}".format(output_path))
+                    return True
+        #the sidecar is removed first, so an interrupted write is never taken for a cached model
+        if os.path.exists(sidecar_path):
+            os.remove(sidecar_path)
+        self.model.write(output_path, overrides)
+        with open(sidecar_path, 'wt') as sidecar_file:
+            sidecar_file.write(key)
+        logger.info("Prepared model {} from {} with {} overrides".format(output_path, self.base_path, len(overrides)))
+        return False
+
+
+def prepare_model(base_path, output_path, overrides):
+    """writes base_path with overrides applied to output_path, see ModelVariants.write"""
+    return ModelVariants(base_path).write(output_path, overrides)
+
+
+if __name__ == "__main__":
+    #parse and patch timing of a building model: python -m simulator.idf model.idf
+    import sys
+    import time
+    with open(sys.argv[1], 'rb') as model_file:
+        text = model_file.read().decode('latin-1')
+    start = time.perf_counter()
+    model = IdfModel.parse(text)
+    parsed = time.perf_counter()
+    run_period = [IdfOverride('RunPeriod', '*', 1, 1), IdfOverride('RunPeriod', '*', 2, 1)]
+    patched = model.serialize(run_period)
+    serialized = time.perf_counter()
+    print("{:.1f} MB, {} objects".format(len(text) / 1e6, len(model.objects)))
+    print("parse:     {:8.1f} ms".format((parsed - start) * 1e3))
+    print("serialize: {:8.1f} ms".format((serialized - parsed) * 1e3))
+    print("unchanged round trip: {}".format(model.serialize() == text))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Pacing of simulation timesteps against the wall clock
+
+realtime - a timestep is not processed until the wall clock has passed its simulation
+           time plus a buffer (the live digital twin behavior)
+scaled   - simulation time advances PacingScale times faster than the wall clock,
+           measured from the first paced timestep (e.g. 60 => one simulated hour per minute)
+fast     - no waiting at all, for replays and backfills of historical periods
+"""
+import datetime as dt
+import threading
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+PACING_MODES = ('realtime', 'scaled', 'fast')
+
+
+class SimulationPacer:
+    def __init__(self, config):
+        self.mode = config.get('DEFAULT', 'PacingMode', fallback='realtime').strip().lower()
+        if self.mode not in PACING_MODES:
+            raise ValueError("Unsupported PacingMode {}, expected one of {}".format(self.mode, PACING_MODES))
+        self.scale = float(config.get('DEFAULT', 'PacingScale', fallback='60'))
+        if self.mode == 'scaled' and self.scale <= 0:
+            raise ValueError("PacingScale must be positive, got {}".format(self.scale))
+        self.buffer = dt.timedelta(minutes=float(config.get('DEFAULT', 'PacingBufferMinutes', fallback='5')))
+        #set to interrupt a pending wait, e.g. when the simulation is being shut down
+        self.stop_event = threading.Event()
+        self._sim_anchor = None
+        self._wall_anchor = None
+        logger.info("Simulation pacing mode {} (scale {}, buffer {})".format(self.mode, self.scale, self.buffer))
+
+    def seconds_until(self, simulation_datetime, buffer=None):
+        """
+        seconds the caller still has to wait before simulation_datetime may be processed; in realtime
+        mode a buffer other than PacingBufferMinutes can be given, e.g. for work due before the timestep
+        """
+        if self.mode == 'realtime':
+            buffer = self.buffer if buffer is None else buffer
+            #simulation datetimes are naive building local times, as is datetime.now()
+            return ((simulation_datetime + buffer) - dt.datetime.now()).total_seconds()
+        if self.mode == 'scaled':
+            if self._sim_anchor is None:
+                self._sim_anchor = simulation_datetime
+                self._wall_anchor = time.monotonic()
+            sim_elapsed = (simulation_datetime - self._sim_anchor).total_seconds()
+            return self._wall_anchor + sim_elapsed / self.scale - time.monotonic()
+        return 0.0
+
+    def wait(self, simulation_datetime, buffer=None):
+        """
+        blocks until simulation_datetime is due, sleeping straight to the deadline rather than
+        polling; returns False if the wait was interrupted by stop()
+        """
+        remaining = self.seconds_until(simulation_datetime, buffer)
+        while remaining > 0:
+            if self.stop_event.wait(remaining):
+                return False
+            #Event.wait may return marginally early, so re-check against the deadline
+            remaining = self.seconds_until(simulation_datetime, buffer)
+        return True
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Array backed value store for the digital twin's sensors and signals
+
+The per timestep code paths (EP callbacks, retrieval, persistence, OPC publishing) read and
+write the contiguous NumPy buffers held here, while the pandas dataframe is only built on
+demand as a view for custom callbacks and other non critical consumers.
+"""
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+import logging
+logger = logging.getLogger(__name__)
+
+#quality codes kept per slot when a store tracks quality
+QUALITY_GOOD = 0
+QUALITY_STALE = 1
+QUALITY_BAD = 2
+
+#a single value delivered by a retrieval agent; timestamp is the source time of the value
+SignalReading = namedtuple('SignalReading', ['value', 'quality', 'timestamp'])
+
+
+class SignalStore:
+    def __init__(self, metadata_df, key_column, initial_value=-1.0, track_quality=False):
+        """
+        metadata_df: dataframe with one row per signal, as read from the configuration csv
+        key_column: column uniquely identifying each signal (e.g. PersistenceName)
+        initial_value: value every slot holds until first written
+        track_quality: also keep a quality code and source timestamp per slot, as needed
+        for signals merged from several retrieval agents
+        """
+        #slots are positions in the metadata frame, so make sure the index agrees with them
+        self.metadata = metadata_df.reset_index(drop=True)
+        self.key_column = key_column
+        self.keys = tuple(self.metadata[key_column])
+        self.slots = {key: slot for slot, key in enumerate(self.keys)}
+        if len(self.slots) != len(self.keys):
+            duplicates = sorted(set(str(key) for key in self.metadata[key_column][self.metadata[key_column].duplicated()]))
+            raise ValueError("Duplicate values in {} column of signal configuration: {}".format(key_column, ', '.join(duplicates)))
+
+        self.values = np.full(len(self.keys), initial_value, dtype=np.float64)
+        self.handles = np.full(len(self.keys), -1, dtype=np.int32)
+        self.track_quality = track_quality
+        self.quality = np.full(len(self.keys), QUALITY_GOOD, dtype=np.int8)
+        self.timestamps = np.full(len(self.keys), None, dtype=object)
+        #bumped on every write so the dataframe view knows when it is out of date
+        self.version = 0
+        self._frame = None
+        self._frame_version = -1
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def stage_slots(self, stage_column, stage, mask=None):
+        """
+        returns an int32 array of the slots whose stage_column equals stage, optionally
+        restricted further by a boolean mask over all slots
+        """
+        selected = (self.metadata[stage_column] == stage).to_numpy()
+        if mask is not None:
+            selected &= mask
+        return np.flatnonzero(selected).astype(np.int32)
+
+    def index_by(self, column):
+        """
+        returns (and caches) a dict mapping the values of a metadata column to slots,
+        skipping empty cells; used to resolve alternate names such as OPC tag names
+        """
+        index = self._indexes.get(column)
+        if index is None:
+            index = {}
+            if column in self.metadata:
+                for slot, name in enumerate(self.metadata[column]):
+                    if not pd.isna(name):
+                        index[name] = slot
+            self._indexes[column] = index
+        return index
+
+    def write(self, slots, values):
+        """writes values into the given slots in one vectorized assignment"""
+        self.values[slots] = values
+        self.version += 1
+
+    def merge(self, readings):
+        """
+        merges a dict of key -> SignalReading, typically the combined partial results of all
+        retrieval agents, in one step. Unknown keys are ignored and NaN values keep the
+        previous value (their quality is still recorded)
+        """
+        slots = [self.slots[key] for key in readings if key in self.slots]
+        if not slots:
+            return
+        known = [readings[key] for key in readings if key in self.slots]
+        slots = np.asarray(slots, dtype=np.intp)
+        values = np.fromiter((reading.value for reading in known), dtype=np.float64, count=len(known))
+        valid = ~np.isnan(values)
+        self.values[slots[valid]] = values[valid]
+        self.quality[slots] = [reading.quality for reading in known]
+        self.timestamps[slots] = [reading.timestamp for reading in known]
+        self.version += 1
+
+    def mark(self, slots, quality):
+        """sets the quality code of the given slots, e.g. QUALITY_STALE after a missed fetch"""
+        self.quality[slots] = quality
+        self.version += 1
+
+    def snapshot(self):
+        """returns an independent copy of the current values"""
+        return self.values.copy()
+
+    def frame(self):
+        """
+        returns the metadata dataframe with ep_handle and current_val columns reflecting the
+        store. The frame is only rebuilt when the store changed since the last call; every caller
+        gets its own copy, so changes to it stay local until written back with update_from_frame
+        """
+        if self._frame is None or self._frame_version != self.version:
+            frame = self.metadata.copy()
+            frame['ep_handle'] = self.handles.copy()
+            frame['current_val'] = self.values.copy()
+            if self.track_quality:
+                frame['quality'] = self.quality.copy()
+                frame['stale'] = self.quality != QUALITY_GOOD
+                frame['source_timestamp'] = self.timestamps.copy()
+            self._frame = frame
+            self._frame_version = self.version
+        return self._frame.copy()
+
+    def update_from_frame(self, frame, column='current_val'):
+        """
+        writes the column of a frame (as returned by frame(), possibly a subset of its rows) back
+        into the store, matching rows by the key column. Raises KeyError for unknown keys
+        """
+        unknown = [key for key in frame[self.key_column] if key not in self.slots]
+        if unknown:
+            raise KeyError("Unknown {} values: {}".format(self.key_column, ', '.join(map(str, unknown))))
+        slots = np.fromiter((self.slots[key] for key in frame[self.key_column]), dtype=np.intp, count=len(frame))
+        self.write(slots, frame[column].to_numpy(dtype=np.float64))
+
+
+if __name__ == "__main__":
+    #micro benchmark of per stage sensor collection: per cell dataframe writes (previous
+    #implementation) against vectorized writes into the store
+    import timeit
+    n_sensors = 600
+    df = pd.DataFrame({'PersistenceName': ['sensor_{}'.format(i) for i in range(n_sensors)],
+                       'Read_stage': 'end_zone_timestep_after_zone_reporting'})
+    df = df.assign(current_val=-1.0)
+    store = SignalStore(df, 'PersistenceName')
+    slots = store.stage_slots('Read_stage', 'end_zone_timestep_after_zone_reporting')
+    readings = [float(i) for i in range(n_sensors)]
+
+    def dataframe_collect():
+        for idx in df.index:
+            df.iloc[idx, df.columns.get_loc('current_val')] = readings[idx]
+
+    def store_collect():
+        store.write(slots, readings)
+
+    repeats = 20
+    df_time = timeit.timeit(dataframe_collect, number=repeats) / repeats
+    store_time = timeit.timeit(store_collect, number=repeats * 100) / (repeats * 100)
+    print("{} sensors per timestep".format(n_sensors))
+    print("dataframe iloc writes: {:10.1f} us".format(df_time * 1e6))
+    print("signal store write:    {:10.1f} us".format(store_time * 1e6))
+    print("speedup:               {:10.0f}x".format(df_time / store_time))
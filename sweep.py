@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel parameter sweeps of a digital twin, e.g. for ensemble calibration
+
+A sweep file lists the parameters to vary, one csv row per parameter:
+    Kind        idf (a building model field) or actuator (a fixed actuator value)
+    ObjectType  IDF object type, or the ActuatorCategory
+    ObjectName  IDF object name ('*' or empty for every object of the type), or the ActuatorName
+    Field       IDF field index or name (see simulator.idf), or the ActuatorInstance
+    Values      ';' separated values to use
+    Min, Max    range to sample from, for parameters without Values
+Without --samples every combination of Values is run (a grid); with --samples N, N variants
+are drawn by latin hypercube sampling, from Values or from [Min, Max].
+
+Every variant gets its own working directory under the output directory: a copy of the base
+twin's config.ini switched to fast pacing, wide Parquet persistence and no OPC server, plus
+the variant's IdfOverridesFile and ActuatorOverridesFile (the base twin's overrides followed by
+the variant's). A variant directory is therefore a regular twin working directory that
+digital_twin.py can rerun on its own. The variants are run by the orchestrator's process
+pool (see orchestrator.py), after which the sensor outputs of all variants are collected into
+results.parquet (a variant column, then the twin's wide layout), and, given a csv of recorded
+measurements (a timestamp column plus one column per PersistenceName), scored in metrics.csv
+per variant and sensor:
+    RMSE, MAE
+    CV(RMSE) = RMSE over n - p degrees of freedom / measured mean, in %
+    NMBE     = sum(measured - simulated) / ((n - p) * measured mean), in %
+with p = 1 as in ASHRAE Guideline 14, recorded values being interpolated in time onto the
+simulation timestamps. Recorded timestamps with a UTC offset are converted to naive building
+local time (bldg_tz of the base twin, or the host's time zone), as simulation times are.
+The orchestrator's end state of every variant (finished, failed, ...) is recorded in
+variants.csv and metrics.csv, and only finished variants are ranked.
+
+usage: python sweep.py [options] base_working_directory sweep_file
+"""
+import argparse
+import configparser
+import glob
+import itertools
+import os
+import shutil
+import sys
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from dateutil.tz import tzlocal
+from orchestrator import Orchestrator
+from simulator.idf import OVERRIDE_COLUMNS
+import logging
+logger = logging.getLogger(__name__)
+
+SWEEP_KINDS = ('idf', 'actuator')
+SWEEP_COLUMNS = ('Kind', 'ObjectType', 'ObjectName', 'Field', 'Values', 'Min', 'Max')
+ACTUATOR_OVERRIDE_COLUMNS = ('ActuatorCategory', 'ActuatorName', 'ActuatorInstance', 'Value')
+
+#values is a tuple of strings, empty when the parameter is sampled from [minimum, maximum]
+SweepParameter = namedtuple('SweepParameter', ['kind', 'object_type', 'object_name', 'field', 'values', 'minimum', 'maximum'])
+
+#fitted parameters in the CV(RMSE) and NMBE denominators (ASHRAE Guideline 14)
+METRIC_PARAMETERS = 1
+
+#options of the base config that name files and are resolved against the base working directory
+BASE_PATH_OPTIONS = {
+    'CONFIGURATIONFILES': ('SignalsFile', 'SensorsFile', 'ActuatorsFile', 'CustomFile', 'OpcDevicesFile', 'OpcVariablesFile'),
+    'ENERGYPLUS': ('EPWeatherFile', 'EPBuildingModel'),
+    'Seeq': ('OfflineDataFile',),
+}
+
+
+def parameter_label(parameter):
+    return '{}:{}:{}:{}'.format(parameter.kind, parameter.object_type, parameter.object_name, parameter.field)
+
+
+def read_sweep(path):
+    """reads the parameters of a sweep file"""
+    sweep_df = pd.read_csv(path, dtype=str, keep_default_na=False, skipinitialspace=True)
+    missing = [column for column in SWEEP_COLUMNS[:5] if column not in sweep_df.columns]
+    if missing:
+        raise ValueError("Sweep file {} lacks the columns {}".format(path, missing))
+    sweep_df = sweep_df.reindex(columns=list(SWEEP_COLUMNS), fill_value='')
+    parameters = []
+    for kind, object_type, object_name, field, values, minimum, maximum in sweep_df.itertuples(index=False):
+        kind = kind.strip().lower()
+        if kind not in SWEEP_KINDS:
+            raise ValueError("Unsupported sweep parameter kind {}, expected one of {}".format(kind, SWEEP_KINDS))
+        values = tuple(value.strip() for value in values.split(';') if value.strip())
+        if not values and not (minimum.strip() and maximum.strip()):
+            raise ValueError("Sweep parameter {} {} {} needs Values or Min and Max".format(object_type, object_name, field))
+        parameters.append(SweepParameter(kind, object_type.strip(), object_name.strip() or '*', field.strip(), values,
+                                         float(minimum) if minimum.strip() else None,
+                                         float(maximum) if maximum.strip() else None))
+    return parameters
+
+
+def grid_variants(parameters):
+    """every combination of the parameters' values"""
+    sampled = [parameter_label(parameter) for parameter in parameters if not parameter.values]
+    if sampled:
+        raise ValueError("Parameters {} only have a range, which needs a sampled sweep".format(sampled))
+    return list(itertools.product(*[parameter.values for parameter in parameters]))
+
+
+def sampled_variants(parameters, samples, seed=None):
+    """samples variants drawn by latin hypercube sampling: each parameter's range is split in samples strata, each used once"""
+    rng = np.random.default_rng(seed)
+    columns = []
+    for parameter in parameters:
+        positions = (rng.permutation(samples) + rng.random(samples)) / samples
+        if parameter.values:
+            columns.append([parameter.values[int(position * len(parameter.values))] for position in positions])
+        else:
+            values = parameter.minimum + positions * (parameter.maximum - parameter.minimum)
+            columns.append(['{:.6g}'.format(value) for value in values])
+    return list(zip(*columns))
+
+
+def error_metrics(simulated, measured, parameters=METRIC_PARAMETERS):
+    """RMSE, MAE, CV(RMSE) and NMBE of simulated against measured, over the samples where both are known"""
+    simulated = np.asarray(simulated, dtype=np.float64)
+    measured = np.asarray(measured, dtype=np.float64)
+    valid = ~(np.isnan(simulated) | np.isnan(measured))
+    simulated = simulated[valid]
+    measured = measured[valid]
+    n = len(measured)
+    metrics = {'n': n, 'rmse': np.nan, 'mae': np.nan, 'cv_rmse': np.nan, 'nmbe': np.nan}
+    if n == 0:
+        return metrics
+    errors = measured - simulated
+    metrics['rmse'] = float(np.sqrt(np.mean(errors ** 2)))
+    metrics['mae'] = float(np.mean(np.abs(errors)))
+    mean = measured.mean()
+    dof = n - parameters
+    if dof > 0 and mean != 0:
+        metrics['cv_rmse'] = float(np.sqrt(np.sum(errors ** 2) / dof) / mean * 100)
+        metrics['nmbe'] = float(errors.sum() / (dof * mean) * 100)
+    return metrics
+
+
+def naive_local(times, tz=None):
+    """times as naive building local times; aware times are converted to tz (default the host's time zone)"""
+    times = pd.DatetimeIndex(times)
+    if times.tz is not None:
+        times = times.tz_convert(tz or tzlocal()).tz_localize(None)
+    return times
+
+
+def read_recorded(path, tz=None):
+    """recorded measurements: a timestamp column followed by one column per PersistenceName"""
+    recorded = pd.read_csv(path, index_col=0)
+    #timestamps with UTC offsets are parsed as UTC, as the offsets may change across DST
+    aware = len(recorded) and pd.to_datetime(recorded.index[:1]).tz is not None
+    recorded.index = naive_local(pd.to_datetime(recorded.index, utc=bool(aware)), tz)
+    return recorded.sort_index()
+
+
+def align_recorded(recorded, times, tz=None):
+    """
+    recorded values interpolated in time onto times (NaN outside the recorded period); both are
+    compared as naive building local times, see naive_local
+    """
+    times = naive_local(times, tz)
+    recorded = recorded.set_axis(naive_local(recorded.index, tz))
+    combined = recorded.reindex(recorded.index.union(times))
+    return combined.interpolate(method='time', limit_area='inside').reindex(times)
+
+
+class Sweep:
+    def __init__(self, base_directory, parameters, output_directory, variants):
+        self.base_directory = os.path.abspath(base_directory)
+        self.parameters = parameters
+        self.output_directory = os.path.abspath(output_directory)
+        self.variants = variants
+        self.base_config = configparser.ConfigParser(interpolation=None)
+        self.base_config.read(os.path.join(self.base_directory, 'config.ini'))
+        self.base_id = self.base_config.get('DEFAULT', 'DigitalTwinIdentifier', fallback='dt')
+        self.tz = self.base_config.get('DEFAULT', 'bldg_tz', fallback='').strip() or None
+        self.variant_ids = ['v{:04d}'.format(index) for index in range(len(variants))]
+        #end state of every variant's twin as reported by the orchestrator (see run)
+        self.states = {}
+        self.details = {}
+
+    def variant_directory(self, variant_id):
+        return os.path.join(self.output_directory, variant_id)
+
+    def base_overrides(self, option):
+        """the base twin's own override file for option, as a dataframe of strings (None if there is none)"""
+        name = self.base_config.get('CONFIGURATIONFILES', option, fallback='').strip()
+        if not name:
+            return None
+        return pd.read_csv(os.path.join(self.base_directory, name), dtype=str, keep_default_na=False)
+
+    def prepare(self):
+        """writes the working directory of every variant and the variants table variants.csv"""
+        os.makedirs(self.output_directory, exist_ok=True)
+        base_idf_overrides = self.base_overrides('IdfOverridesFile')
+        base_actuator_overrides = self.base_overrides('ActuatorOverridesFile')
+        for variant_id, values in zip(self.variant_ids, self.variants):
+            directory = self.variant_directory(variant_id)
+            os.makedirs(directory, exist_ok=True)
+            #output of an earlier run of the sweep would otherwise be collected along with this one
+            shutil.rmtree(os.path.join(directory, 'output'), ignore_errors=True)
+            idf_rows = [(parameter.object_type, parameter.object_name, parameter.field, value)
+                        for parameter, value in zip(self.parameters, values) if parameter.kind == 'idf']
+            actuator_rows = [(parameter.object_type, parameter.object_name, parameter.field, value)
+                             for parameter, value in zip(self.parameters, values) if parameter.kind == 'actuator']
+            idf_overrides = pd.DataFrame(idf_rows, columns=list(OVERRIDE_COLUMNS))
+            actuator_overrides = pd.DataFrame(actuator_rows, columns=list(ACTUATOR_OVERRIDE_COLUMNS))
+            if base_idf_overrides is not None:
+                idf_overrides = pd.concat([base_idf_overrides, idf_overrides], ignore_index=True)
+            if base_actuator_overrides is not None:
+                actuator_overrides = pd.concat([base_actuator_overrides, actuator_overrides], ignore_index=True)
+            idf_overrides.to_csv(os.path.join(directory, 'idf_overrides.csv'), index=False)
+            actuator_overrides.to_csv(os.path.join(directory, 'actuator_overrides.csv'), index=False)
+            self.write_variant_config(directory, variant_id)
+        self.states = {}
+        self.details = {}
+        self.write_variants()
+        logger.info("Prepared {} sweep variants of {} in {}".format(len(self.variants), self.base_directory, self.output_directory))
+        return [self.variant_directory(variant_id) for variant_id in self.variant_ids]
+
+    def write_variants(self):
+        """writes variants.csv: every variant's parameter values and the end state of its run"""
+        variants_df = pd.DataFrame(self.variants, columns=[parameter_label(parameter) for parameter in self.parameters])
+        variants_df.insert(0, 'variant', self.variant_ids)
+        variants_df.insert(1, 'state', [self.states.get(variant_id, 'pending') for variant_id in self.variant_ids])
+        variants_df.insert(2, 'detail', [self.details.get(variant_id, '') for variant_id in self.variant_ids])
+        variants_df.to_csv(os.path.join(self.output_directory, 'variants.csv'), index=False)
+
+    def read_states(self):
+        """end states of the variants as recorded in variants.csv by an earlier run"""
+        path = os.path.join(self.output_directory, 'variants.csv')
+        if not os.path.exists(path):
+            return
+        variants_df = pd.read_csv(path, dtype=str, keep_default_na=False)
+        if 'state' in variants_df.columns:
+            self.states = dict(zip(variants_df['variant'], variants_df['state']))
+            self.details = dict(zip(variants_df['variant'], variants_df['detail'])) if 'detail' in variants_df.columns else {}
+
+    def write_variant_config(self, directory, variant_id):
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(os.path.join(self.base_directory, 'config.ini'))
+        for section, options in BASE_PATH_OPTIONS.items():
+            for option in options:
+                value = config.get(section, option, fallback='').strip()
+                if value:
+                    config.set(section, option, os.path.join(self.base_directory, value))
+        for section in ('CONFIGURATIONFILES', 'COLUMNAR', 'OPCSERVER', 'RETRIEVAL', 'Seeq'):
+            if not config.has_section(section):
+                config.add_section(section)
+        config.set('DEFAULT', 'DigitalTwinIdentifier', '{}_{}'.format(self.base_id, variant_id))
+        #accelerated replay into files, without an OPC server (every variant would claim its endpoint)
+        config.set('DEFAULT', 'PacingMode', 'fast')
+        config.set('DEFAULT', 'PersistenceType', 'PARQUET')
+        config.set('COLUMNAR', 'OutputDirectory', 'output')
+        config.set('COLUMNAR', 'Layout', 'wide')
+        config.set('OPCSERVER', 'OpcServerEnabled', 'false')
+        config.set('RETRIEVAL', 'ReadAheadEnabled', 'true')
+        config.set('Seeq', 'PrefetchEnabled', 'true')
+        config.set('CONFIGURATIONFILES', 'IdfOverridesFile', 'idf_overrides.csv')
+        config.set('CONFIGURATIONFILES', 'ActuatorOverridesFile', 'actuator_overrides.csv')
+        with open(os.path.join(directory, 'config.ini'), 'w') as config_file:
+            config.write(config_file)
+
+    def run(self, start_datetime_string=None, max_workers=None, cores_per_twin=1):
+        """runs the prepared variants in the orchestrator's process pool; returns True if all finished"""
+        directories = [self.variant_directory(variant_id) for variant_id in self.variant_ids]
+        orchestrator = Orchestrator(directories, start_datetime_string, max_workers, cores_per_twin)
+        finished = orchestrator.run()
+        self.states = {variant_id: health.state for variant_id, health in zip(self.variant_ids, orchestrator.twins)}
+        self.details = {variant_id: health.detail or '' for variant_id, health in zip(self.variant_ids, orchestrator.twins)}
+        self.write_variants()
+        return finished
+
+    def collect(self, recorded=None):
+        """
+        writes the sensor outputs of all variants to results.parquet, one variant at a time, and
+        returns the metrics of every variant and sensor against recorded (None without recorded data),
+        each with the end state of the variant's run (see variants.csv)
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        results_path = os.path.join(self.output_directory, 'results.parquet')
+        writer = None
+        metrics = []
+        try:
+            for variant_id in self.variant_ids:
+                if self.states.get(variant_id, 'finished') != 'finished':
+                    logger.warning("Sweep variant {} did not finish ({}), its output is partial".format(variant_id, self.states[variant_id]))
+                paths = sorted(glob.glob(os.path.join(self.variant_directory(variant_id), 'output', '*.parquet')))
+                if not paths:
+                    logger.warning("Sweep variant {} has no output".format(variant_id))
+                    continue
+                table = pa.concat_tables([pq.read_table(path).replace_schema_metadata(None) for path in paths])
+                table = table.add_column(0, 'variant', pa.array([variant_id] * table.num_rows, pa.dictionary(pa.int32(), pa.string())))
+                if writer is None:
+                    writer = pq.ParquetWriter(results_path, table.schema, compression='zstd')
+                writer.write_table(table)
+                if recorded is not None:
+                    metrics.extend(self.score(variant_id, table.drop(['variant']).to_pandas(), recorded))
+        finally:
+            if writer is not None:
+                writer.close()
+        logger.info("Collected sweep results in {}".format(results_path))
+        if recorded is None:
+            return None
+        metrics_df = pd.DataFrame(metrics, columns=['variant', 'state', 'sensor', 'n', 'rmse', 'mae', 'cv_rmse', 'nmbe'])
+        metrics_df.to_csv(os.path.join(self.output_directory, 'metrics.csv'), index=False)
+        return metrics_df
+
+    def score(self, variant_id, results, recorded):
+        sensors = [column for column in results.columns if column != 'time' and column in recorded.columns]
+        measured = align_recorded(recorded[sensors], results['time'], self.tz)
+        state = self.states.get(variant_id, 'unknown')
+        return [dict(variant=variant_id, state=state, sensor=sensor, **error_metrics(results[sensor].to_numpy(), measured[sensor].to_numpy()))
+                for sensor in sensors]
+
+
+"""
+Entry point for code execution
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Runs variants of a digital twin in parallel and scores them against recorded data')
+    parser.add_argument('base_working_directory', help='working directory of the twin to vary')
+    parser.add_argument('sweep_file', help='csv of the parameters to vary')
+    parser.add_argument('--output', default='sweep', help='directory for the variants and results')
+    parser.add_argument('--samples', type=int, default=None, help='number of sampled variants (default: the full grid)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--start', default=None, help='simulation start datetime (default now)')
+    parser.add_argument('--recorded', default=None, help='csv of recorded measurements to score the variants against')
+    parser.add_argument('--max-workers', type=int, default=None)
+    parser.add_argument('--cores-per-twin', type=int, default=1)
+    parser.add_argument('--no-run', action='store_true', help='only collect and score the output of an earlier run')
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='ep_sweep.log', level=logging.INFO)
+    parameters = read_sweep(args.sweep_file)
+    variants = sampled_variants(parameters, args.samples, args.seed) if args.samples else grid_variants(parameters)
+    sweep = Sweep(args.base_working_directory, parameters, args.output, variants)
+    finished = True
+    if args.no_run:
+        sweep.read_states()
+    else:
+        sweep.prepare()
+        finished = sweep.run(args.start, args.max_workers, args.cores_per_twin)
+    recorded = read_recorded(args.recorded, sweep.tz) if args.recorded else None
+    metrics_df = sweep.collect(recorded)
+    if metrics_df is not None and len(metrics_df):
+        #best variants per sensor, among the variants that ran to the end
+        ranked_df = metrics_df[metrics_df['state'] == 'finished']
+        excluded = sorted(set(metrics_df['variant']) - set(ranked_df['variant']))
+        if excluded:
+            print("Not ranked, as they did not finish: {}".format(', '.join(excluded)))
+        print(ranked_df.sort_values('cv_rmse').groupby('sensor').head(3).to_string(index=False))
+    sys.exit(0 if finished else 1)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the reconnect backoff and health checks of the shared PostgreSQL pool (persistence.connection_manager)
+"""
+import time
+import psycopg2
+import pytest
+from persistence import connection_manager
+from persistence.connection_manager import ConnectionManager
+
+BACKOFF_INITIAL = 0.05
+BACKOFF_MAX = 0.15
+
+
+class StubConnection:
+    def __init__(self):
+        self.closed = 0
+        self.checks = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement):
+        self.checks += 1
+
+    def close(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class StubDatabase:
+    """stands in for ThreadedConnectionPool; refuses to connect while down"""
+    def __init__(self):
+        self.down = False
+        self.attempts = 0
+        self.handed_out = []
+        self.discarded = []
+
+    def __call__(self, minconn, maxconn, **params):
+        self.attempts += 1
+        if self.down:
+            raise psycopg2.OperationalError("could not connect to server")
+        self.idle = []
+        self.closed = False
+        return self
+
+    def getconn(self):
+        if self.down:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        conn = self.idle.pop() if self.idle else StubConnection()
+        self.handed_out.append(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        if close:
+            self.discarded.append(conn)
+        else:
+            self.idle.append(conn)
+
+    def closeall(self):
+        self.closed = True
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = StubDatabase()
+    monkeypatch.setattr(connection_manager, 'ThreadedConnectionPool', database)
+    return database
+
+
+def make_manager():
+    return ConnectionManager({'host': 'db'}, backoff_initial=BACKOFF_INITIAL, backoff_max=BACKOFF_MAX)
+
+
+def fail_once(manager):
+    with pytest.raises(psycopg2.OperationalError):
+        with manager.connection():
+            pass
+
+
+def test_failure_backs_off_and_fails_fast(database):
+    manager = make_manager()
+    database.down = True
+    fail_once(manager)
+    assert database.attempts == 1
+    assert not manager.available()
+    #within the backoff no connection is attempted
+    fail_once(manager)
+    assert database.attempts == 1
+    time.sleep(BACKOFF_INITIAL)
+    assert manager.available()
+    fail_once(manager)
+    assert database.attempts == 2
+
+
+def test_backoff_doubles_up_to_the_maximum(database):
+    manager = make_manager()
+    database.down = True
+    delays = []
+    for _ in range(4):
+        while not manager.available():
+            time.sleep(0.005)
+        fail_once(manager)
+        delays.append(manager.next_attempt - manager.last_failure)
+    assert delays == pytest.approx([0.05, 0.1, 0.15, 0.15])
+
+
+def test_recovery_resets_the_backoff(database):
+    manager = make_manager()
+    database.down = True
+    fail_once(manager)
+    fail_once(manager)
+    database.down = False
+    time.sleep(BACKOFF_INITIAL)
+    with manager.connection() as conn:
+        assert isinstance(conn, StubConnection)
+    assert manager.failures == 0
+    assert manager.available()
+    #the next failure starts again from the initial backoff
+    database.down = True
+    with pytest.raises(psycopg2.OperationalError):
+        with manager.connection():
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+    assert manager.next_attempt - manager.last_failure == pytest.approx(BACKOFF_INITIAL)
+
+
+def test_pooled_connections_are_checked_after_an_outage(database):
+    manager = make_manager()
+    with manager.connection() as first:
+        pass
+    assert first.checks == 1
+    #reused within the health check interval without another SELECT 1
+    with manager.connection() as conn:
+        assert conn is first
+    assert first.checks == 1
+    #an idle connection is suspect once a failure happened since its last use
+    database.down = True
+    fail_once(manager)
+    database.down = False
+    time.sleep(BACKOFF_INITIAL)
+    with manager.connection() as conn:
+        assert conn is first
+    assert first.checks == 2
+    #a connection that did not survive is discarded and replaced
+    first.closed = 1
+    with manager.connection() as conn:
+        assert conn is not first
+    assert database.discarded == [first]
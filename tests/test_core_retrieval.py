@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the concurrent agent retrieval (retrieval.core_retrieval)
+"""
+import configparser
+import datetime
+import logging
+import pandas as pd
+from retrieval.core_retrieval import CoreRetrieval
+from simulator.pacing import SimulationPacer
+from simulator.signal_store import SignalStore, SignalReading, QUALITY_GOOD
+
+
+class ConstantAgent:
+    def fetch_signals_at_timepoint(self, timepoint):
+        return {'t1': SignalReading(1.0, QUALITY_GOOD, timepoint)}
+
+
+def make_retrieval(**retrieval_options):
+    config = configparser.ConfigParser()
+    config['DEFAULT'] = {'PacingMode': 'fast'}
+    config['RETRIEVAL'] = retrieval_options
+    store = SignalStore(pd.DataFrame({'SignalTagName': ['t1'], 'SignalSource': ['test']}), 'SignalTagName', track_quality=True)
+    pacer = SimulationPacer(config)
+    retrieval = CoreRetrieval(config, store, pacer)
+    retrieval.add_retrieval_agent(ConstantAgent())
+    return retrieval, store, pacer
+
+
+def test_close_leaves_the_shared_pacer_running():
+    retrieval, store, pacer = make_retrieval(ReadAheadEnabled='true')
+    start = datetime.datetime(2024, 1, 1)
+    for minute in range(3):
+        retrieval.retrieve_signals_for_actuators_at_timepoint(store, start + datetime.timedelta(minutes=minute))
+    retrieval.close()
+    assert not pacer.stop_event.is_set()
+
+
+def test_metrics_are_logged_periodically(caplog):
+    retrieval, store, _ = make_retrieval(MetricsLogIntervalSeconds='0.000001')
+    with caplog.at_level(logging.INFO, logger='retrieval.core_retrieval'):
+        retrieval.retrieve_signals_for_actuators_at_timepoint(store, datetime.datetime(2024, 1, 1))
+    assert any('Retrieval metrics' in record.getMessage() for record in caplog.records)
+    retrieval.close()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the IDF field patcher (simulator.idf)
+"""
+from simulator.idf import IdfModel, IdfOverride
+
+MODEL = """Version,9.4;
+
+Timestep,4;  !- Number of Timesteps per Hour
+
+Zone,
+    Office,                  !- Name
+    0,                       !- Direction of Relative North {deg}
+    1.5;                     !- X Origin {m}
+"""
+
+
+def patched(*overrides):
+    return IdfModel.parse(MODEL).serialize(list(overrides))
+
+
+def test_named_field_of_single_line_object():
+    model = IdfModel.parse(MODEL)
+    timestep = model.find('Timestep')[0]
+    assert timestep.field_index('Number of Timesteps per Hour') == 0
+    assert 'Timestep,6;  !- Number of Timesteps per Hour' in patched(IdfOverride('Timestep', '*', 'Number of Timesteps per Hour', 6))
+
+
+def test_named_field_of_multi_line_object():
+    text = patched(IdfOverride('Zone', 'Office', 'X Origin', 2.5))
+    assert '    2.5;                     !- X Origin {m}' in text
+    assert text.replace('2.5;', '1.5;', 1) == MODEL
+
+
+def test_field_by_index():
+    text = patched(IdfOverride('Zone', 'Office', 1, 90))
+    assert '    90,                       !- Direction of Relative North {deg}' in text
+
+
+def test_field_past_the_last_is_appended():
+    text = patched(IdfOverride('Zone', 'Office', 4, 3.0))
+    assert '    1.5,,3.0;                     !- X Origin {m}' in text
+    assert IdfModel.parse(text).find('Zone', 'Office')[0].value(4) == '3.0'
+
+
+def test_untouched_model_round_trips():
+    assert patched() == MODEL
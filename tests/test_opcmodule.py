@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the snapshot handover of the OPC UA module (opcmodule.opcmodule)
+"""
+import asyncio
+import configparser
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+from asyncua import ua
+from opcmodule.opcmodule import OPCUAModule
+from opcmodule.ring_history import RingHistoryStorage
+from simulator.signal_store import SignalStore
+
+NODE = ua.NodeId('tag', 2)
+
+
+def make_module(tmp_path, bldg_tz='America/New_York'):
+    pd.DataFrame(columns=['device_name', 'description', 'class']).to_csv(tmp_path / 'devices.csv', index=False)
+    pd.DataFrame(columns=['device_name', 'tag_name', 'ep_type']).to_csv(tmp_path / 'variables.csv', index=False)
+    config = configparser.ConfigParser()
+    config['DEFAULT'] = {'bldg_tz': bldg_tz}
+    config['CONFIGURATIONFILES'] = {'OpcDevicesFile': 'devices.csv', 'OpcVariablesFile': 'variables.csv'}
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    config['OPCSERVER'] = {'ep': 'opc.tcp://127.0.0.1:{}/'.format(port), 'OpcServerName': 'test', 'uri': 'http://test'}
+    module = OPCUAModule(str(tmp_path), config)
+    module.history = RingHistoryStorage([NODE], [ua.VariantType.Double], depth=16)
+    module.history_tags = ['tag']
+    store = SignalStore(pd.DataFrame({'PersistenceName': ['sensor'], 'opc_tag_name': ['tag']}), 'PersistenceName')
+    return module, store
+
+
+def test_history_follows_simulation_time(tmp_path):
+    module, store = make_module(tmp_path)
+    start = datetime(2024, 1, 1, 12, 0)
+    #a fast replay: a week of timesteps in no time
+    for day in range(7):
+        store.write([0], [float(day)])
+        module.update_variables(store, start + timedelta(days=day))
+    utc_start = datetime(2024, 1, 1, 17, 0, tzinfo=timezone.utc)
+    results, _ = asyncio.run(module.history.read_node_history(NODE, utc_start + timedelta(days=2), utc_start + timedelta(days=4), 0))
+    assert [result.Value.Value for result in results] == [2.0, 3.0, 4.0]
+    assert results[0].SourceTimestamp == utc_start + timedelta(days=2)
+    #published with the same source timestamp
+    assert module.pending_update[2] == utc_start + timedelta(days=6)
+
+
+def run_server(module, store, timesteps, start):
+    """publishes timesteps snapshots and stops the server; returns the published timestamps"""
+    published = []
+
+    async def record(sensor_store, sensor_values, timestamp):
+        published.append(timestamp)
+        #a slow publish, so later snapshots are coalesced
+        await asyncio.sleep(0.01)
+    module.publish_changes = record
+    module.start()
+    for minute in range(timesteps):
+        module.update_variables(store, start + timedelta(minutes=minute))
+        time.sleep(0.001)
+    module.stop()
+    deadline = time.monotonic() + 20
+    while module.thread.is_alive() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not module.thread.is_alive()
+    return published
+
+
+def test_last_snapshot_published_on_stop(tmp_path):
+    module, store = make_module(tmp_path)
+    module.history = None
+    start = datetime(2024, 1, 1, 12, 0)
+    published = run_server(module, store, 200, start)
+    assert published[-1] == module.source_timestamp(start + timedelta(minutes=199))
+    assert published == sorted(published)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the stall detection of the twin fleet orchestrator
+"""
+from orchestrator import Heartbeat, TwinHealth
+
+STALL_SECONDS = 900.0
+
+
+def beat(health, now, timesteps, pacing_wait_seconds=0.0):
+    health.update(Heartbeat(health.twin, 'heartbeat', 1, timesteps, None, pacing_wait_seconds, None), now)
+    health.check_stall(now, STALL_SECONDS)
+    return health.state
+
+
+def test_realtime_twin_waiting_for_its_timestep_is_not_stalled():
+    health = TwinHealth('twin', '.')
+    health.state = 'running'
+    health.started = 0.0
+    #15 minute timesteps, each completed right after its pacing wait of a little over 900s
+    states = []
+    for step in range(1, 5):
+        start = (step - 1) * 905.0
+        for now in range(int(start), int(start + 905), 5):
+            states.append(beat(health, float(now), step - 1, start + 905.0 - now))
+        states.append(beat(health, start + 905.0, step))
+    assert set(states) == {'running'}
+
+
+def test_due_timestep_without_progress_is_stalled():
+    health = TwinHealth('twin', '.')
+    health.state = 'running'
+    health.started = 0.0
+    assert beat(health, 5.0, 1, 3600.0) == 'running'
+    #the timestep became due at 3605s
+    assert beat(health, 3605.0 + STALL_SECONDS - 5, 1) == 'running'
+    assert beat(health, 3605.0 + STALL_SECONDS + 5, 1) == 'stalled'
+    assert beat(health, 3605.0 + STALL_SECONDS + 10, 2) == 'running'
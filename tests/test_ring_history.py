@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the in memory OPC UA history (opcmodule.ring_history)
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from asyncua import ua
+from opcmodule.ring_history import RingHistoryStorage
+
+NODE = ua.NodeId('tag', 2)
+T0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def make_storage(values):
+    storage = RingHistoryStorage([NODE], [ua.VariantType.Double], depth=16)
+    for minute, value in enumerate(values):
+        storage.record(T0 + timedelta(minutes=minute), [value])
+    return storage
+
+
+def read(storage, start, end, nb_values=0):
+    results, cont = asyncio.run(storage.read_node_history(NODE, start, end, nb_values))
+    return [result.Value.Value for result in results], cont
+
+
+def test_unspecified_start_stops_at_end_time():
+    storage = make_storage([23, 24, 25, 26, 27])
+    values, cont = read(storage, None, T0 + timedelta(minutes=2))
+    assert values == [25, 24, 23]
+    assert cont is None
+
+
+def test_reverse_continuation_keeps_reading_backwards():
+    storage = make_storage([23, 24, 25, 26, 27])
+    storage.max_history_data_response_size = 2
+    pages = []
+    values, cont = read(storage, None, None)
+    pages.append(values)
+    while cont is not None:
+        #asyncua passes the continuation point as the start of the next read, with the original end
+        values, cont = read(storage, cont, None)
+        pages.append(values)
+    assert pages == [[27, 26], [25, 24], [23]]
+
+
+def test_reverse_continuation_with_end_time():
+    storage = make_storage([23, 24, 25, 26, 27])
+    storage.max_history_data_response_size = 2
+    end = T0 + timedelta(minutes=3)
+    values, cont = read(storage, None, end)
+    assert values == [26, 25]
+    values, cont = read(storage, cont, end)
+    assert values == [24, 23]
+    assert cont is None
+
+
+def test_forward_read_and_continuation():
+    storage = make_storage([23, 24, 25, 26, 27])
+    storage.max_history_data_response_size = 3
+    values, cont = read(storage, T0, None)
+    assert values == [23, 24, 25]
+    values, cont = read(storage, cont, None)
+    assert values == [26, 27]
+    assert cont is None
+
+
+def test_single_node_saves_do_not_add_rows():
+    storage = make_storage([23, 24])
+    asyncio.run(storage.save_node_value(NODE, ua.DataValue(ua.Variant(99.0, ua.VariantType.Double), SourceTimestamp=T0 + timedelta(minutes=5))))
+    assert storage.count == 2
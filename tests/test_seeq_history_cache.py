@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the prefetching history cache of SeeqRetrieval, served from a FileSpy
+"""
+import configparser
+import numpy as np
+import pandas as pd
+from retrieval.file_spy import FileSpy
+from retrieval.seeq_retrieval import SeeqRetrieval
+from simulator.signal_store import QUALITY_GOOD, QUALITY_STALE
+
+
+def make_retrieval(tmp_path, grid, chunk_days):
+    times = pd.date_range('2022-12-31', '2023-01-06', freq='5min')
+    data = pd.DataFrame({'t1': np.arange(len(times), dtype=float)}, index=times)
+    data_path = tmp_path / 'history.csv'
+    data.to_csv(data_path)
+    config = configparser.ConfigParser()
+    config['Seeq'] = {'SeeqServerURL': '', 'SeeqUser': '', 'SeeqPassword': '', 'SeeqRequestOrigin': '',
+                      'PrefetchEnabled': 'true', 'PrefetchChunkDays': str(chunk_days), 'PrefetchGrid': grid}
+    signals_df = pd.DataFrame({'SignalTagName': ['t1'], 'SignalSource': ['seeq'], 'SourceId': ['file']})
+    return SeeqRetrieval(config, signals_df, FileSpy(str(data_path))), data
+
+
+def test_timepoints_off_grid_at_chunk_starts(tmp_path):
+    retrieval, data = make_retrieval(tmp_path, '15min', 2)
+    for timepoint in (pd.Timestamp('2023-01-01 00:07'), pd.Timestamp('2023-01-03 00:14')):
+        readings = retrieval.fetch_signals_at_timepoint(timepoint)
+        assert retrieval.history_cache.window_start <= timepoint
+        #the latest 15 minute grid sample at or before the timepoint
+        assert readings['t1'].value == data['t1'][timepoint.floor('15min')]
+
+
+def test_timepoint_on_grid_at_chunk_start(tmp_path):
+    retrieval, data = make_retrieval(tmp_path, '15min', 2)
+    timepoint = pd.Timestamp('2023-01-01 00:15')
+    readings = retrieval.fetch_signals_at_timepoint(timepoint)
+    assert readings['t1'].value == data['t1'][timepoint]
+
+
+def test_fill_across_chunks_goes_stale(tmp_path):
+    retrieval, data = make_retrieval(tmp_path, '15min', 1)
+    #the tag stops reporting after 2023-01-01 06:00
+    data.loc[data.index > '2023-01-01 06:00', 't1'] = np.nan
+    data.to_csv(tmp_path / 'history.csv')
+    retrieval.spy = FileSpy(str(tmp_path / 'history.csv'))
+    fresh = retrieval.fetch_signals_at_timepoint(pd.Timestamp('2023-01-01 06:10'))['t1']
+    assert (fresh.value, fresh.quality) == (data['t1']['2023-01-01 06:00'], QUALITY_GOOD)
+    stale = retrieval.fetch_signals_at_timepoint(pd.Timestamp('2023-01-03 12:00'))['t1']
+    assert (stale.value, stale.quality) == (fresh.value, QUALITY_STALE)
+    assert stale.timestamp == pd.Timestamp('2023-01-01 06:00')
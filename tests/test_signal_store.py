@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the dataframe views of the signal store (simulator.signal_store)
+"""
+import pandas as pd
+import pytest
+from simulator.signal_store import SignalStore
+
+
+def make_store(names=('a', 'b', 'c')):
+    return SignalStore(pd.DataFrame({'PersistenceName': list(names)}), 'PersistenceName')
+
+
+def test_duplicate_keys_are_named():
+    with pytest.raises(ValueError, match='b, c'):
+        make_store(['a', 'b', 'c', 'b', 'c'])
+
+
+def test_frame_changes_do_not_leak():
+    store = make_store()
+    frame = store.frame()
+    frame['current_val'] = 5.0
+    assert (store.frame()['current_val'] == -1.0).all()
+    assert (store.values == -1.0).all()
+
+
+def test_frame_written_back():
+    store = make_store()
+    frame = store.frame()
+    frame.loc[frame['PersistenceName'] == 'b', 'current_val'] = 7.0
+    store.update_from_frame(frame[frame['PersistenceName'] != 'a'])
+    assert list(store.values) == [-1.0, 7.0, -1.0]
+    assert store.frame()['current_val'].tolist() == [-1.0, 7.0, -1.0]
+    with pytest.raises(KeyError):
+        store.update_from_frame(pd.DataFrame({'PersistenceName': ['x'], 'current_val': [1.0]}))
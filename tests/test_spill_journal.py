@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the local spill journal (persistence.spill_journal)
+"""
+import datetime
+import glob
+import os
+import subprocess
+import sys
+import numpy as np
+from persistence.spill_journal import HEADER, SpillJournal
+
+KEYS = ('zone_temp', 'zone_rh')
+NAIVE = datetime.datetime(2024, 1, 1, 12, 0)
+AWARE = datetime.datetime(2024, 1, 1, 17, 1, tzinfo=datetime.timezone.utc)
+
+#appends to a journal and dies without closing it, as a crashed twin would
+CRASHING_WRITER = """
+import datetime, os, sys
+import numpy as np
+from persistence.spill_journal import SpillJournal
+journal = SpillJournal(sys.argv[1], ('zone_temp', 'zone_rh'))
+journal.append(datetime.datetime(2024, 1, 1, 12, 0), np.array([21.5, 40.0]))
+journal.append_many([(datetime.datetime(2024, 1, 1, 17, 1, tzinfo=datetime.timezone.utc), np.array([21.75, np.nan]))] * 2000)
+os._exit(1)
+"""
+
+
+def test_round_trip_after_a_crash(tmp_path):
+    path = str(tmp_path / 'twin_wide.journal')
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, '-c', CRASHING_WRITER, path], cwd=package, check=False)
+    journal = SpillJournal(path, KEYS)
+    assert len(journal) == 2001
+    rows = journal.rows()
+    assert rows[0][0] == NAIVE and rows[0][0].tzinfo is None
+    assert rows[1][0] == AWARE
+    np.testing.assert_array_equal(rows[0][1], [21.5, 40.0])
+    np.testing.assert_array_equal(rows[-1][1], [21.75, np.nan])
+    #once replayed the journal is emptied, also for the next process
+    journal.clear()
+    journal.close()
+    assert len(SpillJournal(path, KEYS)) == 0
+
+
+def test_schema_mismatch_sets_the_journal_aside(tmp_path):
+    path = str(tmp_path / 'twin_wide.journal')
+    journal = SpillJournal(path, KEYS)
+    journal.append(NAIVE, np.array([21.5, 40.0]))
+    journal.close()
+    #a sensor was added to the configuration since
+    reopened = SpillJournal(path, KEYS + ('zone_co2',))
+    assert len(reopened) == 0
+    reopened.append(NAIVE, np.array([21.5, 40.0, 400.0]))
+    reopened.close()
+    orphans = glob.glob(path + '.*.orphaned')
+    assert len(orphans) == 1
+    with open(orphans[0], 'rb') as orphan:
+        assert HEADER.unpack(orphan.read(HEADER.size))[3] == 1
+    #the orphaned records are still readable with the schema they were written for
+    os.replace(orphans[0], path + '.old')
+    original = SpillJournal(path + '.old', KEYS)
+    assert original.rows()[0][0] == NAIVE
+    original.close()
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for scoring sweep variants against recorded measurements (sweep.py)
+"""
+import numpy as np
+import pandas as pd
+from sweep import align_recorded, read_recorded
+
+TZ = 'America/New_York'
+
+
+def test_recorded_with_utc_offsets_aligns_on_local_time(tmp_path):
+    #local 2023-03-11 22:00 to 2023-03-12 04:00, across the start of DST
+    utc_times = pd.date_range('2023-03-12 03:00', periods=7, freq='h', tz='UTC')
+    recorded_path = tmp_path / 'recorded.csv'
+    pd.DataFrame({'zone_t': np.arange(7.0)}, index=utc_times.tz_convert(TZ)).to_csv(recorded_path)
+    recorded = read_recorded(str(recorded_path), TZ)
+    assert recorded.index.tz is None
+    simulation_times = pd.DatetimeIndex(['2023-03-11 22:30', '2023-03-12 00:00'])
+    measured = align_recorded(recorded, simulation_times, TZ)
+    assert measured['zone_t'].tolist() == [0.5, 2.0]
+
+
+def test_aware_frames_are_aligned_directly():
+    recorded = pd.DataFrame({'zone_t': [0.0, 10.0]}, index=pd.date_range('2023-01-01 05:00', periods=2, freq='h', tz='UTC'))
+    measured = align_recorded(recorded, pd.DatetimeIndex(['2023-01-01 00:30']), TZ)
+    assert measured['zone_t'].tolist() == [5.0]
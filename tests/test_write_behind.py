@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the overflow policies of the write-behind persistence queue (persistence.write_behind)
+"""
+import configparser
+import datetime
+import threading
+import time
+import pandas as pd
+from persistence.write_behind import WriteBehindPersistence
+from simulator.signal_store import SignalStore
+
+T0 = datetime.datetime(2024, 1, 1)
+
+
+class BlockingAgent:
+    """records persisted batches; writes wait until released"""
+    def __init__(self):
+        self.release = threading.Event()
+        self.rows = []
+
+    def persist_batch(self, rows):
+        self.release.wait()
+        self.rows.extend(rows)
+
+
+def make_pipeline(tmp_path, policy, capacity=2):
+    config = configparser.ConfigParser()
+    config['PERSISTENCE'] = {'BatchSize': '1', 'FlushIntervalSeconds': '0.01', 'QueueCapacity': str(capacity),
+                             'OverflowPolicy': policy, 'SpillFile': str(tmp_path / 'spill.journal')}
+    store = SignalStore(pd.DataFrame({'PersistenceName': ['sensor']}), 'PersistenceName')
+    agent = BlockingAgent()
+    return WriteBehindPersistence(config, agent, store), agent, store
+
+
+def persist_all(pipeline, store, count):
+    for step in range(count):
+        store.write([0], [float(step)])
+        pipeline.persist(T0 + datetime.timedelta(minutes=step))
+
+
+def written_steps(agent):
+    return [int(values[0]) for _, values in agent.rows]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_block_waits_for_room_and_loses_nothing(tmp_path):
+    pipeline, agent, store = make_pipeline(tmp_path, 'block')
+    simulation = threading.Thread(target=persist_all, args=(pipeline, store, 6))
+    simulation.start()
+    #one snapshot held by the blocked writer, two queued, the simulation waits for room
+    assert wait_for(lambda: len(pipeline.queue) == 2)
+    time.sleep(0.05)
+    assert simulation.is_alive()
+    agent.release.set()
+    simulation.join(5)
+    pipeline.close()
+    assert written_steps(agent) == list(range(6))
+    assert pipeline.dropped == 0
+
+
+def test_drop_oldest_keeps_the_latest(tmp_path):
+    pipeline, agent, store = make_pipeline(tmp_path, 'drop_oldest')
+    store.write([0], [0.0])
+    pipeline.persist(T0)
+    #the writer is now blocked on snapshot 0
+    assert wait_for(lambda: not pipeline.queue)
+    for step in range(1, 6):
+        store.write([0], [float(step)])
+        pipeline.persist(T0 + datetime.timedelta(minutes=step))
+    assert pipeline.dropped == 3
+    agent.release.set()
+    pipeline.close()
+    assert written_steps(agent) == [0, 4, 5]
+
+
+def test_spill_replays_the_overflow(tmp_path):
+    pipeline, agent, store = make_pipeline(tmp_path, 'spill')
+    store.write([0], [0.0])
+    pipeline.persist(T0)
+    assert wait_for(lambda: not pipeline.queue)
+    for step in range(1, 8):
+        store.write([0], [float(step)])
+        pipeline.persist(T0 + datetime.timedelta(minutes=step))
+    assert len(pipeline.spill) == 5
+    agent.release.set()
+    assert wait_for(lambda: len(agent.rows) == 8)
+    assert len(pipeline.spill) == 0
+    pipeline.close()
+    assert sorted(written_steps(agent)) == list(range(8))
+    assert pipeline.dropped == 0